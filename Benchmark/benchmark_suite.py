@@ -0,0 +1,158 @@
+import json
+import math
+import platform
+import random
+import statistics
+import time
+from contextlib import closing
+from datetime import datetime
+from typing import Callable, List
+
+
+'''
+Benchmark harness shared by the MongoDB and Postgres measurements.
+
+For every query the connection setup is timed separately from the query itself.
+The query runs on one open connection, first n_warmup times without measurement
+and then n_runs times measured with time.perf_counter_ns. A query callable has to
+fetch the full result. The samples are summarized by mean, percentiles and a
+bootstrap confidence interval of the mean. Optionally the query plan with runtime
+statistics is recorded. Results are written as JSON so that runs can be compared.
+'''
+
+
+def percentile(sorted_samples:List[float], q:float)->float:
+    '''
+    q-th percentile (0-100) of sorted samples with linear interpolation
+    '''
+    if not sorted_samples:
+        return float('nan')
+    pos=(len(sorted_samples)-1)*q/100
+    lo=math.floor(pos)
+    hi=math.ceil(pos)
+    return sorted_samples[lo]+(sorted_samples[hi]-sorted_samples[lo])*(pos-lo)
+
+
+def bootstrap_ci(samples:List[float], confidence:float=0.95, n_resamples:int=2000, seed:int=0)->List[float]:
+    '''
+    Bootstrap confidence interval of the mean of samples
+    '''
+    rng=random.Random(seed)
+    n=len(samples)
+    means=sorted(sum(rng.choices(samples,k=n))/n for _ in range(n_resamples))
+    alpha=(1-confidence)/2*100
+    return [percentile(means,alpha),percentile(means,100-alpha)]
+
+
+def summarize(samples_ns:List[int])->dict:
+    '''
+    Summary statistics of runtime samples in nanoseconds, reported in milliseconds
+    '''
+    samples=sorted(sample/1e6 for sample in samples_ns)
+    if not samples:
+        return {'n':0}
+    return {
+        'n': len(samples),
+        'mean_ms': statistics.fmean(samples),
+        'stdev_ms': statistics.stdev(samples) if len(samples)>1 else 0.0,
+        'min_ms': samples[0],
+        'p50_ms': percentile(samples,50),
+        'p95_ms': percentile(samples,95),
+        'p99_ms': percentile(samples,99),
+        'max_ms': samples[-1],
+        'ci95_mean_ms': bootstrap_ci(samples)
+    }
+
+
+def measure(func:Callable[[],object], n_runs:int, n_warmup:int=0)->List[int]:
+    '''
+    Runtime samples in nanoseconds of n_runs calls of func after n_warmup unmeasured calls
+    '''
+    for _ in range(n_warmup):
+        func()
+    samples=[]
+    for _ in range(n_runs):
+        start=time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns()-start)
+    return samples
+
+
+def benchmark_query(name:str, connect:Callable[[],object], query:Callable[[object],object],
+                    n_runs:int=30, n_warmup:int=3, n_connects:int=5,
+                    explain:Callable[[object],object]=None)->dict:
+    '''
+    Benchmark of a query. connect opens a connection that is closed with its close method,
+    query runs the query on an open connection and fetches its full result and explain
+    returns the query plan with execution statistics
+    '''
+    connect_samples=[]
+    for _ in range(n_connects):
+        start=time.perf_counter_ns()
+        conn=connect()
+        connect_samples.append(time.perf_counter_ns()-start)
+        conn.close()
+    with closing(connect()) as conn:
+        query_samples=measure(lambda: query(conn),n_runs,n_warmup)
+        plan=explain(conn) if explain is not None else None
+    result={
+        'name': name,
+        'n_warmup': n_warmup,
+        'connect': summarize(connect_samples),
+        'query': summarize(query_samples),
+        'samples_ns': query_samples,
+        'plan': plan
+    }
+    return result
+
+
+def format_result(result:dict)->str:
+    '''
+    One line summary of a benchmark result
+    '''
+    q=result['query']
+    return '{}: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, mean {:.2f} ms (95% CI {:.2f}-{:.2f}), connect p50 {:.2f} ms'.format(
+        result['name'],q['p50_ms'],q['p95_ms'],q['p99_ms'],q['mean_ms'],
+        q['ci95_mean_ms'][0],q['ci95_mean_ms'][1],result['connect']['p50_ms'])
+
+
+def write_results(filename:str, results:List[dict], metadata:dict=None)->None:
+    '''
+    Writing of benchmark results together with information on the environment as JSON
+    '''
+    doc={
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'metadata': metadata or {},
+        'results': results
+    }
+    with open(filename,'w',encoding='utf8') as f:
+        json.dump(doc,f,indent=2,default=str)
+
+
+def compare_results(filename_old:str, filename_new:str)->List[dict]:
+    '''
+    Comparison of the p50 and p95 runtimes of two benchmark runs per query name.
+    A ratio below 1 means the new run is faster
+    '''
+    with open(filename_old,encoding='utf8') as f:
+        old={result['name']:result for result in json.load(f)['results']}
+    with open(filename_new,encoding='utf8') as f:
+        new={result['name']:result for result in json.load(f)['results']}
+    comparison=[]
+    for name in new:
+        if name not in old:
+            continue
+        row={'name':name}
+        for stat in ('p50_ms','p95_ms'):
+            row[stat+'_old']=old[name]['query'][stat]
+            row[stat+'_new']=new[name]['query'][stat]
+            row[stat+'_ratio']=new[name]['query'][stat]/old[name]['query'][stat]
+        ci_old=old[name]['query']['ci95_mean_ms']
+        ci_new=new[name]['query']['ci95_mean_ms']
+        row['significant']=ci_new[1]<ci_old[0] or ci_new[0]>ci_old[1]
+        comparison.append(row)
+        print('{}: p50 {:.2f} -> {:.2f} ms ({:.2f}x){}'.format(
+            name,row['p50_ms_old'],row['p50_ms_new'],row['p50_ms_ratio'],'' if row['significant'] else ' (not significant)'))
+    return comparison
@@ -0,0 +1,230 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+
+'''
+Deterministic generator of synthetic band data in the format of the DBpedia csv files.
+
+The files are written in the layout read by load_music_data_to_df: band-album_data.csv
+as plain ';' separated values and the other files as one quoted csv field per line,
+which holds the ';' separated and quoted values as expected by parse_files. Since
+parse_files treats the first line as header, every quoted file starts with a header.
+
+A scale factor of 1 gives 10000 bands like the DBpedia extract. The distributions
+are fitted to the extract:
+
+genres:      89% of the bands have 1+Poisson(1.65) genres, genres are drawn from a
+             vocabulary growing with the square root of the scale with Zipf popularity
+members:     37% of the bands have 1+Poisson(1.35) current and 22% of the bands
+             1+Poisson(2.0) former members. 25% of the member rows reuse a musician
+             of an earlier row and 3% of the rows use an alias of the musician name
+albums:      negative binomial number of albums per band with mean 1.22 and a long
+             tail, release years normally distributed around 1996, log-normal sales
+             and normally distributed running times. Some dates, sales and running
+             times are missing or unparsable
+
+The same seed and scale always give the same files.
+'''
+
+base_url='http://dbpedia.org/resource/'
+n_bands_per_scale=10000
+
+words=['Black','White','Red','Blue','Silver','Golden','Iron','Stone','Glass','Velvet','Electric','Crystal',
+       'Midnight','Morning','Winter','Summer','Northern','Southern','Wild','Silent','Burning','Frozen',
+       'Broken','Hidden','Lost','Lonely','Happy','Dark','Bright','Holy','Sacred','Modern','Ancient','Young',
+       'Wolves','Ravens','Kings','Queens','Saints','Sinners','Ghosts','Tigers','Rebels','Drifters','Dreamers',
+       'Shadows','Rivers','Mountains','Oceans','Stars','Hearts','Machines','Angels','Horses','Birds','Lions',
+       'Road','Fire','Rain','Thunder','Light','Night','Sky','Moon','Sun','City','Garden','Forest','Desert']
+genre_prefixes=['','Indie ','Alternative ','Post-','Progressive ','Experimental ','Hard ','Soft ','Dream ',
+                'Psychedelic ','Garage ','Noise ','Symphonic ','Melodic ','Death ','Black ','Power ','Folk ',
+                'Gothic ','Industrial ','Electro','Art ','Neo-','Acid ','Latin ','Christian ','Southern ']
+genre_names=['rock','pop','metal','punk','jazz','blues','hip hop','soul','funk','folk','country','reggae',
+             'house','techno','trance','ambient','disco','grunge','emo','ska','hardcore','shoegaze',
+             'synthpop','new wave','rhythm and blues','bluegrass','gospel','electronica','dubstep','drum and bass']
+first_names=['Anna','Ben','Chris','Dana','Eric','Fiona','Greg','Hannah','Ian','Julia','Kevin','Laura',
+             'Mike','Nina','Oscar','Paula','Quinn','Rita','Sam','Tina','Uwe','Vera','Will','Xenia','Yuri','Zoe']
+last_names=['Smith','Jones','Miller','Davis','Garcia','Wilson','Moore','Taylor','Anderson','Thomas',
+            'Jackson','Martin','Lee','Thompson','White','Harris','Clark','Lewis','Walker','Hall','Young',
+            'King','Wright','Lopez','Hill','Scott','Green','Adams','Baker','Nelson','Carter','Mitchell']
+description_words=[word.lower() for word in words]+['is','the','album','by','band','of','released','and',
+                                                    'was','in','a','second','debut','studio','recorded','with']
+
+
+def get_unique_names(parts:List[List[str]], n:int)->np.ndarray:
+    '''
+    n distinct names built from the combinations of parts, numbered once all
+    combinations are used
+    '''
+    combinations=pd.MultiIndex.from_product(parts).map(' '.join).to_numpy(dtype=object)
+    idx=np.arange(n)
+    names=combinations[idx%len(combinations)]
+    rounds=idx//len(combinations)
+    return np.where(rounds>0,names+' '+(rounds+1).astype(str).astype(object),names)
+
+
+def get_genre_vocabulary(scale:float)->np.ndarray:
+    '''
+    Genre names of a scale, about 532 genres at scale 1 ordered by popularity
+    '''
+    vocabulary=pd.MultiIndex.from_product([genre_prefixes,genre_names]).map(''.join)
+    return get_unique_names([list(vocabulary)],int(round(532*np.sqrt(scale))))
+
+
+def zipf_choice(rng:np.random.Generator, n_choices:int, size:int, exponent:float=1.1)->np.ndarray:
+    '''
+    Indices drawn from n_choices values with Zipf distributed popularity
+    '''
+    weights=1/np.arange(1,n_choices+1)**exponent
+    return rng.choice(n_choices,size=size,p=weights/weights.sum())
+
+
+def get_text(rng:np.random.Generator, vocabulary:List[str], n_words:np.ndarray)->np.ndarray:
+    '''
+    One text of n_words[i] random words of vocabulary per entry of n_words
+    '''
+    vocabulary=np.asarray(vocabulary,dtype=object)
+    all_words=vocabulary[rng.integers(0,len(vocabulary),size=int(n_words.sum()))]
+    offsets=np.concatenate([[0],np.cumsum(n_words)])
+    return np.array([' '.join(all_words[start:end]) for start,end in zip(offsets[:-1],offsets[1:])],dtype=object)
+
+
+def get_group_counts(rng:np.random.Generator, n_bands:int, share:float, mean_extra:float)->np.ndarray:
+    '''
+    Number of rows per band, where a share of the bands has 1+Poisson(mean_extra) rows
+    '''
+    return np.where(rng.random(n_bands)<share,1+rng.poisson(mean_extra,n_bands),0)
+
+
+def create_members(rng:np.random.Generator, band_urls:np.ndarray, share:float, mean_extra:float,
+                   musician_names:np.ndarray, n_musicians:int)->Tuple[pd.DataFrame,int]:
+    '''
+    Member rows (band URI, musician URI, musician name), where musicians of earlier
+    rows are reused. Returns the rows and the number of musicians used so far
+    '''
+    counts=get_group_counts(rng,len(band_urls),share,mean_extra)
+    n=int(counts.sum())
+    is_new=rng.random(n)<0.75
+    new_ids=n_musicians+np.cumsum(is_new)-1
+    #reused musicians are drawn from all musicians created before the row
+    n_known=np.maximum(new_ids+1,1)
+    musician_ids=np.where(is_new,new_ids,(rng.random(n)*n_known).astype(np.int64))
+    names=musician_names[musician_ids%len(musician_names)].copy()
+    rounds=musician_ids//len(musician_names)
+    names=np.where(rounds>0,names+' '+(rounds+1).astype(str).astype(object),names)
+    urls=base_url+pd.Series(names).str.replace(' ','_',regex=False).to_numpy(dtype=object)
+    alias=rng.random(n)<0.03
+    names=np.where(alias,names+' Jr',names)
+    df=pd.DataFrame({0:np.repeat(band_urls,counts),1:urls,2:names})
+    return df,n_musicians+int(is_new.sum())
+
+
+def create_albums(rng:np.random.Generator, band_urls:np.ndarray)->pd.DataFrame:
+    '''
+    Album rows (band URI, album name, release date, abstract, running time, sales)
+    '''
+    counts=rng.negative_binomial(1,0.45,len(band_urls))
+    n=int(counts.sum())
+    years=np.clip(np.round(rng.normal(1996,12,n)),1955,2020).astype(np.int64)
+    months=rng.integers(1,13,n)
+    days=rng.integers(1,29,n)
+    dates=pd.Series(days.astype(str))+'/'+months.astype(str)+'/'+years.astype(str)
+    date_state=rng.random(n)
+    dates=dates.where(date_state>=0.03,'').where((date_state<0.03)|(date_state>=0.05),'unknown')
+    running_times=pd.Series(np.round(np.clip(rng.normal(45,12,n),5,120),1).astype(str))
+    running_times=running_times.where(rng.random(n)>=0.1,'')
+    sales=pd.Series(np.round(rng.lognormal(np.log(300000),1.6,n)).astype(np.int64).astype(str))
+    sales=sales.where(rng.random(n)>=0.08,'')
+    names=get_text(rng,words,1+rng.poisson(1.0,n))
+    descriptions=get_text(rng,description_words,1+rng.poisson(24,n))
+    return pd.DataFrame({0:np.repeat(band_urls,counts),1:names,2:dates.to_numpy(),3:descriptions,
+                         4:running_times.to_numpy(),5:sales.to_numpy()})
+
+
+def create_dataset(scale:float=1, seed:int=0)->dict:
+    '''
+    Dataframes of all csv files for a scale factor and seed, by file name
+    '''
+    rng=np.random.default_rng(seed)
+    n_bands=int(round(n_bands_per_scale*scale))
+    band_names=get_unique_names([words,words],n_bands)
+    band_urls=base_url+pd.Series(band_names).str.replace(' ','_',regex=False).to_numpy(dtype=object)
+    is_band=rng.random(n_bands)<0.4
+    band_urls=np.where(is_band,band_urls+'_(band)',band_urls)
+
+    genre_vocabulary=get_genre_vocabulary(scale)
+    genre_counts=get_group_counts(rng,n_bands,0.89,1.65)
+    genres=genre_vocabulary[zipf_choice(rng,len(genre_vocabulary),int(genre_counts.sum()))]
+    df_genre=pd.DataFrame({0:np.repeat(band_urls,genre_counts),1:genres}).drop_duplicates()
+
+    musician_names=get_unique_names([first_names,last_names],len(first_names)*len(last_names))
+    df_member,n_musicians=create_members(rng,band_urls,0.37,1.35,musician_names,0)
+    df_former_member,_=create_members(rng,band_urls,0.22,2.0,musician_names,n_musicians)
+
+    return {
+        'band-album_data.csv': create_albums(rng,band_urls),
+        'band-band_name.csv': pd.DataFrame({0:band_urls,1:band_names}),
+        'band-member-member_name.csv': df_member,
+        'band-former_member-member_name.csv': df_former_member,
+        'band-genre_name.csv': df_genre
+    }
+
+
+headers={
+    'band-band_name.csv': ['band','bandname'],
+    'band-member-member_name.csv': ['band','member','name'],
+    'band-former_member-member_name.csv': ['band','former_member','name'],
+    'band-genre_name.csv': ['band','genre']
+}
+
+
+def format_quoted_lines(df:pd.DataFrame)->pd.Series:
+    '''
+    Lines of a quoted DBpedia csv file, e.g. "uri;""value""" for the row (uri, value)
+    '''
+    lines=pd.Series(df[0].to_numpy(dtype=object))
+    for column in df.columns[1:]:
+        lines=lines+';"'+df[column].to_numpy(dtype=object)+'"'
+    return '"'+lines.str.replace('"','""',regex=False)+'"'
+
+
+def format_lines(df:pd.DataFrame)->pd.Series:
+    '''
+    Lines of a plain ';' separated csv file
+    '''
+    lines=pd.Series(df[0].to_numpy(dtype=object))
+    for column in df.columns[1:]:
+        lines=lines+';'+df[column].to_numpy(dtype=object)
+    return lines
+
+
+def write_dataset(csv_dir:str, scale:float=1, seed:int=0)->List[str]:
+    '''
+    Writing of the csv files of a scale factor and seed into csv_dir. Returns the
+    paths of the written files
+    '''
+    os.makedirs(csv_dir,exist_ok=True)
+    paths=[]
+    for filename,df in create_dataset(scale,seed).items():
+        path=os.path.join(csv_dir,filename)
+        with open(path,'w',encoding='utf8',newline='\n') as f:
+            if filename in headers:
+                header=pd.DataFrame([headers[filename]])
+                f.write('\n'.join(format_quoted_lines(header))+'\n')
+                f.write('\n'.join(format_quoted_lines(df))+'\n')
+            else:
+                f.write('\n'.join(format_lines(df))+'\n')
+        paths.append(path)
+        print('Wrote {} rows to {}'.format(len(df),path))
+    return paths
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Generation of synthetic DBpedia csv files')
+    parser.add_argument('csv_dir')
+    parser.add_argument('--scale',type=float,default=1)
+    parser.add_argument('--seed',type=int,default=0)
+    args=parser.parse_args()
+    write_dataset(args.csv_dir,args.scale,args.seed)
@@ -0,0 +1,289 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List
+from Connections.connection_manager import get_settings
+
+
+'''
+Instrumentation of the loaders and queries.
+
+An instrumented entry point is one run. During a run the stages record timing spans
+(csv_parse, type_coercion, id_mapping, document_build, network_write, ...) and the
+write paths count rows and bytes per table or collection. Every span keeps the number
+of calls, the total seconds including nested spans and the self seconds without them,
+so nested stages are not counted twice. Outside of a run spans and counters do nothing.
+
+The [instrumentation] section of the settings configures the runs:
+
+output:      empty (nothing recorded), log (one JSON line per run) or prometheus
+             (text exposition format, e.g. for the textfile collector of node_exporter)
+path:        file the output is appended (log) or written (prometheus) to, standard
+             error if empty
+tracemalloc: 1 to sample the peak memory of the run with tracemalloc
+profiler:    empty, cprofile or pyinstrument, the profile of every run is written to
+             profile_dir as <run>.prof or <run>.pyinstrument.txt
+'''
+
+metric_prefix='musicians'
+
+
+class Instrumentation:
+    '''
+    Spans and counters of the current run, shared by all threads of the process
+    '''
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.local=threading.local()
+        self.run=None
+        self.reset()
+
+    def reset(self)->None:
+        with self.lock:
+            self.spans={}
+            self.counters={}
+            self.gauges={}
+
+    @property
+    def active(self)->bool:
+        return self.run is not None
+
+    def get_stack(self)->List[list]:
+        stack=getattr(self.local,'stack',None)
+        if stack is None:
+            stack=self.local.stack=[]
+        return stack
+
+    def add_span(self, stage:str, labels:dict, seconds:float, self_seconds:float, calls:int=1, max_seconds:float=None)->None:
+        key=(stage,tuple(sorted(labels.items())))
+        with self.lock:
+            entry=self.spans.setdefault(key,[0,0.0,0.0,0.0])
+            entry[0]+=calls
+            entry[1]+=seconds
+            entry[2]+=self_seconds
+            entry[3]=max(entry[3],seconds if max_seconds is None else max_seconds)
+
+    @contextmanager
+    def span(self, stage:str, **labels)->Iterator[None]:
+        '''
+        Timing of the enclosed block as a call of stage
+        '''
+        if not self.active:
+            yield
+            return
+        stack=self.get_stack()
+        stack.append([0.0])
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds=time.perf_counter()-start
+            child_seconds=stack.pop()[0]
+            if stack:
+                stack[-1][0]+=seconds
+            self.add_span(stage,labels,seconds,seconds-child_seconds)
+
+    def timed(self, stage:str, iterable:Iterable, **labels)->Iterator:
+        '''
+        Generator yielding the items of iterable, where the time spent producing the
+        items is recorded as stage with one call per item
+        '''
+        if not self.active:
+            yield from iterable
+            return
+        iterator=iter(iterable)
+        calls,seconds,self_seconds,max_seconds=0,0.0,0.0,0.0
+        try:
+            while True:
+                stack=self.get_stack()
+                stack.append([0.0])
+                start=time.perf_counter()
+                try:
+                    item=next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed=time.perf_counter()-start
+                    child_seconds=stack.pop()[0]
+                    if stack:
+                        stack[-1][0]+=elapsed
+                    seconds+=elapsed
+                    self_seconds+=elapsed-child_seconds
+                    max_seconds=max(max_seconds,elapsed)
+                calls+=1
+                yield item
+        finally:
+            self.add_span(stage,labels,seconds,self_seconds,calls,max_seconds)
+
+    def count(self, name:str, value:float=1, **labels)->None:
+        '''
+        Increase of the counter name, e.g. rows or bytes, by value
+        '''
+        if not self.active:
+            return
+        key=(name,tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key]=self.counters.get(key,0)+value
+
+    def set_gauge(self, name:str, value:float, **labels)->None:
+        key=(name,tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key]=value
+
+    def get_record(self)->dict:
+        '''
+        Spans, counters and gauges of the current run as a JSON serializable record
+        '''
+        with self.lock:
+            spans=[dict(labels, stage=stage, calls=calls, seconds=seconds, self_seconds=self_seconds, max_seconds=max_seconds)
+                   for (stage,labels),(calls,seconds,self_seconds,max_seconds) in self.spans.items()]
+            counters=[dict(labels, name=name, value=value) for (name,labels),value in self.counters.items()]
+            gauges=[dict(labels, name=name, value=value) for (name,labels),value in self.gauges.items()]
+        return {'run': self.run, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'spans': spans, 'counters': counters, 'gauges': gauges}
+
+    def to_prometheus(self)->str:
+        '''
+        Spans, counters and gauges of the current run in the Prometheus text format
+        '''
+        def format_labels(labels:dict)->str:
+            values=['{}="{}"'.format(key,str(val).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n'))
+                    for key,val in sorted(labels.items())]
+            return '{'+','.join(values)+'}'
+
+        samples={}
+        types={}
+        with self.lock:
+            for (stage,labels),(calls,seconds,self_seconds,max_seconds) in self.spans.items():
+                labels=dict(labels, run=self.run, stage=stage)
+                for name,value in [('stage_calls_total',calls),('stage_seconds_total',seconds),
+                                   ('stage_self_seconds_total',self_seconds)]:
+                    types[name]='counter'
+                    samples.setdefault(name,[]).append((labels,value))
+                types['stage_max_seconds']='gauge'
+                samples.setdefault('stage_max_seconds',[]).append((labels,max_seconds))
+            for (name,labels),value in self.counters.items():
+                name='{}_total'.format(name)
+                types[name]='counter'
+                samples.setdefault(name,[]).append((dict(labels, run=self.run),value))
+            for (name,labels),value in self.gauges.items():
+                types[name]='gauge'
+                samples.setdefault(name,[]).append((dict(labels, run=self.run),value))
+        lines=[]
+        for name in sorted(samples):
+            lines.append('# TYPE {}_{} {}'.format(metric_prefix,name,types[name]))
+            for labels,value in samples[name]:
+                lines.append('{}_{}{} {}'.format(metric_prefix,name,format_labels(labels),repr(float(value))))
+        return '\n'.join(lines)+'\n'
+
+
+instrumentation=Instrumentation()
+span=instrumentation.span
+timed=instrumentation.timed
+count=instrumentation.count
+
+
+def write_output(output:str, path:str)->None:
+    '''
+    Writing of the current run as a JSON line or in the Prometheus text format
+    '''
+    if output=='log':
+        text=json.dumps(instrumentation.get_record())+'\n'
+        mode='a'
+    elif output=='prometheus':
+        text=instrumentation.to_prometheus()
+        mode='w'
+    else:
+        raise ValueError('Unknown instrumentation output: {}'.format(output))
+    if not path:
+        sys.stderr.write(text)
+        return
+    #the prometheus file is replaced atomically, so collectors never read a partial file
+    tmp_path=path if mode=='a' else path+'.tmp'
+    with open(tmp_path,mode,encoding='utf8') as f:
+        f.write(text)
+    if tmp_path!=path:
+        os.replace(tmp_path,path)
+
+
+@contextmanager
+def start_profiler(profiler:str, name:str, profile_dir:str)->Iterator[None]:
+    '''
+    Profiling of the enclosed block with cProfile or pyinstrument
+    '''
+    if profiler=='cprofile':
+        import cProfile
+        profile=cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(profile_dir,'{}.prof'.format(name)))
+    elif profiler=='pyinstrument':
+        import pyinstrument
+        profile=pyinstrument.Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(os.path.join(profile_dir,'{}.pyinstrument.txt'.format(name)),'w',encoding='utf8') as f:
+                f.write(profile.output_text(unicode=True))
+    elif not profiler:
+        yield
+    else:
+        raise ValueError('Unknown profiler: {}'.format(profiler))
+
+
+@contextmanager
+def profile_run(name:str, output:str=None, path:str=None)->Iterator[Instrumentation]:
+    '''
+    Recording of the enclosed block as the run name with the settings of the
+    [instrumentation] section, output and path override the settings. A run inside
+    another run is recorded as a span of the outer run
+    '''
+    config=get_settings()['instrumentation']
+    output=config['output'] if output is None else output
+    path=config['path'] if path is None else path
+    if instrumentation.active or not output:
+        with instrumentation.span(name):
+            yield instrumentation
+        return
+    instrumentation.reset()
+    instrumentation.run=name
+    use_tracemalloc=config['tracemalloc']=='1' and not tracemalloc.is_tracing()
+    if use_tracemalloc:
+        tracemalloc.start()
+    start=time.perf_counter()
+    try:
+        with start_profiler(config['profiler'],name,config['profile_dir']):
+            yield instrumentation
+    finally:
+        instrumentation.set_gauge('run_seconds',time.perf_counter()-start)
+        if use_tracemalloc:
+            instrumentation.set_gauge('peak_memory_bytes',tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        try:
+            write_output(output,path)
+        finally:
+            instrumentation.run=None
+
+
+def instrumented(name:str=None)->Callable:
+    '''
+    Decorator recording every call of an entry point as a run
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_run(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,176 @@
+import argparse
+import os
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, List
+from Connections.connection_manager import get_settings, get_postgres_dsn, postgres_connection
+from Benchmark.benchmark_suite import benchmark_query, format_result, write_results
+from Benchmark.data_generator import write_dataset
+
+
+'''
+Load and query benchmarks on synthetic data at several scale factors.
+
+For every scale factor the csv files are generated with Benchmark.data_generator and
+used as data directory of the loaders. Every load path starts from empty tables or an
+empty collection and is timed once, its throughput is reported in csv rows per second.
+The flagship query (the most successful band of the 2010s in the most successful genre
+of the 1990s) is benchmarked on both databases after the loads.
+
+The efficiency of a path is its throughput relative to the smallest scale factor, for
+queries it is the p50 runtime growth relative to the data growth. An efficiency well
+below 1 shows where a path stops scaling. The parsed csv files are cached before the
+loads, so the loads do not include the csv parsing.
+'''
+
+root_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_data_dir=os.path.join(root_dir,'csv_files','synthetic')
+
+query_truncate_tables='''
+TRUNCATE bands, albums, genres, musicians, has_genre, member_of, has_name RESTART IDENTITY CASCADE;
+'''
+
+
+def truncate_tables()->None:
+    with postgres_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query_truncate_tables)
+
+
+def get_load_paths()->Dict[str,Callable[[],object]]:
+    '''
+    Load paths by name. The loaders are imported lazily, since they import pandas and
+    both database drivers
+    '''
+    from Postgres import postgres_data_insertion
+    from MongoDB import mongo_data_insertion, mongo_optimization
+    from Connections.connection_manager import get_mongo_collection
+
+    def postgres_load(insert):
+        def load():
+            truncate_tables()
+            insert()
+        return load
+
+    def mongo_add_field():
+        mongo_optimization.add_field(get_mongo_collection(),mongo_optimization.pipeline_90s_sales,'band_sales_90s')
+
+    return {
+        'postgres insert': postgres_load(postgres_data_insertion.insert),
+        'postgres insert_copy': postgres_load(postgres_data_insertion.insert_copy),
+        'mongo insert': mongo_data_insertion.insert,
+        'mongo insert_streaming': mongo_data_insertion.insert_streaming,
+        'mongo add_field': mongo_add_field
+    }
+
+
+def benchmark_flagship_queries(n_runs:int)->List[dict]:
+    '''
+    Benchmarks of the flagship query on both databases
+    '''
+    import psycopg2
+    import pymongo
+    from Postgres.postgres_sales_views import get_most_successful_genre_id, get_most_successful_band_url
+    from MongoDB.mongo_queries import get_genre, get_band
+    mongo=get_settings()['mongodb']
+
+    def query_postgres(conn):
+        with conn.cursor() as cur:
+            genre_id=get_most_successful_genre_id(cur,date(1989,12,31),date(2000,1,1))
+            return get_most_successful_band_url(cur,date(2009,12,31),date(2020,1,1),genre_id)
+
+    def query_mongo(client):
+        col=client[mongo['database']][mongo['collection']]
+        genre=get_genre(col,datetime(1989,12,31),datetime(2000,1,1))
+        return get_band(col,datetime(2009,12,31),datetime(2020,1,1),genre)
+
+    return [
+        benchmark_query('postgres flagship query',lambda: psycopg2.connect(**get_postgres_dsn()),query_postgres,n_runs=n_runs),
+        benchmark_query('mongo flagship query',lambda: pymongo.MongoClient(mongo['uri']),query_mongo,n_runs=n_runs)
+    ]
+
+
+def run_scale(scale:float, seed:int, data_dir:str, paths:List[str], n_runs:int)->List[dict]:
+    '''
+    Generation of the data of a scale factor, timing of the load paths and benchmarks
+    of the queries
+    '''
+    from Postgres.postgres_data_insertion import load_music_data_to_df
+    csv_dir=os.path.join(data_dir,'scale_{:g}'.format(scale))
+    write_dataset(csv_dir,scale,seed)
+    get_settings()['data']['csv_dir']=csv_dir
+    n_rows=sum(len(df) for df in load_music_data_to_df())
+    load_paths=get_load_paths()
+    results=[]
+    for name in paths:
+        start=time.perf_counter()
+        load_paths[name]()
+        seconds=time.perf_counter()-start
+        results.append({'name': name, 'kind': 'load', 'scale': scale, 'n_rows': n_rows,
+                        'seconds': seconds, 'rows_per_s': n_rows/seconds})
+        print('{} at {:g}x: {:.2f} s, {:.0f} rows/s'.format(name,scale,seconds,n_rows/seconds))
+    for result in benchmark_flagship_queries(n_runs):
+        print('{:g}x {}'.format(scale,format_result(result)))
+        result.update({'kind': 'query', 'scale': scale, 'n_rows': n_rows})
+        results.append(result)
+    return results
+
+
+def add_efficiency(results:List[dict])->None:
+    '''
+    Efficiency of every result relative to the result of the same path at the smallest scale
+    '''
+    baselines={}
+    for result in sorted(results,key=lambda result: result['scale']):
+        baseline=baselines.setdefault(result['name'],result)
+        growth=result['n_rows']/baseline['n_rows']
+        if result['kind']=='load':
+            result['efficiency']=result['rows_per_s']/baseline['rows_per_s']
+        else:
+            result['efficiency']=growth/(result['query']['p50_ms']/baseline['query']['p50_ms'])
+
+
+def format_curves(results:List[dict])->str:
+    '''
+    Table of the throughput or p50 runtime and the efficiency of every path per scale factor
+    '''
+    lines=['{:<28}{:>8}{:>12}{:>16}{:>12}'.format('path','scale','rows','rows/s | p50','efficiency')]
+    for result in sorted(results,key=lambda result: (result['kind'],result['name'],result['scale'])):
+        value='{:.0f}'.format(result['rows_per_s']) if result['kind']=='load' else '{:.2f} ms'.format(result['query']['p50_ms'])
+        lines.append('{:<28}{:>7g}x{:>12}{:>16}{:>12.2f}'.format(
+            result['name'],result['scale'],result['n_rows'],value,result['efficiency']))
+    return '\n'.join(lines)
+
+
+default_paths=['postgres insert_copy','mongo insert_streaming','mongo add_field']
+
+
+def run_scale_benchmark(scales:List[float]=(1,10,100), seed:int=0, data_dir:str=default_data_dir,
+                        paths:List[str]=default_paths, n_runs:int=10, output:str=None)->List[dict]:
+    '''
+    Benchmarks at all scale factors, printing the throughput curves and writing the
+    results as JSON to output in the repository root
+    '''
+    data_dir=os.path.abspath(data_dir)
+    paths=paths or default_paths
+    results=[]
+    for scale in scales:
+        results.extend(run_scale(scale,seed,data_dir,paths,n_runs))
+    add_efficiency(results)
+    print(format_curves(results))
+    output=output or 'scale_benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S'))
+    write_results(os.path.join(root_dir,output),results,
+                  {'scales': list(scales), 'seed': seed, 'paths': list(paths)})
+    return results
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Load and query benchmarks at several scale factors')
+    parser.add_argument('--scales',type=float,nargs='+',default=[1,10,100])
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--data-dir',default=default_data_dir)
+    parser.add_argument('--paths',nargs='+',default=default_paths)
+    parser.add_argument('--n-runs',type=int,default=10)
+    parser.add_argument('--output')
+    args=parser.parse_args()
+    run_scale_benchmark(args.scales,args.seed,args.data_dir,args.paths,args.n_runs,args.output)
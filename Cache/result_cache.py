@@ -0,0 +1,273 @@
+import atexit
+import functools
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from Connections.connection_manager import get_settings
+
+
+'''
+Read-through cache for the results of the query functions.
+
+Results are kept in an in-process LRU with a time to live and optionally in a shared
+backend, which is either a local sqlite file or a Redis compatible server. Keys are
+built from a namespace (the database system), the data version of the namespace, the
+database the query runs on (the full name of a collection or the host, port and
+database name of the connection of a cursor), the query name and the arguments after
+the collection or cursor. Write paths call
+bump_data_version, so all entries of the namespace computed before the write are not
+found anymore and age out of the LRU and the backend.
+
+Without a shared backend the data version only lives in the process, so writes of
+other processes are only noticed after the time to live. The cache is configured by
+the [cache] section of the settings: maxsize, ttl in seconds and backend, which is
+empty, disk (with path) or redis (with redis_url).
+'''
+
+
+class LRUCache:
+    '''
+    Thread safe least recently used cache whose entries expire after ttl seconds
+    '''
+    def __init__(self, maxsize:int=1024, ttl:float=300, clock:Callable[[],float]=time.monotonic):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.clock=clock
+        self.entries=OrderedDict()
+        self.lock=threading.Lock()
+
+    def get(self, key:str, default=None):
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is None:
+                return default
+            expires,value=entry
+            if expires<=self.clock():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key:str, value)->None:
+        with self.lock:
+            self.entries[key]=(self.clock()+self.ttl,value)
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self)->None:
+        with self.lock:
+            self.entries.clear()
+
+
+class DiskBackend:
+    '''
+    Shared backend in a sqlite file, usable by several processes on one machine. Every
+    thread opens one connection, which is reused until close
+    '''
+    def __init__(self, path:str):
+        self.path=path
+        self.local=threading.local()
+        self.connections=[]
+        self.lock=threading.Lock()
+        with self.connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters(key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def connect(self)->sqlite3.Connection:
+        '''
+        Connection of the current thread, used as context manager for one transaction
+        '''
+        conn=getattr(self.local,'conn',None)
+        if conn is None:
+            conn=sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.local.conn=conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self)->None:
+        '''
+        Closing of the connections of all threads
+        '''
+        with self.lock:
+            connections,self.connections=self.connections,[]
+        for conn in connections:
+            conn.close()
+        self.local=threading.local()
+
+    def get(self, key:str)->Optional[bytes]:
+        with self.connect() as conn:
+            row=conn.execute('SELECT value FROM entries WHERE key=? AND expires>?', (key,time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key:str, value:bytes, ttl:float)->None:
+        with self.connect() as conn:
+            conn.execute('DELETE FROM entries WHERE expires<=?', (time.time(),))
+            conn.execute('INSERT OR REPLACE INTO entries VALUES(?,?,?)', (key,value,time.time()+ttl))
+
+    def get_counter(self, key:str)->int:
+        with self.connect() as conn:
+            row=conn.execute('SELECT value FROM counters WHERE key=?', (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def incr(self, key:str)->int:
+        with self.connect() as conn:
+            conn.execute('INSERT INTO counters VALUES(?,1) ON CONFLICT(key) DO UPDATE SET value=value+1', (key,))
+            return conn.execute('SELECT value FROM counters WHERE key=?', (key,)).fetchone()[0]
+
+
+class RedisBackend:
+    '''
+    Shared backend on a Redis compatible server
+    '''
+    def __init__(self, url:str):
+        import redis
+        self.client=redis.Redis.from_url(url)
+
+    def get(self, key:str)->Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key:str, value:bytes, ttl:float)->None:
+        self.client.set(key, value, ex=max(int(ttl),1))
+
+    def get_counter(self, key:str)->int:
+        value=self.client.get(key)
+        return 0 if value is None else int(value)
+
+    def incr(self, key:str)->int:
+        return self.client.incr(key)
+
+    def close(self)->None:
+        self.client.close()
+
+
+class ResultCache:
+    '''
+    Read-through cache of query results with data versions per namespace
+    '''
+    def __init__(self, maxsize:int=1024, ttl:float=300, backend=None):
+        self.ttl=ttl
+        self.local=LRUCache(maxsize, ttl)
+        self.backend=backend
+        self.versions={}
+        self.lock=threading.Lock()
+        self.n_hits=0
+        self.n_misses=0
+
+    def get_data_version(self, namespace:str)->int:
+        if self.backend is not None:
+            return self.backend.get_counter('version:'+namespace)
+        with self.lock:
+            return self.versions.get(namespace,0)
+
+    def bump_data_version(self, namespace:str)->int:
+        '''
+        Invalidation of all entries of a namespace
+        '''
+        if self.backend is not None:
+            return self.backend.incr('version:'+namespace)
+        with self.lock:
+            self.versions[namespace]=self.versions.get(namespace,0)+1
+            return self.versions[namespace]
+
+    def close(self)->None:
+        if self.backend is not None:
+            self.backend.close()
+
+    def get_key(self, namespace:str, name:str, args:tuple, kwargs:dict, scope:str='')->str:
+        return '{}:v{}:{}:{}:{!r}:{!r}'.format(namespace, self.get_data_version(namespace), scope, name,
+                                               args, sorted(kwargs.items()))
+
+    def get_or_compute(self, key:str, compute:Callable[[],object]):
+        missing=object()
+        value=self.local.get(key, missing)
+        if value is missing and self.backend is not None:
+            stored=self.backend.get(key)
+            if stored is not None:
+                value=pickle.loads(stored)
+                self.local.set(key, value)
+        if value is not missing:
+            self.n_hits+=1
+            return value
+        self.n_misses+=1
+        value=compute()
+        self.local.set(key, value)
+        if self.backend is not None:
+            self.backend.set(key, pickle.dumps(value), self.ttl)
+        return value
+
+    def cached(self, namespace:str, name:str=None)->Callable:
+        '''
+        Decorator caching a query function whose first argument is the collection or
+        cursor, which is part of the key by the database it belongs to
+        '''
+        def decorator(func):
+            query_name=name or func.__name__
+            @functools.wraps(func)
+            def wrapper(col, *args, **kwargs):
+                key=self.get_key(namespace, query_name, args, kwargs, get_scope(col))
+                return self.get_or_compute(key, lambda: func(col, *args, **kwargs))
+            wrapper.uncached=func
+            return wrapper
+        return decorator
+
+
+def get_scope(col)->str:
+    '''
+    Database a query runs on: the full name of a MongoDB collection or the host, port
+    and database name of the connection of a Postgres cursor
+    '''
+    full_name=getattr(col,'full_name',None)
+    if full_name is not None:
+        return full_name
+    info=getattr(getattr(col,'connection',None),'info',None)
+    if info is not None:
+        return '{}:{}/{}'.format(info.host, info.port, info.dbname)
+    return ''
+
+
+result_cache=None
+lock=threading.Lock()
+
+
+def get_result_cache()->ResultCache:
+    '''
+    Result cache of the process configured by the settings
+    '''
+    global result_cache
+    with lock:
+        if result_cache is None:
+            config=get_settings()['cache']
+            backend=None
+            if config['backend']=='disk':
+                backend=DiskBackend(config['path'])
+            elif config['backend']=='redis':
+                backend=RedisBackend(config['redis_url'])
+            result_cache=ResultCache(int(config['maxsize']), float(config['ttl']), backend)
+            atexit.register(result_cache.close)
+        return result_cache
+
+
+def cached_query(namespace:str, name:str=None)->Callable:
+    '''
+    Decorator caching a query function in the result cache of the process. The cache
+    is only configured on the first call
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(col, *args, **kwargs):
+            return get_result_cache().cached(namespace, name or func.__name__)(func)(col, *args, **kwargs)
+        wrapper.uncached=func
+        return wrapper
+    return decorator
+
+
+def bump_data_version(namespace:str)->int:
+    '''
+    Invalidation of the cached results of a namespace after a write
+    '''
+    return get_result_cache().bump_data_version(namespace)
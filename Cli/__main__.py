@@ -0,0 +1,4 @@
+from Cli.cli import main
+
+
+main()
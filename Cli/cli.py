@@ -0,0 +1,295 @@
+import argparse
+import os
+import sys
+
+
+'''
+Command line interface of the repository:
+
+python -m Cli load postgres|mongodb [--method ...] [--csv-dir DIR]
+python -m Cli optimize postgres|mongodb
+python -m Cli query postgres|mongodb [--cached]
+python -m Cli partitions create|maintain|check [--interval year|decade]
+python -m Cli bench scale|postgres|mongodb|imports
+
+Importing this module only imports the standard library. Every subcommand imports the
+modules it needs when it runs, so a Postgres query does not import pandas or pymongo
+and a MongoDB query does not import pandas or psycopg2. With --import-only a subcommand
+stops after its imports, which is used by bench imports to measure the startup time of
+every subcommand with python -X importtime.
+'''
+
+root_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+load_methods={
+    'postgres': ['insert','copy','parallel','catalog','sync'],
+    'mongodb': ['insert','streaming','parallel','sync','postgres','albums']
+}
+
+#heavy modules a subcommand must not import
+forbidden_imports={
+    'query postgres': ['pandas','numpy','pyarrow','pymongo'],
+    'query mongodb': ['pandas','numpy','pyarrow','psycopg2']
+}
+
+import_commands=[['load','postgres'],['load','mongodb'],['optimize','postgres'],['optimize','mongodb'],
+                 ['query','postgres'],['query','mongodb'],['partitions','check'],['bench','scale']]
+
+
+def set_csv_dir(csv_dir:str)->None:
+    '''
+    Overriding of the directory of the csv files for this process
+    '''
+    from Connections.connection_manager import get_settings
+    if csv_dir:
+        get_settings()['data']['csv_dir']=os.path.abspath(csv_dir)
+
+
+def load(args:argparse.Namespace)->None:
+    '''
+    Loading of the csv files into a database
+    '''
+    method=args.method or ('copy' if args.database=='postgres' else 'streaming')
+    if method not in load_methods[args.database]:
+        raise SystemExit('Unknown load method for {}: {}'.format(args.database,method))
+    if args.database=='postgres':
+        from Postgres import postgres_data_insertion
+        if args.import_only:
+            return
+        set_csv_dir(args.csv_dir)
+        if method=='insert':
+            postgres_data_insertion.insert()
+        elif method=='copy':
+            postgres_data_insertion.insert_copy()
+        elif method=='parallel':
+            postgres_data_insertion.insert_copy_parallel(n_workers=args.workers)
+        elif method=='catalog':
+            from Postgres.postgres_catalog import Catalog
+            postgres_data_insertion.insert_copy_catalog(Catalog.load())
+        else:
+            postgres_data_insertion.sync()
+    else:
+        from MongoDB import mongo_data_insertion
+        if args.import_only:
+            return
+        set_csv_dir(args.csv_dir)
+        if method=='insert':
+            mongo_data_insertion.insert()
+        elif method=='streaming':
+            mongo_data_insertion.insert_streaming(batch_size=args.batch_size,n_writers=args.workers or 1)
+        elif method=='parallel':
+            mongo_data_insertion.insert_parallel(n_workers=args.workers,batch_size=args.batch_size)
+        elif method=='sync':
+            mongo_data_insertion.sync(batch_size=args.batch_size)
+        elif method=='postgres':
+            mongo_data_insertion.sync_from_postgres(batch_size=args.batch_size)
+        else:
+            from MongoDB.mongo_album_layout import insert_albums
+            insert_albums(batch_size=args.batch_size)
+
+
+def optimize(args:argparse.Namespace)->None:
+    '''
+    Creation of the indexes, rollups and derived fields or views the optimized queries use
+    '''
+    if args.database=='postgres':
+        from Connections.connection_manager import postgres_connection
+        from Postgres.postgres_sales_views import create_sales_view
+        if args.import_only:
+            return
+        with postgres_connection() as conn:
+            create_sales_view(conn)
+    else:
+        from Connections.connection_manager import get_mongo_collection
+        from MongoDB.mongo_optimization import create_indexes, create_additional_fields
+        from MongoDB.mongo_album_layout import create_albums_from_bands
+        if args.import_only:
+            return
+        col=get_mongo_collection()
+        create_indexes(col)
+        create_additional_fields(col)
+        if args.album_layout:
+            create_albums_from_bands(col)
+    print('Optimized {} database.'.format(args.database))
+
+
+def query(args:argparse.Namespace)->None:
+    '''
+    Get the most successful band in the 2010s in the most successful genre of the 1990s
+    '''
+    from datetime import date, datetime
+    if args.database=='postgres':
+        from Connections.connection_manager import postgres_connection
+        if args.cached:
+            from Postgres.postgres_sales_views import get_most_successful_genre_id_cached as get_genre_id, \
+                get_most_successful_band_url_cached as get_band_url
+        else:
+            from Postgres.postgres_sales_views import get_most_successful_genre_id as get_genre_id, \
+                get_most_successful_band_url as get_band_url
+        if args.import_only:
+            return
+        with postgres_connection() as conn:
+            with conn.cursor() as cur:
+                genre_id=get_genre_id(cur,date(1989,12,31),date(2000,1,1))
+                band=get_band_url(cur,date(2009,12,31),date(2020,1,1),genre_id)
+    else:
+        from Connections.connection_manager import get_mongo_collection
+        if args.cached:
+            from MongoDB.mongo_queries import get_genre_cached as get_genre, get_band_cached as get_band
+        else:
+            from MongoDB.mongo_queries import get_genre, get_band
+        if args.import_only:
+            return
+        col=get_mongo_collection()
+        genre=get_genre(col,datetime(1989,12,31),datetime(2000,1,1))
+        band=get_band(col,datetime(2009,12,31),datetime(2020,1,1),genre)
+    print('Most successful band: {}'.format(band))
+
+
+def partitions(args:argparse.Namespace)->None:
+    '''
+    Partitioning of the albums table by release_date, creation of the next partitions
+    and check of the partition pruning of the queries
+    '''
+    from datetime import date
+    from Connections.connection_manager import postgres_connection
+    from Postgres.postgres_partitions import create_partitioned_albums, maintain_partitions, check_pruning
+    if args.import_only:
+        return
+    with postgres_connection() as conn:
+        if args.action=='create':
+            create_partitioned_albums(conn,args.interval,args.drop_dependents)
+        elif args.action=='maintain':
+            maintain_partitions(conn,args.ahead)
+        else:
+            with conn.cursor() as cur:
+                results=[result for start_date,end_date in [(date(1990,1,1),date(1999,12,31)),(date(2010,1,1),date(2019,12,31))]
+                         for result in check_pruning(cur,start_date,end_date,genre_id=1)]
+            for result in results:
+                print('{:<18} pruned: {!s:<6} scanned: {}'.format(result['query'],result['pruned'],', '.join(result['scanned'])))
+            if not all(result['pruned'] for result in results):
+                raise SystemExit(1)
+
+
+def get_import_times(command:list)->dict:
+    '''
+    Import time of a subcommand from the output of python -X importtime, the total of
+    the self times of all imported modules in ms, and the imported top-level modules
+    '''
+    import subprocess
+    import time
+    start=time.perf_counter()
+    res=subprocess.run([sys.executable,'-X','importtime','-m','Cli','--import-only']+command,
+                       cwd=root_dir,capture_output=True,text=True,check=True)
+    wall_ms=(time.perf_counter()-start)*1000
+    total_us=0
+    modules=set()
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us,_,name=line[len('import time:'):].split('|')
+        total_us+=int(self_us)
+        modules.add(name.strip().split('.')[0])
+    return {'import_ms': total_us/1000, 'wall_ms': wall_ms, 'modules': modules}
+
+
+def bench_imports(n_runs:int, max_ms:float=None)->bool:
+    '''
+    Median import and process time of every subcommand over n_runs fresh processes.
+    Returns False if a subcommand imports a forbidden module or exceeds max_ms
+    '''
+    import statistics
+    ok=True
+    for command in import_commands:
+        runs=[get_import_times(command) for _ in range(n_runs)]
+        import_ms=statistics.median(run['import_ms'] for run in runs)
+        wall_ms=statistics.median(run['wall_ms'] for run in runs)
+        name=' '.join(command)
+        forbidden=sorted(set(forbidden_imports.get(name,[]))&runs[0]['modules'])
+        heavy=sorted({'pandas','numpy','pyarrow','pymongo','psycopg2'}&runs[0]['modules'])
+        print('{:<20} imports {:7.1f} ms, process {:7.1f} ms, heavy modules: {}{}'.format(
+            name,import_ms,wall_ms,', '.join(heavy) or '-',
+            ' (forbidden: {})'.format(', '.join(forbidden)) if forbidden else ''))
+        if forbidden or (max_ms is not None and import_ms>max_ms):
+            ok=False
+    return ok
+
+
+def bench(args:argparse.Namespace)->None:
+    '''
+    Benchmarks of the loaders and queries
+    '''
+    if args.benchmark=='imports':
+        if args.import_only:
+            return
+        if not bench_imports(args.n_runs,args.max_ms):
+            raise SystemExit(1)
+    elif args.benchmark=='scale':
+        from Benchmark.scale_benchmark import run_scale_benchmark, default_data_dir
+        if args.import_only:
+            return
+        run_scale_benchmark(args.scales,args.seed,args.data_dir or default_data_dir,
+                            args.paths or None,args.n_runs)
+    elif args.benchmark=='postgres':
+        from Postgres.postgres_optimization_measurements import run_measurements
+        if args.import_only:
+            return
+        run_measurements(args.n_runs)
+    else:
+        from MongoDB.mongo_optimization_measurements import run_measurements
+        if args.import_only:
+            return
+        run_measurements(args.n_runs)
+
+
+def get_parser()->argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(prog='python -m Cli',description='Musicians databases')
+    parser.add_argument('--import-only',action='store_true',help='stop after importing the modules of the subcommand')
+    subparsers=parser.add_subparsers(dest='command',required=True)
+
+    parser_load=subparsers.add_parser('load',help='load the csv files into a database')
+    parser_load.add_argument('database',choices=['postgres','mongodb'])
+    parser_load.add_argument('--method',help='postgres: {}, mongodb: {}'.format(
+        '|'.join(load_methods['postgres']),'|'.join(load_methods['mongodb'])))
+    parser_load.add_argument('--csv-dir',help='directory of the csv files, overrides the [data] settings')
+    parser_load.add_argument('--workers',type=int)
+    parser_load.add_argument('--batch-size',type=int,default=1000)
+    parser_load.set_defaults(func=load)
+
+    parser_optimize=subparsers.add_parser('optimize',help='create indexes, rollups and derived data')
+    parser_optimize.add_argument('database',choices=['postgres','mongodb'])
+    parser_optimize.add_argument('--album-layout',action='store_true',help='also create the album collection')
+    parser_optimize.set_defaults(func=optimize)
+
+    parser_query=subparsers.add_parser('query',help='run the flagship query')
+    parser_query.add_argument('database',choices=['postgres','mongodb'])
+    parser_query.add_argument('--cached',action='store_true',help='use the read-through result cache')
+    parser_query.set_defaults(func=query)
+
+    parser_partitions=subparsers.add_parser('partitions',help='partition the albums table of postgres by release_date')
+    parser_partitions.add_argument('action',choices=['create','maintain','check'])
+    parser_partitions.add_argument('--interval',choices=['year','decade'],default='decade')
+    parser_partitions.add_argument('--ahead',type=int,default=1,help='maintain: number of periods created ahead')
+    parser_partitions.add_argument('--drop-dependents',action='store_true',
+                                   help='create: drop the foreign keys referencing albums and the views depending on albums')
+    parser_partitions.set_defaults(func=partitions)
+
+    parser_bench=subparsers.add_parser('bench',help='run a benchmark')
+    parser_bench.add_argument('benchmark',choices=['scale','postgres','mongodb','imports'])
+    parser_bench.add_argument('--n-runs',type=int,default=10)
+    parser_bench.add_argument('--max-ms',type=float,help='imports: fail if a subcommand imports longer')
+    parser_bench.add_argument('--scales',type=float,nargs='+',default=[1,10,100])
+    parser_bench.add_argument('--seed',type=int,default=0)
+    parser_bench.add_argument('--data-dir')
+    parser_bench.add_argument('--paths',nargs='+')
+    parser_bench.set_defaults(func=bench)
+    return parser
+
+
+def main(argv:list=None)->None:
+    args=get_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,171 @@
+import os
+import threading
+import configparser
+from contextlib import contextmanager
+from typing import Iterator
+
+
+'''
+Connection management shared by all entry points. Postgres connections are taken
+from a single psycopg2 ThreadedConnectionPool and MongoDB is accessed through a single
+long-lived MongoClient, which keeps its own connection pool. Both are created lazily
+on first use, so importing this module does not import the database drivers.
+
+Settings are read from the defaults below, overridden by the config file and then by
+environment variables. The config file is an ini file with the sections [postgres],
+[mongodb], [cache], [data] and [instrumentation] whose path is taken from MUSICIANS_CONFIG, by default
+musicians.ini in the repository root. Environment variables are named MUSICIANS_<SECTION>_<KEY>,
+e.g. MUSICIANS_POSTGRES_PASSWORD or MUSICIANS_MONGODB_URI. The [cache] section configures
+the result cache of Cache.result_cache, the [data] section the directory of the csv
+files and the [instrumentation] section the runs of Benchmark.instrumentation.
+'''
+
+default_settings={
+    'postgres': {
+        'host': 'localhost',
+        'port': '5432',
+        'dbname': 'musicians',
+        'user': 'postgres',
+        'password': 'root',
+        'minconn': '1',
+        'maxconn': '10'
+    },
+    'mongodb': {
+        'uri': 'mongodb://localhost:27017/',
+        'database': 'musicians',
+        'collection': 'bands',
+        'max_pool_size': '50',
+        'min_pool_size': '0'
+    },
+    'cache': {
+        'maxsize': '1024',
+        'ttl': '300',
+        'backend': '',
+        'path': os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'musicians_cache.sqlite'),
+        'redis_url': 'redis://localhost:6379/0'
+    },
+    'data': {
+        'csv_dir': os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'csv_files')
+    },
+    'instrumentation': {
+        'output': '',
+        'path': '',
+        'tracemalloc': '0',
+        'profiler': '',
+        'profile_dir': os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    }
+}
+
+default_config_file=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'musicians.ini')
+
+lock=threading.RLock()
+settings=None
+postgres_pool=None
+mongo_client=None
+
+
+def load_settings(config_file:str=None)->dict:
+    '''
+    Loading of the settings from the defaults, the config file and environment variables
+    '''
+    config_file=config_file or os.environ.get('MUSICIANS_CONFIG',default_config_file)
+    parser=configparser.ConfigParser()
+    parser.read(config_file)
+    loaded={}
+    for section,defaults in default_settings.items():
+        loaded[section]=dict(defaults)
+        if parser.has_section(section):
+            loaded[section].update(parser.items(section))
+        for key in defaults:
+            env_name='MUSICIANS_{}_{}'.format(section,key).upper()
+            if env_name in os.environ:
+                loaded[section][key]=os.environ[env_name]
+    return loaded
+
+
+def get_settings()->dict:
+    '''
+    Settings loaded once per process
+    '''
+    global settings
+    with lock:
+        if settings is None:
+            settings=load_settings()
+        return settings
+
+
+def get_postgres_dsn()->dict:
+    '''
+    Keyword arguments for psycopg2.connect
+    '''
+    pg=get_settings()['postgres']
+    return {key:pg[key] for key in ('host','port','dbname','user','password')}
+
+
+def get_postgres_pool():
+    '''
+    Shared thread safe pool of Postgres connections
+    '''
+    global postgres_pool
+    import psycopg2.pool
+    with lock:
+        if postgres_pool is None or postgres_pool.closed:
+            pg=get_settings()['postgres']
+            postgres_pool=psycopg2.pool.ThreadedConnectionPool(
+                int(pg['minconn']),int(pg['maxconn']),**get_postgres_dsn())
+        return postgres_pool
+
+
+@contextmanager
+def postgres_connection()->Iterator:
+    '''
+    Context manager lending a connection of the pool. The transaction is committed
+    on success and rolled back on errors before the connection is returned to the pool
+    '''
+    pool=get_postgres_pool()
+    conn=pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def get_mongo_client():
+    '''
+    Shared long-lived MongoClient
+    '''
+    global mongo_client
+    import pymongo
+    with lock:
+        if mongo_client is None:
+            mongo=get_settings()['mongodb']
+            mongo_client=pymongo.MongoClient(mongo['uri'],
+                                             maxPoolSize=int(mongo['max_pool_size']),
+                                             minPoolSize=int(mongo['min_pool_size']))
+        return mongo_client
+
+
+def get_mongo_collection():
+    '''
+    Collection holding the band documents
+    '''
+    mongo=get_settings()['mongodb']
+    return get_mongo_client()[mongo['database']][mongo['collection']]
+
+
+def close_all()->None:
+    '''
+    Closing of the Postgres pool and the MongoClient
+    '''
+    global postgres_pool, mongo_client
+    with lock:
+        if postgres_pool is not None:
+            postgres_pool.closeall()
+            postgres_pool=None
+        if mongo_client is not None:
+            mongo_client.close()
+            mongo_client=None
@@ -0,0 +1,210 @@
+import pymongo
+from datetime import datetime
+from typing import Iterator, List
+from Connections.connection_manager import get_mongo_client, get_mongo_collection, get_settings
+
+
+'''
+Alternative layout with one document per album, for album heavy analytics:
+
+document={
+    'band_url': 'band_url',
+    'band_name': 'band_name',
+    'genres': ['genre', ...],
+    'album_name': 'name',
+    'release_date': 'date',
+    'description': 'desc',
+    'running_time': 'time',
+    'sales': 'sales_amount'
+}
+
+The band url, band name and genre names are denormalized into every album, so the
+queries filter the albums directly with an index and only unwind the genres of a
+single album, instead of unwinding albums x genres of all bands. Albums without
+release date or sales are stored as well. The yearly sales per genre are kept as
+bucket documents by the rollups of mongo_optimization.
+
+Once created, the album collection follows the writes to the bands collection: the
+loaders recreate it, and the album writes and syncs replace the album documents of
+the bands they change by update_album_documents.
+'''
+
+album_collection='albums'
+
+
+def get_album_collection(client:pymongo.MongoClient=None)->pymongo.collection.Collection:
+    '''
+    Collection holding the album documents, in the database of the bands collection
+    '''
+    client=client or get_mongo_client()
+    return client[get_settings()['mongodb']['database']][album_collection]
+
+
+def create_album_documents(data_list:List)->List[dict]:
+    '''
+    Conversion of a single list yielded by gen_data_list into one document per album
+    '''
+    band_url,band_name,list_genres,_,list_albums=data_list
+    genres=['{}'.format(genre) for genre in list_genres]
+    album_keys=['album_name','release_date','description','running_time','sales']
+    docs=[]
+    for album in list_albums:
+        doc={'band_url': '{}'.format(band_url), 'band_name': '{}'.format(band_name), 'genres': genres}
+        doc.update(zip(album_keys,album))
+        docs.append(doc)
+    return docs
+
+
+def gen_album_documents()->Iterator[dict]:
+    '''
+    Generator function yielding the album documents of all bands
+    '''
+    from MongoDB.mongo_data_insertion import gen_data_list
+    for data_list in gen_data_list():
+        yield from create_album_documents(data_list)
+
+
+def create_album_indexes(col:pymongo.collection.Collection)->None:
+    '''
+    Creation of the indexes of the album layout: the release date with the sales for
+    the genre query and the genre names with the release date for the band query
+    '''
+    col.create_indexes([
+        pymongo.IndexModel([('release_date', pymongo.ASCENDING), ('sales', pymongo.ASCENDING)],
+                           name='index_release_date_sales'),
+        pymongo.IndexModel([('genres', pymongo.ASCENDING), ('release_date', pymongo.ASCENDING)],
+                           name='index_genres_release_date'),
+        pymongo.IndexModel([('band_url', pymongo.ASCENDING)], name='index_band_url')])
+
+
+def insert_albums(batch_size:int=1000)->int:
+    '''
+    Loading of the album documents from the csv files with unordered bulk inserts of
+    batch_size documents. Returns the number of inserted documents
+    '''
+    from MongoDB.mongo_data_insertion import gen_batches, insert_batch
+    col=get_album_collection()
+    col.drop()
+    n_inserted=0
+    for batch in gen_batches(gen_album_documents(),batch_size):
+        n_inserted+=insert_batch(col,batch)
+        print('Inserted {} album documents'.format(n_inserted), end="\r")
+    print('Inserted {} album documents'.format(n_inserted))
+    create_album_indexes(col)
+    return n_inserted
+
+
+pipeline_album_documents = [
+    {'$unwind': {'path': '$albums'}},
+    {'$project': {
+        '_id': 0,
+        'band_url': 1,
+        'band_name': 1,
+        'genres': '$genres.genre_name',
+        'album_name': '$albums.album_name',
+        'release_date': '$albums.release_date',
+        'description': '$albums.description',
+        'running_time': '$albums.running_time',
+        'sales': '$albums.sales'}}]
+
+
+def create_albums_from_bands(col:pymongo.collection.Collection)->None:
+    '''
+    Server side creation of the album collection from the band documents with $out
+    '''
+    col.aggregate(pipeline_album_documents+[{'$out': album_collection}])
+    create_album_indexes(col.database[album_collection])
+
+
+def has_album_collection(col:pymongo.collection.Collection)->bool:
+    return bool(col.database.list_collection_names(filter={'name': album_collection}))
+
+
+def get_album_update_pipeline(query:dict)->list:
+    '''
+    Pipeline on the bands collection writing the album documents of the bands matching
+    query into the album collection with $merge
+    '''
+    return [{'$match': query}]+pipeline_album_documents+[{'$merge': {'into': album_collection}}]
+
+
+def update_album_documents(col:pymongo.collection.Collection, query:dict)->None:
+    '''
+    Replacement of the album documents of the bands matching query, e.g. {'band_url': url},
+    by the albums of their band documents, if the album collection was created. The
+    query is applied to both collections, since the album documents hold the band_url
+    and band_name of their band
+    '''
+    if not has_album_collection(col):
+        return
+    col.database[album_collection].delete_many(query)
+    col.aggregate(get_album_update_pipeline(query))
+
+
+def refresh_album_documents(col:pymongo.collection.Collection)->bool:
+    '''
+    Recreation of the album collection after the bands collection was loaded again,
+    if it was created before. Returns whether it was recreated
+    '''
+    if not has_album_collection(col):
+        return False
+    create_albums_from_bands(col)
+    print('Recreated collection {}.'.format(album_collection))
+    return True
+
+
+def get_genre_pipeline(start_date:datetime, end_date:datetime)->list:
+    '''
+    Aggregation pipeline of get_genre on the album collection
+    '''
+    return [
+        {'$match': {'release_date': {'$gte': start_date, '$lt': end_date}}},
+        {'$project': {'_id': 0, 'genres': 1, 'sales': 1}},
+        {'$unwind': {'path': '$genres'}},
+        {'$group': {'_id': '$genres', 'genre_sales': {'$sum': '$sales'}}},
+        {'$sort': {'genre_sales': -1}},
+        {'$limit': 1}]
+
+
+def get_genre(col:pymongo.collection.Collection, start_date:datetime, end_date:datetime)->str:
+    '''
+    Get the genre with the most sales in a timeframe from the album collection
+    '''
+    res=col.aggregate(get_genre_pipeline(start_date, end_date), allowDiskUse=True)
+    genre=list(res)[0]['_id']
+    return genre
+
+
+def get_band_pipeline(start_date:datetime, end_date:datetime, genre:str)->list:
+    '''
+    Aggregation pipeline of get_band on the album collection
+    '''
+    return [
+        {'$match': {'genres': genre, 'release_date': {'$gte': start_date, '$lt': end_date}}},
+        {'$group': {'_id': '$band_url', 'band_sales': {'$sum': '$sales'}}},
+        {'$sort': {'band_sales': -1}},
+        {'$limit': 1}]
+
+
+def get_band(col:pymongo.collection.Collection, start_date:datetime, end_date:datetime, genre:str)->str:
+    '''
+    Get the band with the most sales in a specific genre in a timeframe from the album collection
+    '''
+    res=col.aggregate(get_band_pipeline(start_date, end_date, genre), allowDiskUse=True)
+    band=list(res)[0]['_id']
+    return band
+
+
+if __name__=='__main__':
+    #creating the album collection from the band documents
+    create_albums_from_bands(get_mongo_collection())
+    col=get_album_collection()
+
+    start_90s=datetime(1989,12,31,0,0,0,0)
+    end_90s=datetime(2000,1,1,0,0,0,0)
+    start_10s=datetime(2009,12,31,0,0,0,0)
+    end_10s=datetime(2020,1,1,0,0,0,0)
+
+    genre=get_genre(col,start_90s, end_90s)
+    band_10s=get_band(col,start_10s, end_10s, genre)
+    print('Most successful band: {}'.format(band_10s))
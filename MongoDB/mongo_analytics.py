@@ -0,0 +1,195 @@
+import pymongo
+import numpy as np
+from datetime import date, datetime
+from typing import Iterable, List, Tuple
+from Connections.connection_manager import get_mongo_collection
+
+
+'''
+In-process engine answering the two flagship queries (most successful genre in a
+timeframe and most successful band of a genre in a timeframe) from compact arrays:
+
+albums:      band index (int32), release day (int32, days since 1970-01-01) and
+             sales (int64), sorted by release day, so that a timeframe is a slice
+genre_band:  CSR incidence matrix with one row per genre, holding the indices of
+             the bands of the genre and how often the genre is listed for the band
+
+Sales of a timeframe are summed per band with np.add.at and per genre with a sparse
+matrix-vector product of the incidence matrix and the band sales. All sums are exact
+int64 sums, as np.bincount would sum weights as float64.
+'''
+
+epoch=date(1970,1,1)
+
+
+def date_to_day(d, round_up:bool=False)->int:
+    '''
+    Conversion of a date or datetime into days since 1970-01-01. Albums are released
+    at midnight, so datetimes after midnight are rounded up to the next day if round_up
+    '''
+    if isinstance(d,datetime):
+        day=(d.date()-epoch).days
+        if round_up and d.time()!=datetime.min.time():
+            day+=1
+        return day
+    return (d-epoch).days
+
+
+class SalesEngine:
+    '''
+    Immutable in-memory representation of the album sales of all bands and their genres
+    '''
+    def __init__(self, band_urls:List[str], genre_names:List[str], band_genres:List[List[int]],
+                 album_bands:np.ndarray, album_days:np.ndarray, album_sales:np.ndarray):
+        self.band_urls=np.array(band_urls,dtype=object)
+        self.genre_names=np.array(genre_names,dtype=object)
+        self.dict_genre_idx={genre:idx for idx,genre in enumerate(genre_names)}
+        n_bands=len(band_urls)
+        n_genres=len(genre_names)
+
+        #albums sorted by release day
+        order=np.argsort(album_days,kind='stable')
+        self.album_bands=np.asarray(album_bands,dtype=np.int32)[order]
+        self.album_days=np.asarray(album_days,dtype=np.int32)[order]
+        self.album_sales=np.asarray(album_sales,dtype=np.int64)[order]
+
+        #CSR incidence matrix genre x band with the multiplicity of the genre as data
+        rows=np.array([genre for genres in band_genres for genre in genres],dtype=np.int64)
+        cols=np.array([band for band,genres in enumerate(band_genres) for _ in genres],dtype=np.int64)
+        keys,counts=np.unique(rows*n_bands+cols,return_counts=True)
+        self.genre_band_indices=(keys%max(n_bands,1)).astype(np.int32)
+        self.genre_band_data=counts.astype(np.int64)
+        self.genre_band_indptr=np.zeros(n_genres+1,dtype=np.int64)
+        np.cumsum(np.bincount(keys//max(n_bands,1),minlength=n_genres),out=self.genre_band_indptr[1:])
+        self.genre_band_rows=np.repeat(np.arange(n_genres,dtype=np.int32),np.diff(self.genre_band_indptr))
+
+    @classmethod
+    def from_band_data(cls, band_data:Iterable[Tuple[str,List[str],List[Tuple[date,int]]]])->'SalesEngine':
+        '''
+        Building of the engine from tuples (band_url, genre names, albums as (release date, sales)).
+        Albums without release date are left out, as they are in no timeframe. Albums without
+        sales are kept with zero sales, since the database queries consider bands and genres
+        with such albums in the timeframe as well
+        '''
+        band_urls=[]
+        dict_genre_idx={}
+        band_genres=[]
+        album_bands=[]
+        album_days=[]
+        album_sales=[]
+        for band_idx,(band_url,genres,albums) in enumerate(band_data):
+            band_urls.append(band_url)
+            band_genres.append([dict_genre_idx.setdefault(genre,len(dict_genre_idx)) for genre in genres])
+            for release_date,sales in albums:
+                if release_date is None:
+                    continue
+                album_bands.append(band_idx)
+                album_days.append(date_to_day(release_date))
+                album_sales.append(0 if sales is None or sales!=sales else int(sales))
+        return cls(band_urls,list(dict_genre_idx),band_genres,
+                   np.array(album_bands,dtype=np.int32),np.array(album_days,dtype=np.int32),
+                   np.array(album_sales,dtype=np.int64))
+
+    @classmethod
+    def from_collection(cls, col:pymongo.collection.Collection)->'SalesEngine':
+        '''
+        Building of the engine from the band documents of a MongoDB collection
+        '''
+        docs=col.find({},{'_id':0,'band_url':1,'genres.genre_name':1,'albums.release_date':1,'albums.sales':1})
+        return cls.from_band_data(
+            (doc['band_url'],
+             [genre['genre_name'] for genre in doc.get('genres',[])],
+             [(album.get('release_date'),album.get('sales')) for album in doc.get('albums',[])])
+            for doc in docs)
+
+    @classmethod
+    def from_postgres(cls, cur)->'SalesEngine':
+        '''
+        Building of the engine from the tables of the Postgres database with a psycopg2 cursor
+        '''
+        cur.execute('''SELECT b.band_url, g.genre_name FROM has_genre AS hg
+                       JOIN bands AS b ON b.band_id=hg.band_id
+                       JOIN genres AS g ON g.genre_id=hg.genre_id''')
+        dict_genres={}
+        for band_url,genre in cur.fetchall():
+            dict_genres.setdefault(band_url,[]).append(genre)
+        cur.execute('''SELECT b.band_url, a.release_date, a.sales FROM albums AS a
+                       JOIN bands AS b ON a.band_url=b.band_url''')
+        dict_albums={}
+        for band_url,release_date,sales in cur.fetchall():
+            dict_albums.setdefault(band_url,[]).append((release_date,sales))
+        cur.execute('SELECT band_url FROM bands')
+        return cls.from_band_data(
+            (band_url,dict_genres.get(band_url,[]),dict_albums.get(band_url,[]))
+            for band_url, in cur.fetchall())
+
+    def get_album_slice(self, start_date, end_date, inclusive_end:bool=False)->slice:
+        '''
+        Slice of the albums released in the timeframe [start_date, end_date), or
+        [start_date, end_date] with inclusive_end as in the Postgres queries
+        '''
+        start=date_to_day(start_date,round_up=True)
+        end=date_to_day(end_date,round_up=True)+(1 if inclusive_end else 0)
+        lo,hi=np.searchsorted(self.album_days,[start,end],side='left')
+        return slice(lo,hi)
+
+    def get_band_sales(self, start_date, end_date, inclusive_end:bool=False)->Tuple[np.ndarray,np.ndarray]:
+        '''
+        Summed sales and number of albums of every band in a timeframe
+        '''
+        albums=self.get_album_slice(start_date,end_date,inclusive_end)
+        n_bands=len(self.band_urls)
+        band_sales=np.zeros(n_bands,dtype=np.int64)
+        np.add.at(band_sales,self.album_bands[albums],self.album_sales[albums])
+        band_albums=np.bincount(self.album_bands[albums],minlength=n_bands)
+        return band_sales,band_albums
+
+    def get_genre_sales(self, start_date, end_date, inclusive_end:bool=False)->Tuple[np.ndarray,np.ndarray]:
+        '''
+        Summed sales and number of albums of every genre in a timeframe, computed as
+        product of the genre x band incidence matrix and the vectors of the band sums
+        '''
+        band_sales,band_albums=self.get_band_sales(start_date,end_date,inclusive_end)
+        genre_sales=np.zeros(len(self.genre_names),dtype=np.int64)
+        np.add.at(genre_sales,self.genre_band_rows,band_sales[self.genre_band_indices]*self.genre_band_data)
+        genre_albums=np.zeros(len(self.genre_names),dtype=np.int64)
+        np.add.at(genre_albums,self.genre_band_rows,band_albums[self.genre_band_indices]*self.genre_band_data)
+        return genre_sales,genre_albums
+
+    def get_genre(self, start_date, end_date, inclusive_end:bool=False)->str:
+        '''
+        Get the genre with the most sales in a timeframe. Only genres with albums in
+        the timeframe are considered, as in the database queries
+        '''
+        genre_sales,genre_albums=self.get_genre_sales(start_date,end_date,inclusive_end)
+        genres=np.flatnonzero(genre_albums>0)
+        if len(genres)==0:
+            return None
+        return self.genre_names[genres[np.argmax(genre_sales[genres])]]
+
+    def get_band(self, start_date, end_date, genre:str, inclusive_end:bool=False)->str:
+        '''
+        Get the band with the most sales in a genre in a timeframe. Only bands with
+        albums in the timeframe are considered, as in the database queries. Returns
+        None for an unknown genre, e.g. the None of get_genre for an empty timeframe
+        '''
+        genre_idx=self.dict_genre_idx.get(genre)
+        if genre_idx is None:
+            return None
+        band_sales,band_albums=self.get_band_sales(start_date,end_date,inclusive_end)
+        bands=self.genre_band_indices[self.genre_band_indptr[genre_idx]:self.genre_band_indptr[genre_idx+1]]
+        bands=bands[band_albums[bands]>0]
+        if len(bands)==0:
+            return None
+        return self.band_urls[bands[np.argmax(band_sales[bands])]]
+
+
+if __name__=='__main__':
+    engine=SalesEngine.from_collection(get_mongo_collection())
+    start_90s=datetime(1989,12,31,0,0,0,0)
+    end_90s=datetime(2000,1,1,0,0,0,0)
+    start_10s=datetime(2009,12,31,0,0,0,0)
+    end_10s=datetime(2020,1,1,0,0,0,0)
+    genre=engine.get_genre(start_90s,end_90s)
+    band_10s=engine.get_band(start_10s,end_10s,genre)
+    print('Most successful band: {}'.format(band_10s))
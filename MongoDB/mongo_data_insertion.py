@@ -1,11 +1,18 @@
-import sys
+import bson
 import pymongo
+from pymongo import ReplaceOne
 import datetime
-from typing import List
-import os
-os.chdir('..')
-from Postgres.postgres_data_insertion import load_music_data_to_df,try_parse,convert_df_to_list_of_tuples
-os.chdir('./MongoDB')
+from typing import List,Iterable,Iterator,Tuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+from Connections.connection_manager import get_mongo_collection, postgres_connection
+from Cache.result_cache import bump_data_version
+from Benchmark.instrumentation import instrumentation, instrumented, span, timed, count
+from Postgres.postgres_data_insertion import load_music_data_to_df,try_parse,convert_df_to_list_of_tuples,group_rows_by_band,convert_to_datetime,hash_content
+from Postgres.postgres_pipeline import split_frames_into_shards,run_pipeline
+from MongoDB.mongo_optimization import refresh_additional_fields, update_additional_fields, has_genre_rollup, \
+    pipeline_genre_year_sales
+from MongoDB.mongo_album_layout import update_album_documents, refresh_album_documents
 
 def create_json_documents()->List:
     '''
@@ -44,30 +51,50 @@ def create_json_documents()->List:
     
     list_docs=[]
     i=1
-    for data_list in gen_data_list():
-        band_url,band_name,list_genres,list_musicians,list_albums=data_list
-    
-        genres=[{'genre_name':'{}'.format(genre)} for genre in list_genres]
-        
-        musician_keys=['member_url','member_name', 'active']
-        musicians=[dict(zip(musician_keys,list(musician))) for musician in list_musicians]
-        
-        album_keys=['album_name','release_date','description','running_time','sales']
-        albums=[dict(zip(album_keys,list(album))) for album in list_albums]
-        
-        schema  = {'band_url': '{}'.format(band_url),
-             'band_name': '{}'.format(band_name),
-             'genres':genres,
-             'members':musicians,
-             'albums':albums
-             }
-        list_docs.append(schema)
+    for doc in timed('document_build',(create_json_document(data_list) for data_list in gen_data_list())):
+        list_docs.append(doc)
         print ('Inserted {} of 10000 documents in database'.format(i), end="\r")
         
         i=i+1
     return list_docs
 
 
+def create_json_document(data_list:List)->dict:
+    '''
+    Conversion of a single list yielded by gen_data_list into a json document
+    with the structure described in create_json_documents
+    '''
+    band_url,band_name,list_genres,list_musicians,list_albums=data_list
+
+    genres=[{'genre_name':'{}'.format(genre)} for genre in list_genres]
+    
+    musician_keys=['member_url','member_name', 'active']
+    musicians=[dict(zip(musician_keys,list(musician))) for musician in list_musicians]
+    
+    album_keys=['album_name','release_date','description','running_time','sales']
+    albums=[dict(zip(album_keys,list(album))) for album in list_albums]
+    
+    schema  = {'band_url': '{}'.format(band_url),
+         'band_name': '{}'.format(band_name),
+         'genres':genres,
+         'members':musicians,
+         'albums':albums
+         }
+    return schema
+
+
+def gen_batches(iterable:Iterable, batch_size:int)->Iterator[List]:
+    '''
+    Generator function splitting an iterable into lists of at most batch_size items
+    '''
+    iterator=iter(iterable)
+    while True:
+        batch=list(islice(iterator,batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 def gen_data_list()->List:
     '''
     Generator function extracting data from dataframes 
@@ -84,43 +111,297 @@ def gen_data_list()->List:
     '''
     #loading of csv data into dataframes
     df_album,df_band_name,df_musicians,df_genre=load_music_data_to_df()
+    yield from gen_data_list_from_df(df_album,df_band_name,df_musicians,df_genre)
+
+
+def gen_data_list_from_df(df_album,df_band_name,df_musicians,df_genre)->Iterator[List]:
+    '''
+    Generator function extracting the lists described in gen_data_list from dataframes
+    '''
+    #grouping of every dataframe by band URI once, instead of filtering
+    #the whole dataframes for each band. Musician and album data are type
+    #casted column-wise before grouping
+    dict_band_names=group_rows_by_band(df_band_name)
+    dict_genres=group_rows_by_band(df_genre)
+    dict_musicians=group_rows_by_band(df_musicians,[str,str,bool])
+    dict_albums=group_rows_by_band(df_album,[str,convert_to_datetime,str,float,int])
     
-    for idx,band_url in enumerate(df_band_name[0]): #.iloc[:20]
+    for band_url in df_band_name[0]:
         
-        band_name=df_band_name.loc[df_band_name[0] == band_url][1].reset_index(drop=True)[0]
+        band_name=dict_band_names[band_url][0][0]
             
-        list_genres=df_genre.loc[df_genre[0] == band_url][1].tolist()
+        list_genres=[row[0] for row in dict_genres.get(band_url,[])]
             
-        musicians=df_musicians.loc[df_musicians[0] == band_url].iloc[:,1:]
-        list_musicians=convert_df_to_list_of_tuples(musicians,[str,str,bool])
+        list_musicians=dict_musicians.get(band_url,[])
         
         #album data contains a lot of different types which are explicitely parsed
-        albums=df_album.loc[df_album[0] == band_url].iloc[:,1:]
-        list_parse_func=[str,convert_to_datetime,str,float,int]
-        list_albums=[tuple([(try_parse(list_parse_func[idx],val)) 
-                       for idx,val in enumerate(row)])
-                            for row in albums.to_numpy()]
+        list_albums=dict_albums.get(band_url,[])
  
         yield [band_url,band_name,list_genres,list_musicians,list_albums]
    
-def convert_to_datetime(d):
-    '''
-    Conversion of value into MongoDB compatible datetime format
-    '''
-    return datetime.datetime.strptime(str(d), '%d/%m/%Y')
-
+@instrumented('mongo_insert')
 def insert():
     '''
     Inserting of a list of json document into a MongoDB
     '''
-    with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-        col = client.musicians.bands
-        list_docs=create_json_documents()
-        col.drop() 
+    col = get_mongo_collection()
+    list_docs=create_json_documents()
+    col.drop() 
+    with span('network_write',collection=col.name):
         ids = col.insert_many(list_docs)
-        #print(ids.inserted_ids)
+    count_documents(col,list_docs)
+    refresh_additional_fields(col)
+    refresh_album_documents(col)
+    bump_data_version('mongodb')
+    #print(ids.inserted_ids)
 
-#insert()
 
+def count_documents(col:pymongo.collection.Collection, docs:List[dict])->None:
+    '''
+    Counting of written documents and, only during an instrumented run, of their
+    BSON size
+    '''
+    count('rows',len(docs),stage='network_write',collection=col.name)
+    if instrumentation.active:
+        count('bytes',sum(len(bson.encode(doc)) for doc in docs),stage='network_write',collection=col.name)
 
-    
+
+def insert_batch(col:pymongo.collection.Collection, batch:List[dict])->int:
+    '''
+    Unordered bulk insert of a batch of json documents, returning the number
+    of inserted documents
+    '''
+    with span('network_write',collection=col.name):
+        res=col.insert_many(batch, ordered=False)
+    count_documents(col,batch)
+    return len(res.inserted_ids)
+
+
+@instrumented('mongo_insert_streaming')
+def insert_streaming(batch_size:int=1000, n_writers:int=1, catalog=None)->int:
+    '''
+    Streaming insertion of json documents into a MongoDB. Documents are built
+    lazily from gen_data_list, or from a compact Catalog if given, and flushed as
+    unordered bulk inserts of batch_size documents by n_writers threads. At most
+    two batches per writer are pending at any time, so memory usage does not grow
+    with the size of the catalog. Returns the number of inserted documents
+    '''
+    col = get_mongo_collection()
+    col.drop()
+    data_lists=gen_data_list() if catalog is None else catalog.iter_data_lists()
+    docs=timed('document_build',(create_json_document(data_list) for data_list in data_lists))
+    n_inserted=0
+    n_batches=0
+    with ThreadPoolExecutor(max_workers=n_writers) as executor:
+        pending=set()
+        for batch in gen_batches(docs,batch_size):
+            if len(pending)>=2*n_writers:
+                done,pending=wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    n_inserted+=future.result()
+                    n_batches+=1
+                print('Inserted {} documents in {} batches'.format(n_inserted,n_batches), end="\r")
+            pending.add(executor.submit(insert_batch,col,batch))
+        for future in pending:
+            n_inserted+=future.result()
+            n_batches+=1
+    print('Inserted {} documents in {} batches'.format(n_inserted,n_batches))
+    refresh_additional_fields(col)
+    refresh_album_documents(col)
+    bump_data_version('mongodb')
+    return n_inserted
+
+def transform_shard_documents(frames:List)->List[dict]:
+    '''
+    Conversion of the dataframes of a shard into json documents
+    '''
+    return [create_json_document(data_list) for data_list in gen_data_list_from_df(*frames)]
+
+
+@instrumented('mongo_insert_parallel')
+def insert_parallel(n_workers:int=None, n_shards:int=64, batch_size:int=1000, n_writers:int=1, queue_size:int=4)->int:
+    '''
+    Insertion of json documents into a MongoDB with the documents built in n_workers
+    processes. The bands are split into n_shards shards by their band_url, every
+    shard is converted into documents in a worker process and inserted by one of
+    n_writers threads as unordered bulk inserts of batch_size documents. The documents
+    are the same for any number of workers. Returns the number of inserted documents
+    '''
+    col = get_mongo_collection()
+    col.drop()
+    shards=split_frames_into_shards(load_music_data_to_df(),n_shards)
+    n_inserted=[]
+
+    def load(docs):
+        for batch in gen_batches(docs,batch_size):
+            n_inserted.append(insert_batch(col,batch))
+        print('Inserted {} documents'.format(sum(n_inserted)), end="\r")
+
+    run_pipeline(shards,transform_shard_documents,load,n_workers=n_workers,n_loaders=n_writers,queue_size=queue_size)
+    print('Inserted {} documents'.format(sum(n_inserted)))
+    refresh_additional_fields(col)
+    refresh_album_documents(col)
+    bump_data_version('mongodb')
+    return sum(n_inserted)
+
+
+def sync_documents(col:pymongo.collection.Collection, docs:Iterable[dict], batch_size:int=1000)->Tuple[int,int]:
+    '''
+    Incremental synchronization of the collection with the documents. Every document
+    gets a content_hash field and only documents with a new or changed hash are
+    written with ReplaceOne(upsert=True) in unordered bulk writes of batch_size
+    documents, while documents of bands that are not part of docs are deleted.
+    If the sales fields and the yearly genre rollup of mongo_optimization were
+    created, the sales fields of the written documents are computed again after
+    every bulk write and the genre rollup is rebuilt after a change. The album
+    documents of the written and deleted bands are replaced as well.
+    Returns the number of upserted and deleted documents
+    '''
+    col.create_index([('band_url', pymongo.ASCENDING)], name='index_band_url')
+    has_sales_fields=has_genre_rollup(col)
+    stored_hashes={doc['band_url']:doc.get('content_hash') 
+                   for doc in col.find({},{'_id':0,'band_url':1,'content_hash':1})}
+    band_urls=set()
+    n_upserted=0
+    batch=[]
+
+    def write(batch):
+        requests=[ReplaceOne({'band_url':doc['band_url']},doc,upsert=True) for doc in batch]
+        with span('network_write',collection=col.name):
+            col.bulk_write(requests,ordered=False)
+        count('rows',len(requests),stage='network_write',collection=col.name)
+        written=[doc['band_url'] for doc in batch]
+        if has_sales_fields:
+            update_additional_fields(col,written)
+        update_album_documents(col,{'band_url':{'$in':written}})
+        return len(requests)
+
+    for doc in docs:
+        doc['content_hash']=hash_content(doc)
+        band_urls.add(doc['band_url'])
+        if stored_hashes.get(doc['band_url'])==doc['content_hash']:
+            continue
+        batch.append(doc)
+        if len(batch)>=batch_size:
+            n_upserted+=write(batch)
+            batch=[]
+    if batch:
+        n_upserted+=write(batch)
+    deleted=[band_url for band_url in stored_hashes if band_url not in band_urls]
+    for batch in gen_batches(deleted,batch_size):
+        with span('network_write',collection=col.name):
+            col.delete_many({'band_url':{'$in':batch}})
+        update_album_documents(col,{'band_url':{'$in':batch}})
+    print('Synchronized collection: {} documents upserted, {} documents deleted'.format(n_upserted,len(deleted)))
+    if n_upserted or deleted:
+        if has_sales_fields:
+            col.aggregate(pipeline_genre_year_sales)
+        bump_data_version('mongodb')
+    return n_upserted,len(deleted)
+
+
+@instrumented('mongo_sync')
+def sync(batch_size:int=1000, catalog=None)->Tuple[int,int]:
+    '''
+    Incremental synchronization of the collection with the csv files by sync_documents.
+    The collection and its indexes are kept. The documents are built from a compact
+    Catalog if given. Returns the number of upserted and deleted documents
+    '''
+    col = get_mongo_collection()
+    data_lists=gen_data_list() if catalog is None else catalog.iter_data_lists()
+    docs=timed('document_build',(create_json_document(data_list) for data_list in data_lists))
+    return sync_documents(col,docs,batch_size)
+
+
+#documents of all bands built by Postgres, in the structure of create_json_documents.
+#The tables do not keep everything the csv files hold, so the documents differ from
+#those of create_json_document:
+#- genres are ordered by genre_id, i.e. by the first occurrence of the genre in the whole
+#  csv file for tables loaded by insert_copy, not by the order of the rows of the band
+#- members are ordered by active (active members first) and then by musician_id
+#- a musician with several names in has_name is listed with the alphabetically smallest
+#  name (MIN), not with the name of the csv row of the band
+#- duplicate genre and member rows of a band are listed once
+#Bands and albums are ordered by their ids. As the content_hash differs for such bands,
+#switching a collection between sync and sync_from_postgres rewrites their documents
+query_export_documents='''
+WITH band_genres AS (
+    SELECT hg.band_id, json_agg(json_build_object('genre_name', g.genre_name) ORDER BY g.genre_id) AS genres
+    FROM has_genre AS hg
+    JOIN genres AS g ON g.genre_id=hg.genre_id
+    GROUP BY hg.band_id
+), musician_names AS (
+    SELECT musician_id, MIN(musician_name) AS musician_name
+    FROM has_name
+    GROUP BY musician_id
+), band_members AS (
+    SELECT mo.band_id, json_agg(json_build_object('member_url', m.musician_url, 'member_name', n.musician_name,
+                                                  'active', mo.active) ORDER BY mo.active DESC, mo.musician_id) AS members
+    FROM member_of AS mo
+    JOIN musicians AS m ON m.musician_id=mo.musician_id
+    LEFT JOIN musician_names AS n ON n.musician_id=mo.musician_id
+    GROUP BY mo.band_id
+), band_albums AS (
+    SELECT a.band_url, json_agg(json_build_object('album_name', a.album_name, 'release_date', a.release_date,
+                                                  'description', a.description, 'running_time', a.running_time,
+                                                  'sales', a.sales) ORDER BY a.album_id) AS albums
+    FROM albums AS a
+    GROUP BY a.band_url
+)
+SELECT json_build_object('band_url', b.band_url, 'band_name', b.band_name,
+                         'genres', COALESCE(bg.genres, '[]'::json),
+                         'members', COALESCE(bm.members, '[]'::json),
+                         'albums', COALESCE(ba.albums, '[]'::json))
+FROM bands AS b
+LEFT JOIN band_genres AS bg ON bg.band_id=b.band_id
+LEFT JOIN band_members AS bm ON bm.band_id=b.band_id
+LEFT JOIN band_albums AS ba ON ba.band_url=b.band_url
+ORDER BY b.band_id;
+'''
+
+
+def convert_exported_document(doc:dict)->dict:
+    '''
+    Conversion of the values of a document built by Postgres that json does not
+    represent like create_json_document: release dates into datetimes and running
+    times into floats
+    '''
+    for album in doc['albums']:
+        if album['release_date'] is not None:
+            album['release_date']=datetime.datetime.strptime(album['release_date'],'%Y-%m-%d')
+        if album['running_time'] is not None:
+            album['running_time']=float(album['running_time'])
+    return doc
+
+
+def gen_postgres_documents(conn, itersize:int=2000)->Iterator[dict]:
+    '''
+    Generator function yielding the documents built by query_export_documents. The
+    documents are streamed through a named server side cursor, which fetches
+    itersize documents per round-trip, so only one batch is held in memory
+    '''
+    with conn.cursor(name='mongo_export_documents') as cur:
+        cur.itersize=itersize
+        cur.execute(query_export_documents)
+        for (doc,) in cur:
+            yield convert_exported_document(doc)
+
+
+@instrumented('mongo_sync_from_postgres')
+def sync_from_postgres(batch_size:int=1000, itersize:int=2000)->Tuple[int,int]:
+    '''
+    Incremental synchronization of the collection with the Postgres tables by
+    sync_documents, without reading the csv files. The documents differ from those
+    of the csv files in the order of genres and members and in the member names,
+    as described at query_export_documents. Returns the number of upserted and
+    deleted documents
+    '''
+    col = get_mongo_collection()
+    with postgres_connection() as conn:
+        docs=timed('document_build',gen_postgres_documents(conn,itersize))
+        return sync_documents(col,docs,batch_size)
+
+
+if __name__=='__main__':
+    #loading the documents of the csv files into the collection
+    insert()
@@ -0,0 +1,137 @@
+import pymongo
+from pymongo import IndexModel
+from datetime import datetime
+from typing import Dict, List
+from Connections.connection_manager import get_mongo_collection
+
+
+'''
+Index advisor and manager for the bands collection.
+
+MongoDB can only use an index for the first $match of a pipeline, before any $unwind.
+hoist_match rewrites a pipeline starting with $unwind stages by putting a $match in
+front that selects the documents with at least one matching array element ($elemMatch),
+while the original $match still filters the unwound elements.
+
+The index plan holds multikey indexes on the fields the queries filter on. A compound
+index may only hold fields of one array per document, as MongoDB cannot index parallel
+arrays, so genres.genre_name and albums.release_date are indexed separately: the
+release date together with the sales of the same albums array and the genre name
+together with the band_url.
+'''
+
+index_plan=[
+    IndexModel([('albums.release_date', pymongo.ASCENDING), ('albums.sales', pymongo.ASCENDING)],
+               name='index_release_date_sales'),
+    IndexModel([('genres.genre_name', pymongo.ASCENDING), ('band_url', pymongo.ASCENDING)],
+               name='index_genre_name_band_url'),
+    IndexModel([('band_url', pymongo.ASCENDING)], name='index_band_url')]
+
+#indexes of earlier versions that can never be used by the rewritten pipelines
+obsolete_indexes=['index_release_date', 'index_genres']
+
+
+def ensure_indexes(col:pymongo.collection.Collection, drop_unplanned:bool=False)->List[str]:
+    '''
+    Creation of the missing indexes of the index plan and dropping of obsolete indexes,
+    or of all indexes not in the plan with drop_unplanned. Returns the created indexes
+    '''
+    existing=col.index_information()
+    planned={index.document['name'] for index in index_plan}
+    for name in existing:
+        if name!='_id_' and name not in planned and (drop_unplanned or name in obsolete_indexes):
+            col.drop_index(name)
+    missing=[index for index in index_plan if index.document['name'] not in existing]
+    if not missing:
+        return []
+    return col.create_indexes(missing)
+
+
+def get_unwound_paths(pipeline:list)->List[str]:
+    '''
+    Paths of the arrays unwound by the leading $unwind stages of a pipeline
+    '''
+    paths=[]
+    for stage in pipeline:
+        if '$unwind' not in stage:
+            break
+        unwind=stage['$unwind']
+        path=unwind['path'] if isinstance(unwind,dict) else unwind
+        paths.append(path.lstrip('$'))
+    return paths
+
+
+def hoist_match(pipeline:list)->list:
+    '''
+    Rewriting of a pipeline starting with $unwind stages followed by a $match, so that
+    the documents are matched before unwinding. Conditions on fields of an unwound
+    array are grouped into one $elemMatch per array, all other top level conditions are
+    copied. Pipelines that do not start with $unwind are returned unchanged
+    '''
+    paths=get_unwound_paths(pipeline)
+    if not paths or len(pipeline)==len(paths) or '$match' not in pipeline[len(paths)]:
+        return pipeline
+    pre_match={}
+    for field,cond in pipeline[len(paths)]['$match'].items():
+        if field.startswith('$'):
+            continue
+        path=next((path for path in paths if field.startswith(path+'.')), None)
+        if path is None:
+            pre_match[field]=cond
+        else:
+            pre_match.setdefault(path,{'$elemMatch': {}})['$elemMatch'][field[len(path)+1:]]=cond
+    if not pre_match:
+        return pipeline
+    return [{'$match': pre_match}]+pipeline
+
+
+def explain_pipeline(col:pymongo.collection.Collection, pipeline:list)->dict:
+    '''
+    Query plan of an aggregation pipeline
+    '''
+    return col.database.command('explain', {'aggregate': col.name, 'pipeline': pipeline, 'cursor': {}},
+                                verbosity='queryPlanner')
+
+
+def get_winning_stages(explain:dict)->List[str]:
+    '''
+    Names of all stages of the winning plans in an explain result, which are nested
+    differently depending on the server version and on how much of the pipeline
+    is pushed down into the query layer
+    '''
+    stages=[]
+    def walk(node, in_plan):
+        if isinstance(node,dict):
+            for key,value in node.items():
+                if key=='stage' and in_plan and isinstance(value,str):
+                    stages.append(value)
+                else:
+                    walk(value, in_plan or key=='winningPlan')
+        elif isinstance(node,list):
+            for value in node:
+                walk(value, in_plan)
+    walk(explain, False)
+    return stages
+
+
+def check_pipelines(col:pymongo.collection.Collection, pipelines:Dict[str,list])->Dict[str,dict]:
+    '''
+    Check of the winning plan of every pipeline, which uses an index if it holds an
+    IXSCAN and no COLLSCAN stage
+    '''
+    report={}
+    for name,pipeline in pipelines.items():
+        stages=get_winning_stages(explain_pipeline(col, pipeline))
+        uses_index=any('IXSCAN' in stage for stage in stages) and 'COLLSCAN' not in stages
+        report[name]={'stages': stages, 'uses_index': uses_index}
+        print('{}: {} ({})'.format(name, 'IXSCAN' if uses_index else 'COLLSCAN', ', '.join(stages)))
+    return report
+
+
+if __name__=='__main__':
+    from MongoDB.mongo_queries import get_genre_pipeline, get_band_pipeline
+    col = get_mongo_collection()
+    print('Created indexes: {}'.format(ensure_indexes(col)))
+    check_pipelines(col, {
+        'genre': get_genre_pipeline(datetime(1989,12,31), datetime(2000,1,1)),
+        'band': get_band_pipeline(datetime(2009,12,31), datetime(2020,1,1), 'Alternative rock')})
@@ -1,6 +1,12 @@
 import pymongo
+from pymongo import UpdateOne
 from datetime import datetime
 from datetime import timezone
+from collections import Counter
+from typing import List,Optional,Tuple
+from Connections.connection_manager import get_mongo_collection
+from Benchmark.instrumentation import instrumented, span
+from MongoDB.mongo_index_advisor import ensure_indexes
 
 pipeline_90s_sales = [
     {'$unwind': {'path': '$albums'}}, 
@@ -17,65 +23,290 @@ pipeline_10s_sales = [
     {'$group': {'_id': '$_id','band_sales': {'$sum': '$albums.sales'}}}]
 
   
+sales_field_prefix='band_sales_'
+
+def get_decade_field(date:datetime)->str:
+    '''
+    Name of the field holding the summed sales of a band in the decade of date, e.g.
+    band_sales_1990s. The field band_sales_90s of add_field is only used by the baseline
+    measurements
+    '''
+    return '{}{}s'.format(sales_field_prefix,date.year//10*10)
+
+def get_merge_stage(col:pymongo.collection.Collection)->dict:
+    '''
+    $merge stage writing the fields of the pipeline output into the matching documents
+    of the collection, after removing all previous sales fields of these documents
+    '''
+    return {'$merge': {
+        'into': col.name,
+        'on': '_id',
+        'whenMatched': [{'$replaceWith': {'$mergeObjects': [
+            {'$arrayToObject': {'$filter': {
+                'input': {'$objectToArray': '$$ROOT'},
+                'cond': {'$ne': [{'$substrCP': ['$$this.k', 0, len(sales_field_prefix)]}, sales_field_prefix]}}}},
+            '$$new']}}],
+        'whenNotMatched': 'discard'}}
+
+pipeline_decade_sales = [
+    {'$project': {'albums.release_date': 1, 'albums.sales': 1}},
+    {'$unwind': {'path': '$albums'}},
+    {'$match': {'albums.release_date': {'$type': 'date'}}},
+    {'$group': {
+        '_id': {'band': '$_id',
+                'decade': {'$subtract': [{'$year': '$albums.release_date'},
+                                         {'$mod': [{'$year': '$albums.release_date'}, 10]}]}},
+        'band_sales': {'$sum': '$albums.sales'}}},
+    {'$group': {
+        '_id': '$_id.band',
+        'fields': {'$push': {
+            'k': {'$concat': [sales_field_prefix, {'$toString': '$_id.decade'}, 's']},
+            'v': '$band_sales'}}}},
+    {'$replaceRoot': {'newRoot': {'$mergeObjects': [{'_id': '$_id'}, {'$arrayToObject': '$fields'}]}}}]
+  
+@instrumented('mongo_add_field')
 def add_field(col:pymongo.collection.Collection,pipeline:list,new_field:str):
     '''
-    add additional field with sales of a band in a time area for optimizing predefined queries
+    add additional field with sales of a band in a time area for optimizing predefined queries.
+    The field is written on the server with a $merge stage instead of one update per band
+    '''
+    with span('network_write',collection=col.name,field=new_field):
+        col.aggregate(pipeline+[
+            {'$project': {new_field: '$band_sales'}},
+            {'$merge': {'into': col.name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}])
+
+def add_decade_fields(col:pymongo.collection.Collection)->None:
+    '''
+    add fields with the summed sales of a band for every decade, e.g. band_sales_1990s,
+    in a single server side pass over the collection. Previous sales fields are replaced
+    and bands without dated albums lose their sales fields
+    '''
+    col.aggregate(pipeline_decade_sales+[get_merge_stage(col)])
+    col.update_many({'albums.release_date': {'$not': {'$type': 'date'}}},
+                    [{'$replaceWith': {'$arrayToObject': {'$filter': {
+                        'input': {'$objectToArray': '$$ROOT'},
+                        'cond': {'$ne': [{'$substrCP': ['$$this.k', 0, len(sales_field_prefix)]}, sales_field_prefix]}}}}}])
+
+'''
+Rollups of the sales per year. Every band document holds the field sales_by_year,
+e.g. {'1995': 1200000, '1997': 300000}, and the collection genre_sales_by_year holds
+one document {'genre': 'genre', 'year': 1995, 'sales': 1200000} per genre and year.
+Queries over a date range sum the buckets of all years fully inside the range and
+only look at the albums of the partially covered years at the range limits
+'''
+
+year_field='sales_by_year'
+genre_rollup_collection='genre_sales_by_year'
+
+pipeline_year_sales = [
+    {'$project': {'albums.release_date': 1, 'albums.sales': 1}},
+    {'$unwind': {'path': '$albums'}},
+    {'$match': {'albums.release_date': {'$type': 'date'}}},
+    {'$group': {
+        '_id': {'band': '$_id', 'year': {'$year': '$albums.release_date'}},
+        'sales': {'$sum': '$albums.sales'}}},
+    {'$group': {
+        '_id': '$_id.band',
+        'years': {'$push': {'k': {'$toString': '$_id.year'}, 'v': '$sales'}}}},
+    {'$project': {year_field: {'$arrayToObject': '$years'}}}]
+
+pipeline_genre_year_sales = [
+    {'$project': {'albums.release_date': 1, 'albums.sales': 1, 'genres.genre_name': 1}},
+    {'$unwind': {'path': '$albums'}},
+    {'$match': {'albums.release_date': {'$type': 'date'}}},
+    {'$unwind': {'path': '$genres'}},
+    {'$group': {
+        '_id': {'genre': '$genres.genre_name', 'year': {'$year': '$albums.release_date'}},
+        'sales': {'$sum': '$albums.sales'}}},
+    {'$project': {'_id': 0, 'genre': '$_id.genre', 'year': '$_id.year', 'sales': 1}},
+    {'$out': genre_rollup_collection}]
+
+def get_sales_sums(albums, get_key)->dict:
+    '''
+    Expression of the list of {k, v} pairs of the summed sales of albums per distinct
+    value of the key expression get_key('$$album')
+    '''
+    return {'$map': {
+        'input': {'$setUnion': [{'$map': {'input': albums, 'as': 'album', 'in': get_key('$$album')}}]},
+        'as': 'key',
+        'in': {'k': '$$key', 'v': {'$sum': {'$map': {
+            'input': {'$filter': {'input': albums, 'as': 'album', 'cond': {'$eq': [get_key('$$album'), '$$key']}}},
+            'as': 'album',
+            'in': '$$album.sales'}}}}}}
+
+def get_decade_key(album:str)->dict:
+    year={'$year': album+'.release_date'}
+    return {'$concat': [sales_field_prefix, {'$toString': {'$subtract': [year, {'$mod': [year, 10]}]}}, 's']}
+
+def get_year_key(album:str)->dict:
+    return {'$toString': {'$year': album+'.release_date'}}
+
+#update pipeline stage recomputing the sales fields per decade and year of a band from its
+#albums, with the values of add_decade_fields and create_rollups
+pipeline_sales_fields = [
+    {'$replaceWith': {'$let': {
+        'vars': {'dated': {'$filter': {'input': {'$ifNull': ['$albums', []]}, 'as': 'album',
+                                       'cond': {'$eq': [{'$type': '$$album.release_date'}, 'date']}}}},
+        'in': {'$mergeObjects': [
+            {'$arrayToObject': {'$filter': {
+                'input': {'$objectToArray': '$$ROOT'},
+                'cond': {'$and': [{'$ne': [{'$substrCP': ['$$this.k', 0, len(sales_field_prefix)]}, sales_field_prefix]},
+                                  {'$ne': ['$$this.k', year_field]}]}}}},
+            {'$arrayToObject': get_sales_sums('$$dated', get_decade_key)},
+            {year_field: {'$cond': [{'$eq': ['$$dated', []]}, '$$REMOVE',
+                                    {'$arrayToObject': get_sales_sums('$$dated', get_year_key)}]}}]}}}}]
+
+def get_year_field(date:datetime)->str:
+    '''
+    Name of the field holding the summed sales of a band in the year of date, e.g. sales_by_year.1995
+    '''
+    return '{}.{}'.format(year_field,date.year)
+
+def create_rollups(col:pymongo.collection.Collection)->None:
+    '''
+    Creation of the yearly sales rollups for bands and genres with server side pipelines
     '''
-    cur = col.aggregate(pipeline)
-    len_cur=len(list(cur))
-    cur = col.aggregate(pipeline)
-    i=1
-    for doc in cur:
-        col.update_one({"_id": doc['_id']}, {'$set': {new_field: doc['band_sales']}})
-        print ('Inserted {} of {} fields in database'.format(i,len_cur), end="\r")
-        i+=1
+    col.aggregate(pipeline_year_sales+[
+        {'$merge': {'into': col.name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}])
+    col.update_many({'albums.release_date': {'$not': {'$type': 'date'}}}, {'$unset': {year_field: ''}})
+    col.aggregate(pipeline_genre_year_sales)
+    col.database[genre_rollup_collection].create_index(
+        [('year', pymongo.ASCENDING), ('genre', pymongo.ASCENDING)], name='index_year_genre', unique=True)
+
+def has_genre_rollup(col:pymongo.collection.Collection)->bool:
+    '''
+    Whether the yearly sales rollups were created by create_rollups. Writes only
+    update the precomputed sales and the genre rollup if they exist, so that a partial
+    rollup is never created
+    '''
+    return bool(col.database.list_collection_names(filter={'name': genre_rollup_collection}))
+
+def get_genre_rollup_requests(genres:List[dict], date:datetime, sales:int)->List[UpdateOne]:
+    '''
+    Updates of the yearly sales rollup of the genres of a band for the sales of a new album
+    '''
+    counts=Counter(genre['genre_name'] for genre in genres)
+    return [UpdateOne({'genre': genre, 'year': date.year}, {'$inc': {'sales': sales*count}}, upsert=True)
+            for genre,count in counts.items()]
+
+def update_genre_rollup(col:pymongo.collection.Collection, genres:List[dict], date:datetime, sales:int)->None:
+    '''
+    Increase of the yearly sales rollup of the genres of a band by the sales of a new album
+    '''
+    requests=get_genre_rollup_requests(genres, date, sales)
+    if requests:
+        col.database[genre_rollup_collection].bulk_write(requests, ordered=False)
+
+def split_date_range(start_date:datetime, end_date:datetime)->Tuple[int,int,List[Tuple[datetime,datetime]]]:
+    '''
+    Splitting of the range [start_date, end_date) into the years first_year to last_year
+    that are fully covered by the range and the remaining partial ranges at its limits
+    '''
+    def year_start(year):
+        return start_date.replace(year=year, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    first_year=start_date.year if start_date==year_start(start_date.year) else start_date.year+1
+    last_year=end_date.year-1
+    if first_year>last_year:
+        return first_year, last_year, [(start_date, end_date)]
+    partial_ranges=[]
+    if start_date<year_start(first_year):
+        partial_ranges.append((start_date, year_start(first_year)))
+    if year_start(last_year+1)<end_date:
+        partial_ranges.append((year_start(last_year+1), end_date))
+    return first_year, last_year, partial_ranges
 
 def get_genre_optimized(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime)->str:
     '''
-    optimized query for returning the most successful genre in the 90s
+    optimized query for returning the most successful genre in a timeframe using the yearly sales rollups
     '''
-    res=col.aggregate([
-        {'$unwind': {'path': '$genres'}}, 
-        {'$group': {'_id': {'genre': '$genres.genre_name'},'genre_sales': {'$sum': '$band_sales_90s'}}},
-        {'$sort': {'genre_sales': -1}},
-        {'$project' : {'genres.genre_name':1} },#'genre':1,'genre_sales':1,
-        {'$limit': 1}])
-    genre=list(res)[0]['_id']['genre']
+    first_year,last_year,partial_ranges=split_date_range(start_date, end_date)
+    genre_sales=Counter()
+    res=col.database[genre_rollup_collection].aggregate([
+        {'$match': {'year': {'$gte': first_year, '$lte': last_year}}},
+        {'$group': {'_id': '$genre', 'genre_sales': {'$sum': '$sales'}}}])
+    for doc in res:
+        genre_sales[doc['_id']]+=doc['genre_sales']
+    for start,end in partial_ranges:
+        res=col.aggregate([
+            {'$match': {'albums': {'$elemMatch': {'release_date': {'$gte': start, '$lt': end}}}}},
+            {'$unwind': {'path': '$albums'}},
+            {'$match': {'albums.release_date': {'$gte': start, '$lt': end}}},
+            {'$unwind': {'path': '$genres'}},
+            {'$group': {'_id': '$genres.genre_name', 'genre_sales': {'$sum': '$albums.sales'}}}])
+        for doc in res:
+            genre_sales[doc['_id']]+=doc['genre_sales']
+    genre=genre_sales.most_common(1)[0][0]
     return genre
 
-    
-def get_band_optimized(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime, genre:str)->str:
+
+def get_band_optimized(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime, genre:str)->Optional[str]:
     '''
-    optimized query for finding the most successful band in the 2010s in the mos successful genre in the 90s
+    optimized query for finding the most successful band in a timeframe in a genre using the yearly sales rollups.
+    Like the baseline only bands with an album in the timeframe are considered, None is returned if there is none
     '''
+    first_year,last_year,partial_ranges=split_date_range(start_date, end_date)
+    list_sales=[{'$sum': {'$map': {
+        'input': {'$filter': {
+            'input': {'$objectToArray': {'$ifNull': ['$'+year_field, {}]}},
+            'cond': {'$and': [{'$gte': [{'$toInt': '$$this.k'}, first_year]},
+                              {'$lte': [{'$toInt': '$$this.k'}, last_year]}]}}},
+        'in': '$$this.v'}}}]
+    for start,end in partial_ranges:
+        list_sales.append({'$sum': {'$map': {
+            'input': {'$filter': {
+                'input': {'$ifNull': ['$albums', []]},
+                'cond': {'$and': [{'$gte': ['$$this.release_date', start]},
+                                  {'$lt': ['$$this.release_date', end]}]}}},
+            'in': '$$this.sales'}}})
     res=col.aggregate([
-        {'$unwind': {'path': '$albums'}},
-        {'$match': {'genres.genre_name':genre}}, 
-        {'$group': {'_id': {'band': '$band_name'},'band_sales': {'$sum': '$band_sales_10s'}}},
+        {'$match': {'genres.genre_name': genre,
+                    'albums': {'$elemMatch': {'release_date': {'$gte': start_date, '$lt': end_date}}}}},
+        {'$project': {'band_url': 1, 'band_sales': {'$add': list_sales}}},
         {'$sort': {'band_sales': -1}},
-        {'$project' : {'bands.band_name':1} },
-        {'$limit': 1}]) 
-    band=list(res)[0]['_id']['band']
-    return band 
+        {'$limit': 1}])
+    res=list(res)
+    if not res:
+        return None
+    return res[0]['band_url']
 
 def create_indexes(col:pymongo.collection.Collection)->None:
     '''
-    Creation of indexes on the fields albums.release_date and genres
+    Creation of the indexes of the index plan on albums.release_date and sales,
+    genres.genre_name and band_url, replacing the former indexes on albums.release_date
+    and on the whole genres subdocuments
     '''
-    col.create_index([('albums.release_date', pymongo.ASCENDING)], name='index_release_date')
-    col.create_index([('genres', pymongo.ASCENDING)], name='index_genres')
+    ensure_indexes(col)
 
 
 def create_additional_fields(col:pymongo.collection.Collection)->None:
     '''
-    Add fields that hold already summed sales in 1990s and 2010s for respective documents
+    Add fields that hold already summed sales per decade, including the 1990s and 2010s, and per year for respective documents
+    '''
+    add_decade_fields(col)
+    create_rollups(col)
+
+def update_additional_fields(col:pymongo.collection.Collection, band_urls:List[str])->None:
+    '''
+    Recomputation of the sales fields per decade and year of the bands with band_urls
+    from their albums, e.g. after their documents were replaced. The fields are
+    replaced as a whole, so years and decades without albums are removed. The yearly
+    genre rollup is not changed
+    '''
+    col.update_many({'band_url': {'$in': band_urls}}, pipeline_sales_fields)
+
+def refresh_additional_fields(col:pymongo.collection.Collection)->bool:
+    '''
+    Recreation of the sales fields and the yearly genre rollup after the collection was
+    loaded again, if they were created before. Returns whether they were recreated
     '''
-    add_field(col,pipeline_90s_sales, 'band_sales_90s')
-    add_field(col,pipeline_10s_sales, 'band_sales_10s')
+    if not has_genre_rollup(col):
+        return False
+    create_additional_fields(col)
+    print('Recreated sales fields and collection {}.'.format(genre_rollup_collection))
+    return True
     
 if __name__=='__main__':
     #adding the new fields to the collection
-    with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-        col = client.musicians.bands
-        create_indexes(col)
-        create_additional_fields(col)
\ No newline at end of file
+    col = get_mongo_collection()
+    create_indexes(col)
+    create_additional_fields(col)
\ No newline at end of file
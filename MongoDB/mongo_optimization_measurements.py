@@ -1,70 +1,118 @@
 import pymongo
 import datetime
-import time
-from mongo_queries import get_genre, get_band
-from mongo_optimization import get_genre_optimized, get_band_optimized, create_additional_fields, create_indexes
+from MongoDB.mongo_queries import get_genre, get_band, get_genre_pipeline, get_band_pipeline
+from MongoDB.mongo_optimization import get_genre_optimized, get_band_optimized, create_additional_fields, create_indexes
+from MongoDB import mongo_album_layout
+from Connections.connection_manager import get_mongo_collection, get_settings
+from Benchmark.benchmark_suite import benchmark_query, format_result, write_results, summarize, measure
 
+start_90s=datetime.datetime(1989,12,31,0,0,0,0)
+end_90s=datetime.datetime(2000,1,1,0,0,0,0)
+start_10s=datetime.datetime(2009,12,31,0,0,0,0)
+end_10s=datetime.datetime(2020,1,1,0,0,0,0)
 
-def measure_query_runtime(query, n_runs:int)->float:
+
+def connect()->pymongo.MongoClient:
+    '''
+    Opening of a new client for measuring the connection setup, the client
+    is only connected after the first command
+    '''
+    client=pymongo.MongoClient(get_settings()['mongodb']['uri'])
+    client.admin.command('ping')
+    return client
+
+
+def get_collection(client:pymongo.MongoClient)->pymongo.collection.Collection:
+    '''
+    Collection holding the band documents for a client
+    '''
+    mongo=get_settings()['mongodb']
+    return client[mongo['database']][mongo['collection']]
+
+
+def measure_query_runtime(query, n_runs:int, n_warmup:int=3)->float:
     '''
-    measuring runtime of query by running it n_runs. for
-    every run the connection to the database is renewed
+    measuring the mean runtime of query in seconds by running it n_runs
+    times after n_warmup runs on the shared client
     '''
-    list_runtimes=[]
-    for i in range(n_runs):
-        with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-            col = client.musicians.bands
-            start=time.time()
-            query(col)
-            stop=time.time()
-        runtime=stop-start
-        list_runtimes.append(runtime)
-    return sum(list_runtimes)/len(list_runtimes)
+    col = get_mongo_collection()
+    samples=measure(lambda: query(col),n_runs,n_warmup)
+    return summarize(samples)['mean_ms']/1000
 
 def query_bands(col:pymongo.collection.Collection):
-    start_90s=datetime.datetime(1989,12,31,0,0,0,0)
-    end_90s=datetime.datetime(2000,1,1,0,0,0,0)
-    start_10s=datetime.datetime(2009,12,31,0,0,0,0)
-    end_10s=datetime.datetime(2020,1,1,0,0,0,0)
     genre=get_genre(col,start_90s, end_90s)
     band_10s=get_band(col,start_10s, end_10s, genre)
- 
+    return band_10s
+
 
 def query_bands_optimized(col:pymongo.collection.Collection):
-    start_90s=datetime.datetime(1989,12,31,0,0,0,0)
-    end_90s=datetime.datetime(2000,1,1,0,0,0,0)
-    start_10s=datetime.datetime(2009,12,31,0,0,0,0)
-    end_10s=datetime.datetime(2020,1,1,0,0,0,0)
     genre=get_genre_optimized(col,start_90s, end_90s)
     band_10s=get_band_optimized(col,start_10s, end_10s, genre)
+    return band_10s
 
 
-if __name__ == '__main__':
-    
-    n_runs=10
-    
+def query_bands_album_layout(col:pymongo.collection.Collection):
+    albums=col.database[mongo_album_layout.album_collection]
+    genre=mongo_album_layout.get_genre(albums,start_90s, end_90s)
+    band_10s=mongo_album_layout.get_band(albums,start_10s, end_10s, genre)
+    return band_10s
+
+
+def explain_query_bands(col:pymongo.collection.Collection)->dict:
+    '''
+    Execution statistics of the aggregation pipelines of query_bands
+    '''
+    genre=get_genre(col,start_90s, end_90s)
+    plans={}
+    for name,pipeline in [('genre',get_genre_pipeline(start_90s, end_90s)),
+                          ('band',get_band_pipeline(start_10s, end_10s, genre))]:
+        plans[name]=col.database.command('explain',
+                                         {'aggregate': col.name, 'pipeline': pipeline, 'cursor': {}},
+                                         verbosity='executionStats')
+    return plans
+
+
+def benchmark_mongo_query(name:str, query, n_runs:int, explain=None)->dict:
+    '''
+    Benchmark of a query on the bands collection
+    '''
+    return benchmark_query(name, connect,
+                           lambda client: query(get_collection(client)),
+                           n_runs=n_runs,
+                           explain=None if explain is None else lambda client: explain(get_collection(client)))
+
+
+def run_measurements(n_runs:int=30)->list:
+    '''
+    Benchmarks of the query for every optimization level, written as JSON
+    '''
+    results=[]
+
     #measuring runtime with not optimized query
-    with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-        col = client.musicians.bands
-        col.drop_indexes() 
-    runtime_not_optimized=measure_query_runtime(query_bands, n_runs)
-    print('Runtime not optimized: {}'.format(runtime_not_optimized))
-    
+    col = get_mongo_collection()
+    col.drop_indexes()
+    results.append(benchmark_mongo_query('not optimized', query_bands, n_runs, explain_query_bands))
+    print(format_result(results[-1]))
+
     #measuring runtime creating indexes on release_date and genres
-    with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-        col = client.musicians.bands
-        create_indexes(col)
-    runtime_with_indexes=measure_query_runtime(query_bands, n_runs) 
-    print('Runtime with indexes: {}'.format(runtime_with_indexes))
-    
+    create_indexes(col)
+    results.append(benchmark_mongo_query('with indexes', query_bands, n_runs, explain_query_bands))
+    print(format_result(results[-1]))
+
     #measuring runtime using optimized queries
-    runtime_optimized=measure_query_runtime(query_bands_optimized, n_runs) 
-    print('Runtime optimized: {}'.format(runtime_optimized))
-    
-    
-    
- 
-    
-    
-    
-    
\ No newline at end of file
+    create_additional_fields(col)
+    results.append(benchmark_mongo_query('optimized', query_bands_optimized, n_runs))
+    print(format_result(results[-1]))
+
+    #measuring runtime on the collection with one document per album
+    mongo_album_layout.create_albums_from_bands(col)
+    results.append(benchmark_mongo_query('album layout', query_bands_album_layout, n_runs))
+    print(format_result(results[-1]))
+
+    write_results('mongo_benchmark_{}.json'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S')),results,
+                  metadata={'database':'mongodb','n_runs':n_runs})
+    return results
+
+
+if __name__ == '__main__':
+    run_measurements()
@@ -1,11 +1,19 @@
 import pymongo
 from datetime import datetime
+from typing import Optional
+from MongoDB.mongo_optimization import get_decade_field, get_year_field, update_genre_rollup, has_genre_rollup
+from MongoDB.mongo_index_advisor import hoist_match
+from MongoDB.mongo_album_layout import update_album_documents
+from Connections.connection_manager import get_mongo_collection
+from Cache.result_cache import cached_query, bump_data_version
+from Benchmark.instrumentation import span
 
-def get_genre(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime)->str:
+def get_genre_pipeline(start_date:datetime, end_date:datetime)->list:
     '''
-    Get the most sold album from a timeframe
+    Aggregation pipeline of get_genre. The $match is hoisted before the $unwind
+    stages, so that the documents can be selected with an index
     '''
-    res=col.aggregate([
+    return hoist_match([
         {'$unwind': {'path': '$albums'}},
         {'$unwind': {'path': '$genres'}},
         {'$match': {'albums.release_date': {'$gte': start_date,'$lt': end_date}}}, 
@@ -13,82 +21,131 @@ def get_genre(col:pymongo.collection.Collection,start_date:datetime, end_date:da
         {'$sort': {'genre_sales': -1}},
         {'$project' : {'genres.genre_name':1} },#'genre':1,'genre_sales':1,
         {'$limit': 1}])
-    genre=list(res)[0]['_id']['genre']
+
+def get_genre(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime)->str:
+    '''
+    Get the most sold album from a timeframe
+    '''
+    with span('query',name='get_genre'):
+        res=col.aggregate(get_genre_pipeline(start_date, end_date))
+        genre=list(res)[0]['_id']['genre']
     return genre
 
-def get_band(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime, genre:str)->str:
+def get_band_pipeline(start_date:datetime, end_date:datetime, genre:str)->list:
     '''
-    Get the the band with the most sales in a specific genre in a timeframe
+    Aggregation pipeline of get_band. The $match is hoisted before the $unwind
+    stage, so that the documents can be selected with an index
     '''
-    res=col.aggregate([
+    return hoist_match([
         {'$unwind': {'path': '$albums'}},
         {'$match': {'albums.release_date': {'$gte': start_date,'$lt': end_date},
                     'genres.genre_name':genre}}, 
         {'$group': {'_id': {'band': '$band_url'},'band_sales': {'$sum': '$albums.sales'}}},
         {'$sort': {'band_sales': -1}},
         {'$project' : {'bands.band_url':1} },
-        {'$limit': 1}]) 
-    band=list(res)[0]['_id']['band']
+        {'$limit': 1}])
+
+def get_band(col:pymongo.collection.Collection,start_date:datetime, end_date:datetime, genre:str)->str:
+    '''
+    Get the the band with the most sales in a specific genre in a timeframe
+    '''
+    with span('query',name='get_band'):
+        res=col.aggregate(get_band_pipeline(start_date, end_date, genre))
+        band=list(res)[0]['_id']['band']
     return band
 
-def get_highest_sales(col:pymongo.collection.Collection)->int:
+#read-through cached versions of the queries, invalidated by the write paths
+get_genre_cached=cached_query('mongodb')(get_genre)
+get_band_cached=cached_query('mongodb')(get_band)
+
+def get_highest_sales_pipeline()->list:
     '''
-    Get the overall highest sales
+    Aggregation pipeline of get_highest_sales
     '''
-    res=col.aggregate([
+    return [
         {'$unwind': {'path': '$albums'}},
         {'$sort': {'albums.sales': -1}},
         {'$project' : {'albums.sales':1} },
-        {'$limit': 1}])
-    highest_sales=list(res)[0]['albums']['sales']
+        {'$limit': 1}]
+
+def get_highest_sales(col:pymongo.collection.Collection)->int:
+    '''
+    Get the overall highest sales
+    '''
+    with span('query',name='get_highest_sales'):
+        res=col.aggregate(get_highest_sales_pipeline())
+        highest_sales=list(res)[0]['albums']['sales']
     return highest_sales
 
 
-def insert_album(col:pymongo.collection.Collection, band:str, sales:int)->None:
+def get_insert_album_update(date:datetime, sales:int, update_sales_fields:bool=False)->dict:
     '''
-    Insert a new album for an existing band with higher sales than any other album
+    Update of insert_album pushing the new album and, with update_sales_fields,
+    increasing the precomputed sales
+    '''
+    update={'$push': 
+                 {'albums': 
+                      {'album_name': 'nices album',
+                       'release_date': date,
+                       'description': 'not the best',
+                       'running_time': 69.3,
+                       'sales': sales}}}
+    if update_sales_fields:
+        update['$inc']={get_decade_field(date): sales, get_year_field(date): sales}
+    return update
+
+def insert_album(col:pymongo.collection.Collection, band:str, sales:int, update_sales_fields:Optional[bool]=None)->None:
+    '''
+    Insert a new album for an existing band with higher sales than any other album.
+    With update_sales_fields, by default if the yearly genre rollup exists, the
+    precomputed sales of the decade and year are increased atomically in the same
+    update and the genre rollup is increased afterwards. The album documents of the
+    band are updated if the album collection exists
     '''
     date=datetime(2019,1,1,0,0,0,0)
-    col.update_one(
-        {'band_name': band},
-        {'$push': 
-             {'albums': 
-                  {'album_name': 'nices album',
-                   'release_date': date,
-                   'description': 'not the best',
-                   'running_time': 69.3,
-                   'sales': sales+1}}})
+    if update_sales_fields is None:
+        update_sales_fields=has_genre_rollup(col)
+    update=get_insert_album_update(date, sales+1, update_sales_fields)
+    if update_sales_fields:
+        doc=col.find_one_and_update({'band_name': band}, update, projection={'genres': 1})
+        if doc is not None and has_genre_rollup(col):
+            update_genre_rollup(col, doc.get('genres', []), date, sales+1)
+    else:
+        col.update_one({'band_name': band}, update)
+    update_album_documents(col, {'band_name': band})
+    bump_data_version('mongodb')
    
   
-#FIXME: deletion of specific albums does not work
 def delete_album(col:pymongo.collection.Collection):
-    band = col.find_one({'band_name':'The Offspring'})
-    id_band=band.get('_id')
-    
-    deleted=col.update_one( 
-            { '_id': id_band}, 
-            { '$pull': {'albums': {'$elemMatch': {'album_name':'nices album'}}}}) 
+    '''
+    Delete the album added by insert_album from a band. The condition of $pull is
+    applied to the albums themselves, so it is given on their fields (an $elemMatch
+    would look for an array inside of an album and never match)
+    '''
+    col.update_one({'band_name':'The Offspring'},
+                   {'$pull': {'albums': {'album_name':'nices album'}}})
+    update_album_documents(col, {'band_name':'The Offspring'})
+    bump_data_version('mongodb')
     res=col.find_one({ 'band_name': 'The Offspring'})  
     return res      
 
 
 if __name__=='__main__':
             
-    with pymongo.MongoClient('mongodb://localhost:27017/') as client:
-        col = client.musicians.bands
+    col = get_mongo_collection()
         
-        #define dates for queries
-        start_90s=datetime(1989,12,31,0,0,0,0)
-        end_90s=datetime(2000,1,1,0,0,0,0)
-        start_10s=datetime(2009,12,31,0,0,0,0)
-        end_10s=datetime(2020,1,1,0,0,0,0)
+    #define dates for queries
+    start_90s=datetime(1989,12,31,0,0,0,0)
+    end_90s=datetime(2000,1,1,0,0,0,0)
+    start_10s=datetime(2009,12,31,0,0,0,0)
+    end_10s=datetime(2020,1,1,0,0,0,0)
         
         
-        #1. Get the most successful band in the 2010s (01.01.2010 - 31.12.2019) in the most successful genre of the 1990s (01.01.1990 - 31.12.1999)                   
-        genre=get_genre(col,start_90s, end_90s)
-        band_10s=get_band(col,start_10s, end_10s, genre)
+    #1. Get the most successful band in the 2010s (01.01.2010 - 31.12.2019) in the most successful genre of the 1990s (01.01.1990 - 31.12.1999)                   
+    genre=get_genre(col,start_90s, end_90s)
+    band_10s=get_band(col,start_10s, end_10s, genre)
         
-        #2. Add a new album to the most successful band of most successful genre in the 90s, so that it is more successful than all of the albums of the most successful band in this genre in the 10s 
-        band_90s=get_band(col,start_90s, end_90s, genre)
-        highest_sales=get_highest_sales(col)
-        insert_album(col, band_90s,highest_sales)
\ No newline at end of file
+    #2. Add a new album to the most successful band of most successful genre in the 90s, so that it is more successful than all of the albums of the most successful band in this genre in the 10s 
+    band_90s=get_band(col,start_90s, end_90s, genre)
+    highest_sales=get_highest_sales(col)
+    insert_album(col, band_90s,highest_sales)
\ No newline at end of file
@@ -0,0 +1,190 @@
+import sys
+import numpy as np
+import pandas as pd
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Tuple
+from Postgres.postgres_data_insertion import load_music_data_to_df, coerce_str, coerce_dates, coerce_float, coerce_int, coerce_bool
+
+
+'''
+Memory-compact in-process representation of the band catalog.
+
+Instead of lists of dicts and tuples per band the catalog keeps column arrays:
+
+bands:       one entry per row of the band name file with the code of its band URI.
+             Band URIs, genre names and musician URIs are interned and kept once in
+             lists with dictionaries from the string to its code
+genres:      genre codes of all bands, the genres of band URI code i are
+             genre_codes[genre_offsets[i]:genre_offsets[i+1]]
+members:     musician codes, names and active flags, referenced by member_offsets
+albums:      names, release days, descriptions, running times and sales, referenced
+             by album_offsets
+
+Free text (band, album and musician names, descriptions) is stored as one utf8 buffer
+with offsets per column. Rows of bands without a row in the band name file are not part
+of the catalog. The loaders serialize the catalog lazily, band by band.
+'''
+
+epoch=date(1970,1,1)
+missing_day=np.iinfo(np.int32).min
+
+
+class StringColumn:
+    '''
+    Column of strings stored as a single utf8 buffer and the offsets of the strings
+    '''
+    __slots__=('data','offsets')
+
+    def __init__(self, strings:List[str]):
+        encoded=[string.encode('utf8') for string in strings]
+        self.data=b''.join(encoded)
+        self.offsets=np.zeros(len(encoded)+1,dtype=np.int64)
+        np.cumsum([len(string) for string in encoded],out=self.offsets[1:])
+
+    def __len__(self)->int:
+        return len(self.offsets)-1
+
+    def __getitem__(self, idx:int)->str:
+        return self.data[self.offsets[idx]:self.offsets[idx+1]].decode('utf8')
+
+    @property
+    def nbytes(self)->int:
+        return len(self.data)+self.offsets.nbytes
+
+
+def intern_strings(values)->Tuple[List[str],dict,np.ndarray]:
+    '''
+    Interning of strings, returning the distinct strings in order of appearance, the
+    dictionary from string to code and the code of every value
+    '''
+    codes,uniques=pd.factorize(pd.Series(coerce_str(values),dtype=object),sort=False)
+    strings=[sys.intern(string) for string in uniques]
+    return strings,{string:code for code,string in enumerate(strings)},codes.astype(np.int32)
+
+
+def group_by_code(codes:np.ndarray, n:int)->Tuple[np.ndarray,np.ndarray]:
+    '''
+    Positions of the rows with a valid code ordered by code, keeping the order of the
+    rows within a code, and the offsets of the rows of every code
+    '''
+    rows=np.flatnonzero(codes>=0)
+    order=rows[np.argsort(codes[rows],kind='stable')]
+    offsets=np.searchsorted(codes[order],np.arange(n+1)).astype(np.int64)
+    return order,offsets
+
+
+class Catalog:
+    '''
+    Column arrays of all bands with their genres, members and albums
+    '''
+    __slots__=('band_urls','band_index','band_codes','band_names',
+               'genre_names','genre_index','genre_codes','genre_offsets',
+               'musician_urls','musician_index','member_codes','member_names','member_active','member_offsets',
+               'album_names','album_days','album_descriptions','album_running_times','album_running_time_valid',
+               'album_sales','album_sales_valid','album_offsets')
+
+    @classmethod
+    def from_frames(cls, df_album:pd.DataFrame, df_band_name:pd.DataFrame,
+                    df_musicians:pd.DataFrame, df_genre:pd.DataFrame)->'Catalog':
+        '''
+        Building of the catalog from the dataframes of load_music_data_to_df. The values
+        are type casted as in gen_data_list and gen_band_data
+        '''
+        self=cls()
+        self.band_urls,self.band_index,self.band_codes=intern_strings(df_band_name[0])
+        n_urls=len(self.band_urls)
+        #every band row carries the first name of its band URI
+        first_rows=np.unique(self.band_codes,return_index=True)[1]
+        names=coerce_str(df_band_name[1])
+        self.band_names=StringColumn([names[first_rows[code]] for code in self.band_codes])
+
+        codes=pd.Index(self.band_urls,dtype=object).get_indexer(coerce_str(df_genre[0]))
+        order,self.genre_offsets=group_by_code(codes,n_urls)
+        self.genre_names,self.genre_index,self.genre_codes=intern_strings(df_genre[1].iloc[order])
+
+        codes=pd.Index(self.band_urls,dtype=object).get_indexer(coerce_str(df_musicians[0]))
+        order,self.member_offsets=group_by_code(codes,n_urls)
+        df_members=df_musicians.iloc[order]
+        self.musician_urls,self.musician_index,self.member_codes=intern_strings(df_members[1])
+        self.member_names=StringColumn(coerce_str(df_members[2]))
+        self.member_active=np.array(coerce_bool(df_members['active']),dtype=bool)
+
+        codes=pd.Index(self.band_urls,dtype=object).get_indexer(coerce_str(df_album[0]))
+        order,self.album_offsets=group_by_code(codes,n_urls)
+        df_albums=df_album.iloc[order]
+        self.album_names=StringColumn(coerce_str(df_albums[1]))
+        dates=coerce_dates(df_albums[2])
+        days=(dates-pd.Timestamp(epoch)).dt.days
+        self.album_days=days.fillna(missing_day).to_numpy(dtype=np.int64).astype(np.int32)
+        self.album_descriptions=StringColumn(coerce_str(df_albums[3]))
+        running_times=coerce_float(df_albums[4])
+        self.album_running_time_valid=np.array([val is not None for val in running_times],dtype=bool)
+        self.album_running_times=np.array([np.nan if val is None else val for val in running_times],dtype=np.float64)
+        sales=coerce_int(df_albums[5])
+        self.album_sales_valid=np.array([val is not None for val in sales],dtype=bool)
+        self.album_sales=np.array([0 if val is None else val for val in sales],dtype=np.int64)
+        return self
+
+    @classmethod
+    def load(cls)->'Catalog':
+        '''
+        Building of the catalog from the csv files
+        '''
+        return cls.from_frames(*load_music_data_to_df())
+
+    @property
+    def nbytes(self)->int:
+        '''
+        Size of the column arrays and string buffers, without the interned strings
+        '''
+        return sum(getattr(self,name).nbytes for name in self.__slots__ if hasattr(getattr(self,name),'nbytes'))
+
+    def get_genres(self, code:int)->List[str]:
+        return [self.genre_names[genre] for genre in self.genre_codes[self.genre_offsets[code]:self.genre_offsets[code+1]]]
+
+    def get_members(self, code:int)->List[tuple]:
+        return [(self.musician_urls[self.member_codes[idx]],self.member_names[idx],bool(self.member_active[idx]))
+                for idx in range(self.member_offsets[code],self.member_offsets[code+1])]
+
+    def get_albums(self, code:int, as_datetime:bool=True)->List[tuple]:
+        '''
+        Albums of a band URI as tuples (album_name, release_date, description,
+        running_time, sales), with release dates as datetime or date
+        '''
+        albums=[]
+        for idx in range(self.album_offsets[code],self.album_offsets[code+1]):
+            day=int(self.album_days[idx])
+            release_date=None
+            if day!=missing_day:
+                release_date=epoch+timedelta(days=day)
+                if as_datetime:
+                    release_date=datetime(release_date.year,release_date.month,release_date.day)
+            running_time=float(self.album_running_times[idx]) if self.album_running_time_valid[idx] else None
+            sales=int(self.album_sales[idx]) if self.album_sales_valid[idx] else None
+            albums.append((self.album_names[idx],release_date,self.album_descriptions[idx],running_time,sales))
+        return albums
+
+    def iter_data_lists(self)->Iterator[List]:
+        '''
+        Generator function yielding the lists of gen_data_list of the MongoDB loader
+        '''
+        for row,code in enumerate(self.band_codes):
+            yield [self.band_urls[code],self.band_names[row],self.get_genres(code),
+                   self.get_members(code),self.get_albums(code,as_datetime=True)]
+
+    def iter_band_data(self)->Iterator[tuple]:
+        '''
+        Generator function yielding the tuples of gen_band_data of the Postgres loader
+        '''
+        rows=np.unique(self.band_codes,return_index=True)[1]
+        for code,row in enumerate(rows):
+            yield (self.band_urls[code],self.band_names[row],self.get_genres(code),
+                   self.get_members(code),self.get_albums(code,as_datetime=False))
+
+    def iter_album_rows(self)->Iterator[tuple]:
+        '''
+        Generator function yielding the rows of the albums table
+        '''
+        for code,band_url in enumerate(self.band_urls):
+            for album in self.get_albums(code,as_datetime=False):
+                yield (band_url,)+album
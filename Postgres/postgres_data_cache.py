@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from typing import Callable,List,Tuple
+
+
+'''
+Cache of the parsed csv sources. The dataframes built from the csv files are stored
+as parquet files in a cache directory together with a manifest holding the size,
+mtime and sha256 hash of every source file. As long as the sources are unchanged,
+the dataframes are read from the memory mapped parquet files instead of parsing
+the csv files again.
+
+manifest={
+    'sources':{
+        'csv_files/band-band_name.csv':{'size':int,'mtime_ns':int,'sha256':'hash'},
+            ...
+    },
+    'frames':[
+        {'file':'frame_0.parquet','columns':[['0',True],['active',False]]},
+            ...
+    ]
+}
+'''
+
+MANIFEST_NAME='manifest.json'
+
+
+def hash_file(filename:str, chunk_size:int=1024**2)->str:
+    '''
+    Computation of the sha256 hash of the content of a file
+    '''
+    h=hashlib.sha256()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_file_signature(filename:str)->dict:
+    '''
+    Size and modification time of a file
+    '''
+    stat=os.stat(filename)
+    return {'size':stat.st_size,'mtime_ns':stat.st_mtime_ns}
+
+
+def read_manifest(cache_dir:str)->dict:
+    '''
+    Reading of the manifest of a cache directory, returns None if there is no valid manifest
+    '''
+    try:
+        with open(os.path.join(cache_dir,MANIFEST_NAME),encoding='utf8') as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+
+def write_manifest(cache_dir:str, manifest:dict)->None:
+    '''
+    Atomic writing of the manifest of a cache directory
+    '''
+    path=os.path.join(cache_dir,MANIFEST_NAME)
+    with open(path+'.tmp','w',encoding='utf8') as f:
+        json.dump(manifest,f,indent=4)
+    os.replace(path+'.tmp',path)
+
+
+def check_sources(manifest:dict, sources:List[str])->bool:
+    '''
+    Checking if the sources recorded in a manifest are unchanged. Files with equal
+    size and mtime are considered unchanged, otherwise their content hash is compared.
+    Signatures of files with a new mtime but an unchanged content are updated in the manifest
+    '''
+    if manifest is None or sorted(manifest.get('sources',{}))!=sorted(sources):
+        return False
+    for source in sources:
+        entry=manifest['sources'][source]
+        signature=get_file_signature(source)
+        if signature['size']!=entry['size']:
+            return False
+        if signature['mtime_ns']!=entry['mtime_ns']:
+            if hash_file(source)!=entry['sha256']:
+                return False
+            entry.update(signature)
+    return True
+
+
+def save_frames(cache_dir:str, frames:Tuple[pd.DataFrame,...], sources:List[str])->None:
+    '''
+    Saving of dataframes as parquet files and writing of the manifest for the sources.
+    Parquet only supports string column names, so the original column names are
+    recorded in the manifest
+    '''
+    os.makedirs(cache_dir,exist_ok=True)
+    manifest={'sources':{},'frames':[]}
+    for source in sources:
+        manifest['sources'][source]=dict(get_file_signature(source),sha256=hash_file(source))
+    for idx,df in enumerate(frames):
+        filename='frame_{}.parquet'.format(idx)
+        columns=[[str(col),isinstance(col,int)] for col in df.columns]
+        path=os.path.join(cache_dir,filename)
+        df.set_axis([col for col,_ in columns],axis='columns').to_parquet(path+'.tmp')
+        os.replace(path+'.tmp',path)
+        manifest['frames'].append({'file':filename,'columns':columns})
+    write_manifest(cache_dir,manifest)
+
+
+def load_frames(cache_dir:str, manifest:dict)->Tuple[pd.DataFrame,...]:
+    '''
+    Loading of the memory mapped parquet files of a cache directory
+    '''
+    frames=[]
+    for entry in manifest['frames']:
+        df=pd.read_parquet(os.path.join(cache_dir,entry['file']),memory_map=True)
+        frames.append(df.set_axis([int(col) if is_int else col for col,is_int in entry['columns']],axis='columns'))
+    return tuple(frames)
+
+
+def load_cached_frames(sources:List[str], build:Callable[[],Tuple[pd.DataFrame,...]], cache_dir:str)->Tuple[pd.DataFrame,...]:
+    '''
+    Loading of the dataframes built from the sources by the function build. The
+    dataframes are read from the cache directory if the sources did not change,
+    otherwise they are built again and the cache is renewed
+    '''
+    manifest=read_manifest(cache_dir)
+    signatures=None if manifest is None else json.dumps(manifest.get('sources'),sort_keys=True)
+    if check_sources(manifest,sources):
+        try:
+            frames=load_frames(cache_dir,manifest)
+            if json.dumps(manifest['sources'],sort_keys=True)!=signatures:
+                write_manifest(cache_dir,manifest)
+            return frames
+        except (ImportError,OSError,ValueError,TypeError) as error:
+            print('Reading of cache failed: {}'.format(error))
+    frames=build()
+    try:
+        save_frames(cache_dir,frames,sources)
+    except (ImportError,OSError,ValueError,TypeError) as error:
+        print('Writing of cache failed: {}'.format(error))
+    return frames
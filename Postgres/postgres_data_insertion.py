@@ -1,9 +1,20 @@
+from __future__ import annotations
 import pandas as pd
-import psycopg2
-import psycopg2.extras
+import numpy as np
+import io
 from datetime import datetime
-from typing import Tuple,List
+from typing import Tuple,List,Iterator,Iterable
 import os
+import json
+import hashlib
+import tempfile
+from Connections.connection_manager import get_settings, get_postgres_dsn, postgres_connection
+from Cache.result_cache import bump_data_version
+from Benchmark.instrumentation import instrumented, span, timed, count
+from Postgres.postgres_data_cache import load_cached_frames
+from Postgres.postgres_pipeline import split_frames_into_shards, run_pipeline
+from Postgres.postgres_sales_views import query_begin_bulk_load, refresh_after_load
+from Postgres.postgres_partitions import get_partition_interval, ensure_partitions
 
 
 '''
@@ -19,27 +30,62 @@ Tables in schema: bands,albums, genres,has_genre,musicians,member_of, has_name
 
 def parse_files(filename:str)->pd.DataFrame:
     '''
-    Custom reading and parsing of csv files, by splitting according to ';' delimeter
-    and deletion of '"'
+    Reading and parsing of the DBpedia csv files. Every line of the files is one
+    quoted csv field, which itself holds ';' separated and quoted fields. The lines
+    are unquoted in a first pass and split into columns by the csv parser in a second
+    pass. As before, the first line is treated as header and '"' and "'" are deleted
+    from all values
     '''
-    df = pd.read_csv(filename, encoding='utf8')
-    df=df.iloc[:,0].str.split(';',expand=True,)
+    lines = pd.read_csv(filename, encoding='utf8', dtype=str, keep_default_na=False).iloc[:,0]
+    df = pd.read_csv(io.StringIO('\n'.join(lines)), sep=';', quotechar='"', header=None,
+                     dtype=str, keep_default_na=False)
     for i in range(len(df.columns)):
-        df.iloc[:,i]=df.iloc[:,i].str.replace(r'\"', '',regex=True)
-        df.iloc[:,i]=df.iloc[:,i].str.replace(r'\'', '',regex=True)
+        df[i]=df[i].str.replace('"', '',regex=False).str.replace("'", '',regex=False)
     return df
 
-def load_music_data_to_df()->Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame,pd.DataFrame]:
+list_csv_files=[
+    'csv_files/band-album_data.csv',
+    'csv_files/band-band_name.csv',
+    'csv_files/band-member-member_name.csv',
+    'csv_files/band-former_member-member_name.csv',
+    'csv_files/band-genre_name.csv'
+]
+
+def get_csv_files()->List[str]:
+    '''
+    Paths of the csv files in the directory of the [data] settings, in the order of
+    list_csv_files
+    '''
+    csv_dir=get_settings()['data']['csv_dir']
+    return [os.path.join(csv_dir,os.path.basename(filename)) for filename in list_csv_files]
+
+def load_music_data_to_df(use_cache:bool=True)->Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame,pd.DataFrame]:
     '''
-    Loading of csv files into dataframes.
+    Loading of csv files into dataframes. With use_cache the dataframes are read from
+    a parquet snapshot of the parsed csv files, which is rebuilt if any file changed.
+    The files are read from the directory of the [data] settings, independent of the
+    working directory
     '''
-    os.chdir('..')
-    df_album = pd.read_csv('csv_files/band-album_data.csv', sep=';', header=None)
-    df_band_name=parse_files('csv_files/band-band_name.csv')
-    df_member=parse_files('csv_files/band-member-member_name.csv')
-    df_former_member=parse_files('csv_files/band-former_member-member_name.csv')
-    df_genre=parse_files('csv_files/band-genre_name.csv')
-    os.chdir('./Postgres')
+    with span('csv_parse',cached=use_cache):
+        if use_cache:
+            frames=load_cached_frames(get_csv_files(),read_music_data,os.path.join(get_settings()['data']['csv_dir'],'.cache'))
+        else:
+            frames=read_music_data()
+    return frames
+
+def read_music_data()->Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame,pd.DataFrame]:
+    '''
+    Reading and parsing of the csv files into dataframes
+    '''
+    csv_files=get_csv_files()
+    df_album = pd.read_csv(csv_files[0], sep=';', header=None)
+    df_band_name=parse_files(csv_files[1])
+    df_member=parse_files(csv_files[2])
+    df_former_member=parse_files(csv_files[3])
+    df_genre=parse_files(csv_files[4])
+    for filename,df in zip(csv_files,[df_album,df_band_name,df_member,df_former_member,df_genre]):
+        count('rows',len(df),stage='csv_parse',file=os.path.basename(filename))
+        count('bytes',os.path.getsize(filename),stage='csv_parse',file=os.path.basename(filename))
     
     #adding of 'active'column and merging of members and former members into df_musicians
     df_member['active']=[True]*len(df_member)
@@ -50,13 +96,10 @@ def load_music_data_to_df()->Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame,pd.Dat
     
 def connect()->psycopg2.extensions.connection:
     '''
-    Building of a connection to Postgres database
+    Building of a connection to Postgres database outside of the shared pool
     '''
-    conn = psycopg2.connect(
-    host="localhost",
-    database="musicians",
-    user="postgres",
-    password="root")
+    import psycopg2
+    conn = psycopg2.connect(**get_postgres_dsn())
     return conn
 
 def convert_df_to_list_of_tuples(df:pd.DataFrame, list_parse_func:List)->List[tuple]:
@@ -65,10 +108,23 @@ def convert_df_to_list_of_tuples(df:pd.DataFrame, list_parse_func:List)->List[tu
     casting of every column of the datframe according to the type functions
     in list_parse_func
     ''' 
-    values=[tuple([(try_parse(list_parse_func[idx],val)) 
-                   for idx,val in enumerate(row)])
-                        for row in df.to_numpy()]
-    return values
+    return list(zip(*coerce_df(df,list_parse_func)))
+
+def group_rows_by_band(df:pd.DataFrame, list_parse_func:List=None)->dict:
+    '''
+    Grouping of the rows of a dataframe by the band URI in its first column with
+    a single pass over the dataframe. The returned dictionary maps each band URI
+    to the list of its remaining row values, in the order of the dataframe. If
+    list_parse_func is given, the remaining columns are type casted beforehand
+    '''
+    if list_parse_func is None:
+        rows=df.iloc[:,1:].itertuples(index=False, name=None)
+    else:
+        rows=convert_df_to_list_of_tuples(df.iloc[:,1:],list_parse_func)
+    groups={}
+    for band_url,row in zip(df.iloc[:,0],rows):
+        groups.setdefault(band_url,[]).append(row)
+    return groups
 
 def convert_to_date(d):
     '''
@@ -76,6 +132,12 @@ def convert_to_date(d):
     '''
     return datetime.strptime(str(d), '%d/%m/%Y').date()
 
+def convert_to_datetime(d):
+    '''
+    Conversion of value into MongoDB compatible datetime format
+    '''
+    return datetime.strptime(str(d), '%d/%m/%Y')
+
 def try_parse(fun,x):
     '''
     Wrapper function for handling type casting exception
@@ -86,13 +148,154 @@ def try_parse(fun,x):
         return None
 
 
+'''
+Vectorized type casting of whole columns. Every coerce function takes a column and
+returns an object array of Python values, which equals the result of applying
+try_parse with the corresponding type function to every value of the column
+'''
+
+def coerce_str(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(str,x)
+    '''
+    arr=np.array(values,dtype=object)
+    if pd.api.types.infer_dtype(arr,skipna=True) not in ('string','empty'):
+        return to_object_array([str(val) for val in arr])
+    mask=pd.isna(arr)
+    if mask.any():
+        arr[mask]=[str(val) for val in arr[mask]]
+    return arr
+
+def coerce_int(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(int,x). Floats are truncated and strings
+    holding an ASCII integer literal of up to 18 digits are converted vectorized.
+    Other strings int() may accept (non ASCII digits or whitespace, underscores,
+    longer literals) are converted by try_parse
+    '''
+    arr=np.full(len(values),None,dtype=object)
+    if pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values):
+        arr[:]=values.to_numpy().astype(np.int64).astype(object)
+    elif pd.api.types.is_float_dtype(values):
+        floats=values.to_numpy(dtype=np.float64)
+        valid=np.isfinite(floats)
+        arr[valid]=np.trunc(floats[valid]).astype(np.int64).astype(object)
+    elif pd.api.types.infer_dtype(values,skipna=True)=='string':
+        strs=pd.Series(np.array(values,dtype=object),dtype=object)
+        valid=strs.str.fullmatch(r'[ \t\n\r\f\v]*[+-]?[0-9]{1,18}[ \t\n\r\f\v]*').fillna(False).to_numpy(dtype=bool)
+        arr[valid]=pd.to_numeric(strs[valid].str.strip()).to_numpy().astype(object)
+        other=~valid & strs.str.contains(r'[^\x00-\x7f]|_|[0-9]{19}').fillna(False).to_numpy(dtype=bool)
+        arr[other]=[try_parse(int,val) for val in strs[other]]
+    else:
+        arr[:]=[try_parse(int,val) for val in values]
+    return arr
+
+def coerce_float(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(float,x). Missing values stay NaN as with
+    float(), while values that can not be converted become None. Strings holding an
+    ASCII decimal literal are converted by a cast of the whole column, which parses
+    them like float(). Other strings float() may accept (e.g. 'nan', 'inf', non ASCII
+    digits, underscores) are converted by try_parse
+    '''
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float64).astype(object)
+    arr=np.array(values,dtype=object)
+    res=np.full(len(arr),None,dtype=object)
+    missing=pd.isna(arr)
+    res[missing]=np.nan
+    strs=pd.Series(arr,dtype=object)
+    valid=strs.str.fullmatch(r'[ \t\n\r\f\v]*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?[ \t\n\r\f\v]*')
+    valid=valid.fillna(False).to_numpy(dtype=bool)
+    res[valid]=arr[valid].astype(np.float64).astype(object)
+    blank=strs.str.strip().eq('').fillna(False).to_numpy(dtype=bool)
+    other=~(valid|missing|blank)
+    res[other]=[try_parse(float,val) for val in arr[other]]
+    return res
+
+def coerce_bool(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(bool,x)
+    '''
+    if pd.api.types.is_bool_dtype(values):
+        return values.to_numpy(dtype=bool).astype(object)
+    return to_object_array([bool(val) for val in values])
+
+def coerce_dates(values:pd.Series)->pd.Series:
+    '''
+    Parsing of a column of dates in the format dd/mm/YYYY, with NaT for invalid values
+    '''
+    strs=pd.Series(coerce_str(values),dtype=object)
+    return pd.to_datetime(strs,format='%d/%m/%Y',errors='coerce')
+
+def coerce_date(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(convert_to_date,x)
+    '''
+    dates=coerce_dates(values)
+    valid=dates.notna().to_numpy()
+    arr=np.full(len(values),None,dtype=object)
+    arr[valid]=dates[valid].array.date
+    return arr
+
+def coerce_datetime(values:pd.Series)->np.ndarray:
+    '''
+    Vectorized counterpart of try_parse(convert_to_datetime,x)
+    '''
+    dates=coerce_dates(values)
+    valid=dates.notna().to_numpy()
+    arr=np.full(len(values),None,dtype=object)
+    arr[valid]=dates[valid].array.to_pydatetime()
+    return arr
+
+def to_object_array(values:List)->np.ndarray:
+    '''
+    Conversion of a list of Python values into a one dimensional object array
+    '''
+    arr=np.empty(len(values),dtype=object)
+    arr[:]=values
+    return arr
+
+dict_coerce_func={
+    str:coerce_str,
+    int:coerce_int,
+    float:coerce_float,
+    bool:coerce_bool,
+    convert_to_date:coerce_date,
+    convert_to_datetime:coerce_datetime
+}
+
+def coerce_column(values:pd.Series, fun)->np.ndarray:
+    '''
+    Type casting of a column according to the type function fun. Type functions
+    without a vectorized counterpart are applied to every value with try_parse
+    '''
+    coerce_func=dict_coerce_func.get(fun)
+    if coerce_func is None:
+        return to_object_array([try_parse(fun,val) for val in values])
+    return coerce_func(values)
+
+def coerce_df(df:pd.DataFrame, list_parse_func:List)->List[np.ndarray]:
+    '''
+    Type casting of every column of a dataframe according to the type functions
+    in list_parse_func, returning the typed columns as object arrays
+    '''
+    with span('type_coercion'):
+        count('rows',len(df),stage='type_coercion')
+        return [coerce_column(df.iloc[:,idx],list_parse_func[idx]) for idx in range(len(df.columns))]
+
+
 def execute_values(conn:psycopg2.extensions.connection,cursor:psycopg2.extensions.connection.cursor,query:str,values:List[tuple],table:str='table',fetch:bool=True):  
     '''
     Bulk insert using the objects given for the query and values parameters. The
     kwarg fetch is used to determine if the query is returning values
     '''
+    import psycopg2.extras
     try:
-        psycopg2.extras.execute_values(cursor, query, values,page_size=len(values))
+        with span('network_write',table=table):
+            psycopg2.extras.execute_values(cursor, query, values,page_size=len(values))
+            count('rows',len(values),stage='network_write',table=table)
+            count('bytes',len(cursor.query or b''),stage='network_write',table=table)
         if fetch:
             res = cursor.fetchall()
             ids = [i for item in res for i in item]
@@ -109,43 +312,66 @@ def execute_values(conn:psycopg2.extensions.connection,cursor:psycopg2.extension
         return 1 
 
 
-def create_has_genre_df(dict_band_ids:dict,dict_genre_ids:dict, df_band_name:pd.DataFrame, df_genre:pd.DataFrame)->pd.DataFrame:
+def create_id_map(keys, ids)->pd.Series:
+    '''
+    Mapping of keys to their ids as series indexed by the keys. The hash table of the
+    index is built once on the first lookup and reused by every later lookup. For
+    repeated keys the last id is kept, as with a dictionary built from the same pairs
+    '''
+    with span('id_mapping'):
+        id_map=pd.Series(np.asarray(ids,dtype=np.int64),index=pd.Index(np.asarray(keys,dtype=object)))
+        return id_map[~id_map.index.duplicated(keep='last')]
+
+
+def map_ids(id_map:pd.Series, keys)->np.ndarray:
+    '''
+    Ids of keys looked up in an id map by hashing. The codes of the keys in the index
+    of the id map select the ids, keys missing in the id map get the id -1
+    '''
+    with span('id_mapping'):
+        codes=id_map.index.get_indexer(np.asarray(keys,dtype=object))
+        return np.where(codes>=0,id_map.to_numpy()[codes],-1)
+
+
+def create_has_genre_df(band_ids:pd.Series,genre_ids:pd.Series, df_genre:pd.DataFrame)->pd.DataFrame:
      '''
-     Creation of the dataframe df_has_genre holding the values for the has_genre table
+     Creation of the dataframe df_has_genre holding the values for the has_genre table.
+     Genre rows of bands without an id are left out
      '''
-     list_band_ids=[dict_band_ids[band] for band in df_genre[0].tolist() if band in df_band_name[0].tolist()]
-     list_genre_ids=[dict_genre_ids[genre] for genre in df_genre[1].tolist()]
-     df_has_genre=pd.DataFrame(list(zip(list_band_ids,list_genre_ids))).drop_duplicates()
+     df_has_genre=pd.DataFrame({0:map_ids(band_ids,df_genre[0]),1:map_ids(genre_ids,df_genre[1])})
+     df_has_genre=df_has_genre[(df_has_genre[0]>=0)&(df_has_genre[1]>=0)].drop_duplicates()
      return df_has_genre
 
 
-def create_member_of_df(dict_musician_ids:dict, dict_band_ids:dict, df_musicians:pd.DataFrame)->pd.DataFrame:
+def create_member_of_df(musician_ids:pd.Series, band_ids:pd.Series, df_musicians:pd.DataFrame)->pd.DataFrame:
     '''
-    Creation of the dataframe df_member_of holding the values for the member_of table
+    Creation of the dataframe df_member_of holding the values for the member_of table.
+    Musician rows of bands without an id are left out
     '''
-    list_musicians=[dict_musician_ids[musician] for musician in df_musicians[1].tolist()]
-    list_bands=[dict_band_ids[band] for band in df_musicians[0].tolist()]
-    list_active=df_musicians['active']
-    df_member_of=pd.DataFrame(list(zip(list_musicians,list_bands,list_active))).drop_duplicates()
+    df_member_of=pd.DataFrame({0:map_ids(musician_ids,df_musicians[1]),1:map_ids(band_ids,df_musicians[0]),
+                               2:df_musicians['active'].to_numpy()})
+    df_member_of=df_member_of[(df_member_of[0]>=0)&(df_member_of[1]>=0)].drop_duplicates()
     return df_member_of
  
     
-def create_has_name_df(dict_musician_ids:dict,df_musicians:pd.DataFrame)->pd.DataFrame:
+def create_has_name_df(musician_ids:pd.Series,df_musicians:pd.DataFrame)->pd.DataFrame:
     '''
      Creation of the dataframe df_has_name holding the values for the has_name table
     '''   
     df_has_name=df_musicians[[1,2]].drop_duplicates()
-    df_has_name[1]=[dict_musician_ids[musician] for musician in df_has_name[1].tolist()]
+    df_has_name[1]=map_ids(musician_ids,df_has_name[1])
     return df_has_name
 
 
+@instrumented('postgres_insert')
 def insert():
     '''
     Loading of the data from the csv files and insertion into the corresponding tables
     '''
     df_album,df_band_name,df_musicians,df_genre=load_music_data_to_df()
-    with connect() as conn:
+    with postgres_connection() as conn:
         with conn.cursor() as cursor:
+            cursor.execute(query_begin_bulk_load)
             # Insertion of data into bands table
             query_band="INSERT INTO bands(band_url,band_name) VALUES %s RETURNING band_id"
             values_band=convert_df_to_list_of_tuples(df_band_name,[str,str])
@@ -166,27 +392,456 @@ def insert():
             values_musician=convert_df_to_list_of_tuples(df_musicians[1].drop_duplicates().to_frame(),[str])
             ids_musicians=execute_values(conn,cursor,query_musician,values_musician,table='musicians',fetch=True)
 
-            # Initialization of dictionaries from returned ids to form foreign keys in other tables
-            dict_musician_ids=dict(zip(df_musicians[1].drop_duplicates().tolist(),ids_musicians))
-            dict_band_ids=dict(zip(df_band_name[0].tolist(),ids_band))
-            dict_genre_ids=dict(zip(df_genre[1].drop_duplicates().tolist(),ids_genre))
+            # Initialization of id maps from returned ids to form foreign keys in other tables
+            musician_ids=create_id_map(df_musicians[1].drop_duplicates(),ids_musicians)
+            band_ids=create_id_map(df_band_name[0],ids_band)
+            genre_ids=create_id_map(df_genre[1].drop_duplicates(),ids_genre)
             
             # Insertion of data into has_genre table
-            df_has_genre=create_has_genre_df(dict_band_ids,dict_genre_ids, df_band_name, df_genre)
+            df_has_genre=create_has_genre_df(band_ids,genre_ids,df_genre)
             query_has_genre="INSERT INTO has_genre(band_id,genre_id) VALUES %s"
             values_has_genre=values_band=convert_df_to_list_of_tuples(df_has_genre,[int,int])
             _=execute_values(conn,cursor,query_has_genre,values_has_genre,table='has_genre',fetch=False)
             
             # Insertion of data into member_of table
-            df_member_of=create_member_of_df(dict_musician_ids, dict_band_ids, df_musicians)
+            df_member_of=create_member_of_df(musician_ids,band_ids,df_musicians)
             query_member_of="INSERT INTO member_of(musician_id,band_id,active) VALUES %s"
             values_member_of=convert_df_to_list_of_tuples(df_member_of,[int,int,bool])
             _=execute_values(conn,cursor,query_member_of,values_member_of,table='member_of',fetch=False)
             
             # Insertion of data into has_name table
-            df_has_name=create_has_name_df(dict_musician_ids,df_musicians)
+            df_has_name=create_has_name_df(musician_ids,df_musicians)
             query_has_name="INSERT INTO has_name(musician_id,musician_name) VALUES %s"
             values_has_name=convert_df_to_list_of_tuples(df_has_name,[int,str])
             _=execute_values(conn,cursor,query_has_name,values_has_name,table='has_name',fetch=False)
             print('Filling of database with data done.')
+    refresh_after_load()
+    bump_data_version('postgres')
+
+
+def format_copy_value(val)->str:
+    '''
+    Formatting of a single value according to the text format of COPY, where
+    None is written as \\N and backslashes, tabs and newlines are escaped
+    '''
+    if val is None:
+        return '\\N'
+    return (str(val).replace('\\','\\\\').replace('\t','\\t')
+            .replace('\n','\\n').replace('\r','\\r'))
+
+
+def copy_values(cursor:psycopg2.extensions.cursor,table:str,columns:List[str],values:Iterable[tuple],max_size:int=64*1024**2)->None:
+    '''
+    Bulk insert of values into a table using COPY FROM STDIN. The rows, which may
+    be produced lazily by a generator, are written
+    into a spooled buffer, which is kept in memory up to max_size bytes and moved
+    to a temporary file above that
+    '''
+    n_rows=0
+    n_bytes=0
+    with tempfile.SpooledTemporaryFile(max_size=max_size,mode='w+',encoding='utf8') as buf:
+        with span('row_format',table=table):
+            for row in timed('row_build',values,table=table):
+                line='\t'.join([format_copy_value(val) for val in row])+'\n'
+                buf.write(line)
+                n_rows+=1
+                n_bytes+=len(line.encode('utf8'))
+        buf.seek(0)
+        query="COPY {}({}) FROM STDIN".format(table,','.join(columns))
+        with span('network_write',table=table):
+            cursor.copy_expert(query,buf)
+        count('rows',n_rows,stage='network_write',table=table)
+        count('bytes',n_bytes,stage='network_write',table=table)
+    print('Copied {} tuples into {} table.'.format(n_rows,table))
+
+
+def reserve_ids(cursor:psycopg2.extensions.cursor,table:str,id_column:str,n:int)->List[int]:
+    '''
+    Client side assignment of n serial ids for a table. The ids are drawn from the
+    sequence of the serial column in one statement, so they never collide with ids
+    handed out to concurrent inserts using the default or to other loaders
+    '''
+    if n<=0:
+        return []
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s,%s)) FROM generate_series(1,%s)",(table,id_column,n))
+    return [row[0] for row in cursor.fetchall()]
+
+
+album_columns=['band_url','album_name','release_date','description','running_time','sales']
+
+
+def copy_albums(cursor:psycopg2.extensions.cursor,values:Iterable[tuple])->None:
+    '''
+    Copying of album rows into the albums table. If the table is partitioned, the rows
+    are copied into the partitioned table, which routes them into their partitions and
+    fires its statement triggers. The release years are collected while the rows are
+    streamed, the missing partitions are created afterwards and take over their rows
+    from the default partition
+    '''
+    interval=get_partition_interval(cursor)
+    if interval is None:
+        copy_values(cursor,'albums',album_columns,values)
+        return
+    years=set()
+    def track_years(rows):
+        for row in rows:
+            if row[2] is not None:
+                years.add(row[2].year)
+            yield row
+    copy_values(cursor,'albums',album_columns,track_years(values))
+    with span('partition_routing',table='albums'):
+        ensure_partitions(cursor,interval,years)
+
+
+@instrumented('postgres_insert_copy')
+def insert_copy():
+    '''
+    Loading of the data from the csv files and insertion into the corresponding tables
+    using COPY instead of multi-row INSERT statements. The ids referenced by foreign
+    keys are assigned client side, so no ids have to be returned by the database
+    '''
+    df_album,df_band_name,df_musicians,df_genre=load_music_data_to_df()
+    with postgres_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query_begin_bulk_load)
+            # Copying of data into bands table
+            values_band=convert_df_to_list_of_tuples(df_band_name,[str,str])
+            ids_band=reserve_ids(cursor,'bands','band_id',len(values_band))
+            copy_values(cursor,'bands',['band_id','band_url','band_name'],
+                        [(idx,)+row for idx,row in zip(ids_band,values_band)])
+            
+            # Copying of data into albums table
+            values_album=convert_df_to_list_of_tuples(df_album,[str,str,convert_to_date,str,float,int])
+            copy_albums(cursor,values_album)
+
+            # Copying of data into genres table
+            values_genre=convert_df_to_list_of_tuples(df_genre[1].drop_duplicates().to_frame(),[str])
+            ids_genre=reserve_ids(cursor,'genres','genre_id',len(values_genre))
+            copy_values(cursor,'genres',['genre_id','genre_name'],
+                        [(idx,)+row for idx,row in zip(ids_genre,values_genre)])
+
+            # Copying of data into musicians table
+            values_musician=convert_df_to_list_of_tuples(df_musicians[1].drop_duplicates().to_frame(),[str])
+            ids_musicians=reserve_ids(cursor,'musicians','musician_id',len(values_musician))
+            copy_values(cursor,'musicians',['musician_id','musician_url'],
+                        [(idx,)+row for idx,row in zip(ids_musicians,values_musician)])
+
+            # Initialization of id maps from assigned ids to form foreign keys in other tables
+            musician_ids=create_id_map(df_musicians[1].drop_duplicates(),ids_musicians)
+            band_ids=create_id_map(df_band_name[0],ids_band)
+            genre_ids=create_id_map(df_genre[1].drop_duplicates(),ids_genre)
+            
+            # Copying of data into has_genre table
+            df_has_genre=create_has_genre_df(band_ids,genre_ids,df_genre)
+            values_has_genre=convert_df_to_list_of_tuples(df_has_genre,[int,int])
+            copy_values(cursor,'has_genre',['band_id','genre_id'],values_has_genre)
+            
+            # Copying of data into member_of table
+            df_member_of=create_member_of_df(musician_ids,band_ids,df_musicians)
+            values_member_of=convert_df_to_list_of_tuples(df_member_of,[int,int,bool])
+            copy_values(cursor,'member_of',['musician_id','band_id','active'],values_member_of)
+            
+            # Copying of data into has_name table
+            df_has_name=create_has_name_df(musician_ids,df_musicians)
+            values_has_name=convert_df_to_list_of_tuples(df_has_name,[int,str])
+            copy_values(cursor,'has_name',['musician_id','musician_name'],values_has_name)
+            print('Filling of database with data done.')
+    refresh_after_load()
+    bump_data_version('postgres')
+
+
+@instrumented('postgres_insert_copy_catalog')
+def insert_copy_catalog(catalog)->None:
+    '''
+    Loading of the data of a compact Catalog into the tables using COPY. The rows are
+    produced lazily from the column arrays of the catalog, the join tables are built
+    from the codes of the catalog
+    '''
+    with postgres_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query_begin_bulk_load)
+            # Copying of data into bands table, one row per band URI
+            rows=np.unique(catalog.band_codes,return_index=True)[1]
+            ids_band=np.array(reserve_ids(cursor,'bands','band_id',len(rows)),dtype=np.int64)
+            copy_values(cursor,'bands',['band_id','band_url','band_name'],
+                        ((int(ids_band[code]),catalog.band_urls[code],catalog.band_names[row]) for code,row in enumerate(rows)))
+
+            # Copying of data into albums table
+            copy_albums(cursor,catalog.iter_album_rows())
+
+            # Copying of data into genres and musicians table
+            ids_genre=np.array(reserve_ids(cursor,'genres','genre_id',len(catalog.genre_names)),dtype=np.int64)
+            copy_values(cursor,'genres',['genre_id','genre_name'],zip(ids_genre.tolist(),catalog.genre_names))
+            ids_musicians=np.array(reserve_ids(cursor,'musicians','musician_id',len(catalog.musician_urls)),dtype=np.int64)
+            copy_values(cursor,'musicians',['musician_id','musician_url'],zip(ids_musicians.tolist(),catalog.musician_urls))
+
+            # Copying of data into the join tables, with the band of every genre and member taken from the offsets
+            genre_bands=np.repeat(np.arange(len(catalog.band_urls)),np.diff(catalog.genre_offsets))
+            df_has_genre=pd.DataFrame({0:ids_band[genre_bands],1:ids_genre[catalog.genre_codes]}).drop_duplicates()
+            copy_values(cursor,'has_genre',['band_id','genre_id'],df_has_genre.itertuples(index=False,name=None))
+            member_bands=np.repeat(np.arange(len(catalog.band_urls)),np.diff(catalog.member_offsets))
+            df_member_of=pd.DataFrame({0:ids_musicians[catalog.member_codes],1:ids_band[member_bands],
+                                       2:catalog.member_active}).drop_duplicates()
+            copy_values(cursor,'member_of',['musician_id','band_id','active'],df_member_of.itertuples(index=False,name=None))
+            df_has_name=pd.DataFrame({0:ids_musicians[catalog.member_codes],
+                                      1:[catalog.member_names[idx] for idx in range(len(catalog.member_names))]}).drop_duplicates()
+            copy_values(cursor,'has_name',['musician_id','musician_name'],df_has_name.itertuples(index=False,name=None))
+            print('Filling of database with data done.')
+    refresh_after_load()
+    bump_data_version('postgres')
+
+
+def transform_shard_rows(frames:List[pd.DataFrame])->List[Tuple[str,List[str],List[tuple]]]:
+    '''
+    Conversion of the dataframes of a shard into the rows of the band related tables,
+    returned as list of (table, columns, rows). The dataframes of bands, genres and
+    musicians carry the ids assigned by insert_copy_parallel in the column 'id'
+    '''
+    df_band_name,df_album,df_genre,df_musicians=frames
+    band_ids=create_id_map(df_band_name[0],df_band_name['id'])
+
+    values_band=convert_df_to_list_of_tuples(df_band_name[['id',0,1]],[int,str,str])
+    values_album=convert_df_to_list_of_tuples(df_album,[str,str,convert_to_date,str,float,int])
+
+    df_has_genre=pd.DataFrame({0:map_ids(band_ids,df_genre[0]),1:df_genre['id'].to_numpy()})
+    df_has_genre=df_has_genre[df_has_genre[0]>=0].drop_duplicates()
+    values_has_genre=convert_df_to_list_of_tuples(df_has_genre,[int,int])
+
+    df_member_of=pd.DataFrame({0:df_musicians['id'].to_numpy(),1:map_ids(band_ids,df_musicians[0]),
+                               2:df_musicians['active'].to_numpy()})
+    df_member_of=df_member_of[df_member_of[1]>=0].drop_duplicates()
+    values_member_of=convert_df_to_list_of_tuples(df_member_of,[int,int,bool])
+    return [('bands',['band_id','band_url','band_name'],values_band),
+            ('albums',['band_url','album_name','release_date','description','running_time','sales'],values_album),
+            ('has_genre',['band_id','genre_id'],values_has_genre),
+            ('member_of',['musician_id','band_id','active'],values_member_of)]
+
+
+@instrumented('postgres_insert_copy_parallel')
+def insert_copy_parallel(n_workers:int=None, n_shards:int=64, queue_size:int=4)->None:
+    '''
+    Loading of the data as in insert_copy, with the band related rows transformed in
+    n_workers processes. Genres, musicians and their names are copied up front and the
+    ids of bands, genres and musicians are assigned before sharding, so the ids are the
+    same as with insert_copy for any number of workers. The transformed shards are
+    copied in shard order on a single connection within one transaction
+    '''
+    df_album,df_band_name,df_musicians,df_genre=load_music_data_to_df()
+    with postgres_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query_begin_bulk_load)
+            # Copying of data into bands table
+            ids_band=reserve_ids(cursor,'bands','band_id',len(df_band_name))
+
+            # Copying of data into genres table
+            values_genre=convert_df_to_list_of_tuples(df_genre[1].drop_duplicates().to_frame(),[str])
+            ids_genre=reserve_ids(cursor,'genres','genre_id',len(values_genre))
+            copy_values(cursor,'genres',['genre_id','genre_name'],
+                        [(idx,)+row for idx,row in zip(ids_genre,values_genre)])
+
+            # Copying of data into musicians table
+            values_musician=convert_df_to_list_of_tuples(df_musicians[1].drop_duplicates().to_frame(),[str])
+            ids_musicians=reserve_ids(cursor,'musicians','musician_id',len(values_musician))
+            copy_values(cursor,'musicians',['musician_id','musician_url'],
+                        [(idx,)+row for idx,row in zip(ids_musicians,values_musician)])
+
+            musician_ids=create_id_map(df_musicians[1].drop_duplicates(),ids_musicians)
+            genre_ids=create_id_map(df_genre[1].drop_duplicates(),ids_genre)
+
+            # Copying of data into has_name table
+            df_has_name=create_has_name_df(musician_ids,df_musicians)
+            values_has_name=convert_df_to_list_of_tuples(df_has_name,[int,str])
+            copy_values(cursor,'has_name',['musician_id','musician_name'],values_has_name)
+
+            # Transformation of the shards and copying into the band related tables
+            frames=[df_band_name.assign(id=ids_band),
+                    df_album,
+                    df_genre.assign(id=map_ids(genre_ids,df_genre[1])),
+                    df_musicians.assign(id=map_ids(musician_ids,df_musicians[1]))]
+            shards=split_frames_into_shards(frames,n_shards)
+
+            def load(rows):
+                for table,columns,values in rows:
+                    if table=='albums':
+                        copy_albums(cursor,values)
+                    else:
+                        copy_values(cursor,table,columns,values)
+
+            run_pipeline(shards,transform_shard_rows,load,n_workers=n_workers,queue_size=queue_size)
+            print('Filling of database with data done.')
+    refresh_after_load()
+    bump_data_version('postgres')
+
+
+def hash_content(content)->str:
+    '''
+    Computation of a sha256 content hash of json serializable data, where values
+    json does not support (e.g. dates) are serialized as strings
+    '''
+    serialized=json.dumps(content,sort_keys=True,default=str)
+    return hashlib.sha256(serialized.encode('utf8')).hexdigest()
+
+
+def gen_band_data()->Iterator[tuple]:
+    '''
+    Generator function yielding the type casted data of every band as tuple of
+    band_url:str, band_name:str, list_genres:List, list_musicians:List, list_albums:List
+    '''
+    df_album,df_band_name,df_musicians,df_genre=load_music_data_to_df()
+    dict_band_names=group_rows_by_band(df_band_name,[str])
+    dict_genres=group_rows_by_band(df_genre,[str])
+    dict_musicians=group_rows_by_band(df_musicians,[str,str,bool])
+    dict_albums=group_rows_by_band(df_album,[str,convert_to_date,str,float,int])
+    for band_url,names in dict_band_names.items():
+        list_genres=[genre for genre, in dict_genres.get(band_url,[])]
+        yield band_url,names[0][0],list_genres,dict_musicians.get(band_url,[]),dict_albums.get(band_url,[])
+
+
+query_create_sync_schema='''
+CREATE UNIQUE INDEX IF NOT EXISTS index_unique_band_url ON bands (band_url);
+CREATE UNIQUE INDEX IF NOT EXISTS index_unique_genre_name ON genres (genre_name);
+CREATE UNIQUE INDEX IF NOT EXISTS index_unique_musician_url ON musicians (musician_url);
+CREATE TABLE IF NOT EXISTS band_hashes(
+	band_url 		TEXT 	PRIMARY KEY,
+	content_hash 	TEXT 	NOT NULL
+);
+'''
+
+
+def upsert_ids(cursor:psycopg2.extensions.cursor,table:str,id_column:str,key_column:str,keys:List)->dict:
+    '''
+    Insertion of keys that are not yet stored into a table with a unique key column,
+    returning a dictionary from every key to its id
+    '''
+    import psycopg2.extras
+    keys=list(dict.fromkeys(keys))
+    query="INSERT INTO {}({}) VALUES %s ON CONFLICT ({}) DO NOTHING".format(table,key_column,key_column)
+    psycopg2.extras.execute_values(cursor,query,[(key,) for key in keys],page_size=1000)
+    cursor.execute("SELECT {},{} FROM {} WHERE {} = ANY(%s)".format(key_column,id_column,table,key_column),(keys,))
+    return dict(cursor.fetchall())
+
+
+def delete_band_rows(cursor:psycopg2.extensions.cursor,band_ids:List[int],band_urls:List[str])->Tuple[set,set]:
+    '''
+    Deletion of the join table rows and albums of bands, returning the ids of the
+    genres and musicians the bands referenced
+    '''
+    cursor.execute("DELETE FROM has_genre WHERE band_id = ANY(%s) RETURNING genre_id",(band_ids,))
+    genre_ids={genre_id for genre_id, in cursor.fetchall()}
+    cursor.execute("DELETE FROM member_of WHERE band_id = ANY(%s) RETURNING musician_id",(band_ids,))
+    musician_ids={musician_id for musician_id, in cursor.fetchall()}
+    cursor.execute("DELETE FROM albums WHERE band_url = ANY(%s)",(band_urls,))
+    return genre_ids,musician_ids
+
+
+def delete_bands(cursor:psycopg2.extensions.cursor,band_urls:List[str])->Tuple[set,set]:
+    '''
+    Deletion of bands together with their albums, join table rows and content hashes,
+    returning the ids of the genres and musicians the bands referenced
+    '''
+    cursor.execute("SELECT band_id FROM bands WHERE band_url = ANY(%s)",(band_urls,))
+    band_ids=[band_id for band_id, in cursor.fetchall()]
+    genre_ids,musician_ids=delete_band_rows(cursor,band_ids,band_urls)
+    cursor.execute("DELETE FROM bands WHERE band_id = ANY(%s)",(band_ids,))
+    cursor.execute("DELETE FROM band_hashes WHERE band_url = ANY(%s)",(band_urls,))
+    return genre_ids,musician_ids
+
+
+def delete_stale_names(cursor:psycopg2.extensions.cursor,musician_ids:List[int],dict_names:dict)->None:
+    '''
+    Deletion of the names of musicians that no band lists anymore, where dict_names
+    holds the set of names of every musician url over all bands
+    '''
+    import psycopg2.extras
+    cursor.execute("SELECT m.musician_url,h.musician_id,h.musician_name FROM has_name AS h "
+                   "JOIN musicians AS m ON m.musician_id=h.musician_id WHERE h.musician_id = ANY(%s)",(musician_ids,))
+    stale=[(musician_id,name) for url,musician_id,name in cursor.fetchall() if name not in dict_names.get(url,())]
+    query=("DELETE FROM has_name AS h USING (VALUES %s) AS s(musician_id,musician_name) "
+           "WHERE h.musician_id=s.musician_id AND h.musician_name=s.musician_name")
+    psycopg2.extras.execute_values(cursor,query,stale,page_size=1000)
+
+
+query_delete_orphans='''
+DELETE FROM musicians AS m
+WHERE m.musician_id = ANY(%(musician_ids)s)
+AND NOT EXISTS (SELECT 1 FROM member_of AS mo WHERE mo.musician_id=m.musician_id);
+DELETE FROM genres AS g
+WHERE g.genre_id = ANY(%(genre_ids)s)
+AND NOT EXISTS (SELECT 1 FROM has_genre AS hg WHERE hg.genre_id=g.genre_id);
+'''
+
+
+@instrumented('postgres_sync')
+def sync(catalog=None)->Tuple[int,int]:
+    '''
+    Incremental synchronization of the tables with the csv files. Every band gets
+    a content hash over its name, genres, musicians and albums, which is stored in
+    the band_hashes table. Only bands with a new or changed hash are upserted and
+    their join table rows and albums are replaced, while bands that are not part of
+    the csv files anymore are deleted. Names the csv files no longer list for a
+    musician of these bands are deleted, as are musicians and genres left without
+    any band (has_name rows follow their musician). The band data is taken from a compact Catalog
+    if given. Returns the number of upserted and deleted bands
+    '''
+    import psycopg2.extras
+    band_data_iter=gen_band_data() if catalog is None else catalog.iter_band_data()
+    dict_band_data={band_data[0]:band_data for band_data in band_data_iter}
+    dict_hashes={band_url:hash_content(band_data[1:]) for band_url,band_data in dict_band_data.items()}
+    with postgres_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query_begin_bulk_load)
+            cursor.execute(query_create_sync_schema)
+            cursor.execute("SELECT band_url,content_hash FROM band_hashes")
+            stored_hashes=dict(cursor.fetchall())
+            changed=[band_url for band_url,content_hash in dict_hashes.items() if stored_hashes.get(band_url)!=content_hash]
+            deleted=[band_url for band_url in stored_hashes if band_url not in dict_hashes]
+
+            # Deletion of removed bands
+            genre_ids,musician_ids=delete_bands(cursor,deleted)
+
+            # Upsert of changed bands
+            query_band=("INSERT INTO bands(band_url,band_name) VALUES %s ON CONFLICT (band_url) "
+                        "DO UPDATE SET band_name=EXCLUDED.band_name RETURNING band_url,band_id")
+            values_band=[dict_band_data[band_url][:2] for band_url in changed]
+            dict_band_ids=dict(psycopg2.extras.execute_values(cursor,query_band,values_band,page_size=1000,fetch=True))
+
+            # Insertion of new genres and musicians
+            list_genres=[genre for band_url in changed for genre in dict_band_data[band_url][2]]
+            dict_genre_ids=upsert_ids(cursor,'genres','genre_id','genre_name',list_genres)
+            list_musicians=[musician for band_url in changed for musician in dict_band_data[band_url][3]]
+            dict_musician_ids=upsert_ids(cursor,'musicians','musician_id','musician_url',[url for url,_,_ in list_musicians])
+
+            # Replacement of the join table rows and albums of changed bands
+            old_genre_ids,old_musician_ids=delete_band_rows(cursor,list(dict_band_ids.values()),changed)
+            genre_ids|=old_genre_ids
+            musician_ids|=old_musician_ids
+            values_has_genre=list(dict.fromkeys((dict_band_ids[band_url],dict_genre_ids[genre])
+                                                for band_url in changed for genre in dict_band_data[band_url][2]))
+            psycopg2.extras.execute_values(cursor,"INSERT INTO has_genre(band_id,genre_id) VALUES %s",values_has_genre,page_size=1000)
+            values_member_of=list(dict.fromkeys((dict_musician_ids[url],dict_band_ids[band_url],active)
+                                                for band_url in changed for url,_,active in dict_band_data[band_url][3]))
+            psycopg2.extras.execute_values(cursor,"INSERT INTO member_of(musician_id,band_id,active) VALUES %s",values_member_of,page_size=1000)
+            values_has_name=list(dict.fromkeys((dict_musician_ids[url],name) for url,name,_ in list_musicians))
+            psycopg2.extras.execute_values(cursor,"INSERT INTO has_name(musician_id,musician_name) VALUES %s ON CONFLICT DO NOTHING",values_has_name,page_size=1000)
+            values_album=[(band_url,)+album for band_url in changed for album in dict_band_data[band_url][4]]
+            psycopg2.extras.execute_values(cursor,"INSERT INTO albums(band_url,album_name,release_date,description,running_time,sales) VALUES %s",values_album,page_size=1000)
+
+            # Deletion of stale names and of musicians and genres without bands
+            dict_names={}
+            for band_data in dict_band_data.values():
+                for url,name,_ in band_data[3]:
+                    dict_names.setdefault(url,set()).add(name)
+            musician_ids|=set(dict_musician_ids.values())
+            delete_stale_names(cursor,list(musician_ids),dict_names)
+            cursor.execute(query_delete_orphans,{'musician_ids': list(musician_ids),'genre_ids': list(genre_ids)})
+
+            # Storing of the new content hashes
+            query_hashes=("INSERT INTO band_hashes(band_url,content_hash) VALUES %s ON CONFLICT (band_url) "
+                          "DO UPDATE SET content_hash=EXCLUDED.content_hash")
+            psycopg2.extras.execute_values(cursor,query_hashes,[(band_url,dict_hashes[band_url]) for band_url in changed],page_size=1000)
+            print('Synchronized database: {} bands upserted, {} bands deleted.'.format(len(changed),len(deleted)))
+    if changed or deleted:
+        refresh_after_load()
+        bump_data_version('postgres')
+    return len(changed),len(deleted)
 #insert()
\ No newline at end of file
@@ -1,68 +1,106 @@
-import pandas as pd
 import psycopg2
 import psycopg2.extras
-from time import time
+from datetime import datetime
+from Connections.connection_manager import get_postgres_dsn, postgres_connection
+from Benchmark.benchmark_suite import benchmark_query, format_result, write_results, summarize, measure
 
 
-def measure_query_runtime(query:str, n_runs:int)->float:
+def connect()->psycopg2.extensions.connection:
     '''
-    Measuring the mean runtime of a query for n_runs
+    Opening of a new connection to the Postgres database for measuring the connection setup
     '''
-    list_runtimes=[]
-    for i in range(n_runs):
-        with psycopg2.connect(dbname='musicians', user='postgres', password='root') as conn:
-            cur = conn.cursor()
-            start=time()
-            cur.execute(query)
-            stop=time()
-        runtime=stop-start
-        list_runtimes.append(runtime)
-    return sum(list_runtimes)/len(list_runtimes)
+    return psycopg2.connect(**get_postgres_dsn())
+
+
+def fetch_query(conn:psycopg2.extensions.connection, query:str)->list:
+    '''
+    Execution of a query and fetching of its full result
+    '''
+    with conn.cursor() as cur:
+        cur.execute(query)
+        return cur.fetchall()
+
+
+def explain_query(conn:psycopg2.extensions.connection, query:str)->list:
+    '''
+    Query plan with execution and buffer statistics of a query. For queries calling
+    plpgsql functions the plan only holds the function call, not the inner statements
+    '''
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '+query)
+        return cur.fetchone()[0]
+
+
+def measure_query_runtime(query:str, n_runs:int, n_warmup:int=3)->float:
+    '''
+    Measuring the mean runtime of a query in seconds for n_runs after n_warmup
+    runs on a pooled connection, including fetching of the result
+    '''
+    with postgres_connection() as conn:
+        samples=measure(lambda: fetch_query(conn,query),n_runs,n_warmup)
+    return summarize(samples)['mean_ms']/1000
+
+
+def benchmark_postgres_query(name:str, query:str, n_runs:int)->dict:
+    '''
+    Benchmark of a query including its query plan
+    '''
+    return benchmark_query(name, connect,
+                           lambda conn: fetch_query(conn,query),
+                           n_runs=n_runs,
+                           explain=lambda conn: explain_query(conn,query))
 
 
 def run_query(query:str)->None:
     '''
     Execution of a query for Postgres
     '''
-    with psycopg2.connect(dbname='musicians', user='postgres', password='root') as conn:
+    with postgres_connection() as conn:
         cur = conn.cursor()
         cur.execute(query)
-        
-        
-if __name__=='__main__':
-    query_drop_indexes='''SELECT drop_indexes();'''
-    query_create_indexes='''SELECT create_indexes();'''
-    query_create_index_view='''SELECT create_index_on_view();'''
-    query_not_optimized='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s('31-12-2009'::date, '01-01-2020'::date);'''
-    query_optimized_view='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s_optimzed_view_joins('31-12-2009'::date, '01-01-2020'::date);'''
-    query_fully_optimized='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s_fully_optimized()'''
-    
-    n_runs=10
-        
-      
+
+
+query_drop_indexes='''SELECT drop_indexes();'''
+query_create_indexes='''SELECT create_indexes();'''
+query_create_index_view='''SELECT create_index_on_view();'''
+query_not_optimized='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s('31-12-2009'::date, '01-01-2020'::date);'''
+query_optimized_view='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s_optimzed_view_joins('31-12-2009'::date, '01-01-2020'::date);'''
+query_fully_optimized='''SELECT get_most_succesful_band_in_timeframe_in_most_successful_genre_90s_fully_optimized()'''
+
+
+def run_measurements(n_runs:int=30)->list:
+    '''
+    Benchmarks of the query for every optimization level, written as JSON
+    '''
+    results=[]
+
     #runtime not optimized
     run_query(query_drop_indexes)
-    runtime_not_optimized=measure_query_runtime(query_not_optimized, n_runs)
-    print('Runtime not optimized: {}'.format(runtime_not_optimized))
-    
-    
+    results.append(benchmark_postgres_query('not optimized',query_not_optimized,n_runs))
+    print(format_result(results[-1]))
+
     #runtime with indexes
     run_query(query_create_indexes)
-    runtime_with_indexes=measure_query_runtime(query_not_optimized, n_runs)
-    print('Runtime with indexes: {}'.format(runtime_with_indexes))
-    
+    results.append(benchmark_postgres_query('with indexes',query_not_optimized,n_runs))
+    print(format_result(results[-1]))
+
     #runtime with view on joins
-    runtime_with_view=measure_query_runtime(query_optimized_view, n_runs)
-    print('Runtime with view on joins: {}'.format(runtime_with_view))
-    
-    
+    results.append(benchmark_postgres_query('with view on joins',query_optimized_view,n_runs))
+    print(format_result(results[-1]))
+
     #runtime with index on view on joins:
     run_query(query_create_index_view)
-    runtime_with_view_and_index=measure_query_runtime(query_optimized_view, n_runs)
-    print('Runtime with index on view on joins: {}'.format(runtime_with_view_and_index))
-    
-    
+    results.append(benchmark_postgres_query('with index on view on joins',query_optimized_view,n_runs))
+    print(format_result(results[-1]))
+
     #runtime fully optimized query
-    runtime_fully_optimized=measure_query_runtime(query_fully_optimized, n_runs)
-    print('Runtime fully optimized: {}'.format(runtime_fully_optimized))
-    
+    results.append(benchmark_postgres_query('fully optimized',query_fully_optimized,n_runs))
+    print(format_result(results[-1]))
+
+    write_results('postgres_benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S')),results,
+                  metadata={'database':'postgres','n_runs':n_runs})
+    return results
+
+
+if __name__=='__main__':
+    run_measurements()
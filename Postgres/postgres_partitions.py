@@ -0,0 +1,393 @@
+from __future__ import annotations
+import argparse
+import json
+from datetime import date, timedelta
+from typing import Iterable, List, Optional, Tuple
+from Connections.connection_manager import postgres_connection
+from Cache.result_cache import bump_data_version
+from Postgres.postgres_sales_views import get_query_params, split_date_range, query_begin_bulk_load, \
+    query_create_sales_view, query_genre_base, query_band_base, query_genre_sales_view, query_band_sales_view
+
+
+'''
+Optional partitioned schema of the albums table. The table is range partitioned by
+release_date into one partition per year (albums_y1995) or per decade (albums_d1990),
+the interval is stored in the comment of the table. Albums without or with a release
+date outside of all partitions go into the default partition albums_default.
+
+- create_partitioned_albums converts the albums table of postgres_create_tables.sql
+  into the partitioned table. The rows are moved into the partitions and the view of
+  postgres_sales_views is created again, if it existed, since it references the old
+  table. Foreign keys referencing albums and other views depending on albums (e.g.
+  the views of postgres_optimization.sql) cannot be kept: the conversion fails while
+  they exist, unless drop_dependents is set, which drops them explicitly and lists
+  them. The views have to be created again by running their file
+- album_id stays a serial column, but is not a primary key anymore, since a primary
+  key of a partitioned table has to contain the partition key and release_date may be
+  NULL. Its uniqueness is not enforced anymore, the ids drawn from the sequence stay
+  distinct. It is indexed by a non unique index, so no foreign key can reference it
+- a BRIN index on release_date and a btree index on band_url are created on the
+  partitioned table, Postgres creates them on every partition attached later
+- ensure_partitions creates missing partitions. Rows of their range in the default
+  partition are moved into the new partition before it is attached, since the default
+  partition must not contain rows of an attached range
+- maintain_partitions is the maintenance tool, e.g. run daily by cron: it creates the
+  partition of the current and the next period ahead of time, creates the partitions
+  of rows that ended up in the default partition and summarizes the new page ranges
+  of the BRIN indexes
+- the loaders copy album rows into the partitioned table, which routes them into
+  their partitions and fires the statement triggers of the table. Rows without a
+  partition go into the default partition and are moved into the partitions
+  ensure_partitions creates after the copy
+- check_pruning runs EXPLAIN on the queries over albums and compares the scanned
+  partitions with the partitions overlapping the date range of the query
+
+The triggers of postgres_sales_views are defined on the partitioned table and fire for
+rows of all partitions (Postgres 13 or newer).
+'''
+
+intervals={'year': 1, 'decade': 10}
+partition_prefixes={'year': 'albums_y', 'decade': 'albums_d'}
+default_partition='albums_default'
+
+query_is_partitioned='''
+SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid=to_regclass('albums'));
+'''
+
+query_partition_interval='''
+SELECT obj_description(to_regclass('albums'), 'pg_class');
+'''
+
+query_partitions='''
+SELECT c.relname
+FROM pg_inherits AS i
+JOIN pg_class AS c ON c.oid=i.inhrelid
+WHERE i.inhparent=to_regclass('albums')
+ORDER BY c.relname;
+'''
+
+query_create_partitioned_albums='''
+ALTER TABLE albums RENAME TO albums_unpartitioned;
+CREATE TABLE albums (LIKE albums_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (release_date);
+ALTER SEQUENCE albums_album_id_seq OWNED BY albums.album_id;
+CREATE TABLE albums_default PARTITION OF albums DEFAULT;
+CREATE INDEX index_albums_release_date_brin ON albums USING brin (release_date);
+CREATE INDEX index_albums_band_url ON albums USING btree (band_url);
+CREATE INDEX index_albums_album_id ON albums USING btree (album_id);
+COMMENT ON TABLE albums IS '{interval}';
+'''
+
+query_existing_views='''
+SELECT to_regclass('band_genre_year_sales') IS NOT NULL;
+'''
+
+query_referencing_keys='''
+SELECT conrelid::regclass::text, quote_ident(conname)
+FROM pg_constraint
+WHERE contype='f' AND confrelid=to_regclass('albums')
+ORDER BY 1, 2;
+'''
+
+#views and materialized views depending on albums, directly or through other views,
+#ordered so that every view comes before the views it depends on
+query_dependent_views='''
+WITH RECURSIVE dependents(oid, depth) AS (
+    SELECT r.ev_class, 1
+    FROM pg_depend AS d
+    JOIN pg_rewrite AS r ON r.oid=d.objid
+    WHERE d.classid='pg_rewrite'::regclass AND d.refobjid=to_regclass('albums') AND r.ev_class<>to_regclass('albums')
+    UNION
+    SELECT r.ev_class, dep.depth+1
+    FROM dependents AS dep
+    JOIN pg_depend AS d ON d.refobjid=dep.oid
+    JOIN pg_rewrite AS r ON r.oid=d.objid
+    WHERE d.classid='pg_rewrite'::regclass AND r.ev_class<>dep.oid
+)
+SELECT c.oid::regclass::text, c.relkind='m'
+FROM dependents AS dep
+JOIN pg_class AS c ON c.oid=dep.oid
+GROUP BY c.oid, c.relkind
+ORDER BY MAX(dep.depth) DESC, 1;
+'''
+
+query_year_range='''
+SELECT EXTRACT(YEAR FROM MIN(release_date))::INT, EXTRACT(YEAR FROM MAX(release_date))::INT FROM {table};
+'''
+
+query_move_rows='''
+INSERT INTO albums SELECT * FROM albums_unpartitioned;
+DROP TABLE albums_unpartitioned;
+'''
+
+query_create_partition='''
+CREATE TABLE {partition} (LIKE albums INCLUDING DEFAULTS);
+WITH moved AS (
+    DELETE FROM albums_default
+    WHERE release_date >= %(start_date)s AND release_date < %(end_date)s
+    RETURNING *
+)
+INSERT INTO {partition} SELECT * FROM moved;
+ALTER TABLE albums ATTACH PARTITION {partition} FOR VALUES FROM (%(start_date)s) TO (%(end_date)s);
+'''
+
+query_get_bulk_load='''SELECT current_setting('musicians.bulk_load', true);'''
+
+query_set_bulk_load='''SELECT set_config('musicians.bulk_load', %(bulk_load)s, true);'''
+
+query_default_years='''
+SELECT DISTINCT EXTRACT(YEAR FROM release_date)::INT FROM albums_default WHERE release_date IS NOT NULL;
+'''
+
+query_summarize_brin='''
+SELECT brin_summarize_new_values(i.indexrelid)
+FROM pg_index AS i
+JOIN pg_class AS c ON c.oid=i.indexrelid
+JOIN pg_am AS am ON am.oid=c.relam
+WHERE am.amname='brin' AND i.indrelid=ANY(%(partitions)s::regclass[]);
+'''
+
+
+def get_partition_start(interval:str, year:int)->int:
+    '''
+    First year of the partition of a year
+    '''
+    return year-year%intervals[interval]
+
+
+def get_partition_name(interval:str, release_date:Optional[date])->str:
+    '''
+    Name of the partition a release date belongs to
+    '''
+    if release_date is None:
+        return default_partition
+    return '{}{}'.format(partition_prefixes[interval],get_partition_start(interval,release_date.year))
+
+
+def get_partition_range(interval:str, start_year:int)->Tuple[date,date]:
+    '''
+    Range [start_date, end_date) of the partition starting at start_year
+    '''
+    return date(start_year,1,1), date(start_year+intervals[interval],1,1)
+
+
+def get_partition_interval(cur:psycopg2.extensions.cursor)->Optional[str]:
+    '''
+    Partition interval of the albums table, year or decade, and None if the table is
+    not partitioned
+    '''
+    cur.execute(query_is_partitioned)
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(query_partition_interval)
+    interval=cur.fetchone()[0]
+    if interval not in intervals:
+        raise ValueError('Unknown partition interval of albums: {}'.format(interval))
+    return interval
+
+
+def get_partitions(cur:psycopg2.extensions.cursor)->List[str]:
+    cur.execute(query_partitions)
+    return [row[0] for row in cur.fetchall()]
+
+
+def ensure_partitions(cur:psycopg2.extensions.cursor, interval:str, years:Iterable[int])->List[str]:
+    '''
+    Creation of the missing partitions of years. Rows of the new ranges are moved out
+    of the default partition with the row trigger switched off, since moving does not
+    change the sales. Returns the names of the created partitions
+    '''
+    existing=set(get_partitions(cur))
+    created=[]
+    for start_year in sorted({get_partition_start(interval,year) for year in years}):
+        partition='{}{}'.format(partition_prefixes[interval],start_year)
+        if partition in existing:
+            continue
+        start_date,end_date=get_partition_range(interval,start_year)
+        cur.execute(query_get_bulk_load)
+        bulk_load=cur.fetchone()[0]
+        cur.execute(query_begin_bulk_load)
+        cur.execute(query_create_partition.format(partition=partition),
+                    {'start_date': start_date, 'end_date': end_date})
+        cur.execute(query_set_bulk_load,{'bulk_load': bulk_load or ''})
+        existing.add(partition)
+        created.append(partition)
+        print('Created partition {} for [{}, {}).'.format(partition,start_date,end_date))
+    return created
+
+
+def get_dependents(cur:psycopg2.extensions.cursor)->Tuple[List[Tuple[str,str]],List[Tuple[str,bool]]]:
+    '''
+    Foreign keys referencing albums as (table, constraint) and views depending on
+    albums as (view, materialized), with the names quoted as identifiers
+    '''
+    cur.execute(query_referencing_keys)
+    keys=cur.fetchall()
+    cur.execute(query_dependent_views)
+    return keys, cur.fetchall()
+
+
+def drop_dependents_of_albums(cur:psycopg2.extensions.cursor, keys:List[Tuple[str,str]], views:List[Tuple[str,bool]])->None:
+    '''
+    Dropping of the foreign keys referencing albums and the views depending on albums
+    '''
+    for table,constraint in keys:
+        cur.execute('ALTER TABLE {} DROP CONSTRAINT {};'.format(table,constraint))
+        print('Dropped foreign key {} of {} referencing albums.'.format(constraint,table))
+    for view,materialized in views:
+        cur.execute('DROP {}VIEW {};'.format('MATERIALIZED ' if materialized else '',view))
+        print('Dropped {}view {} depending on albums.'.format('materialized ' if materialized else '',view))
+
+
+def create_partitioned_albums(conn:psycopg2.extensions.connection, interval:str='decade',
+                              drop_dependents:bool=False)->List[str]:
+    '''
+    Conversion of the albums table into a table partitioned by release_date, with one
+    partition per year or decade from the first release year to the year after the
+    current year. The sales view is created again if it existed. Other views depending
+    on albums and foreign keys referencing albums are dropped if drop_dependents is set,
+    otherwise their existence raises a ValueError
+    '''
+    if interval not in intervals:
+        raise ValueError('Unknown partition interval: {}'.format(interval))
+    with conn.cursor() as cur:
+        if get_partition_interval(cur) is not None:
+            raise ValueError('The albums table is already partitioned.')
+        cur.execute(query_existing_views)
+        has_sales_view=cur.fetchone()[0]
+        keys,views=get_dependents(cur)
+        others=[view for view,_ in views if view!='band_genre_year_sales']
+        if (keys or others) and not drop_dependents:
+            raise ValueError('Partitioning drops the foreign keys referencing albums ({}) and the views depending '
+                             'on albums ({}), set drop_dependents to drop them.'.format(
+                                 ', '.join('{}.{}'.format(table,constraint) for table,constraint in keys) or 'none',
+                                 ', '.join(others) or 'none'))
+        drop_dependents_of_albums(cur,keys,views)
+        cur.execute(query_year_range.format(table='albums'))
+        first_year,last_year=cur.fetchone()
+        this_year=date.today().year
+        first_year=min(first_year or this_year,this_year)
+        last_year=max(last_year or this_year,this_year+1)
+        cur.execute(query_create_partitioned_albums.format(interval=interval))
+        created=ensure_partitions(cur,interval,range(first_year,last_year+1))
+        cur.execute(query_begin_bulk_load)
+        cur.execute(query_move_rows)
+        if has_sales_view:
+            cur.execute(query_create_sales_view)
+        cur.execute('ANALYZE albums;')
+    conn.commit()
+    bump_data_version('postgres')
+    print('Partitioned albums table by {} into {} partitions.'.format(interval,len(created)+1))
+    return created
+
+
+def maintain_partitions(conn:psycopg2.extensions.connection, ahead:int=1)->List[str]:
+    '''
+    Creation of the partitions of the current period and the ahead following periods
+    and of the partitions of dated rows in the default partition. The new page ranges
+    of the BRIN indexes of the created partitions and of the partitions of the current
+    period are summarized. Returns the names of the created partitions
+    '''
+    with conn.cursor() as cur:
+        interval=get_partition_interval(cur)
+        if interval is None:
+            raise ValueError('The albums table is not partitioned.')
+        this_year=date.today().year
+        years=[this_year+intervals[interval]*idx for idx in range(ahead+1)]
+        cur.execute(query_default_years)
+        years.extend(row[0] for row in cur.fetchall())
+        created=ensure_partitions(cur,interval,years)
+        partitions=set(created)|{get_partition_name(interval,date(this_year,1,1)),default_partition}
+        cur.execute(query_summarize_brin,{'partitions': sorted(partitions)})
+        n_ranges=sum(row[0] for row in cur.fetchall())
+    conn.commit()
+    print('Summarized {} new BRIN page ranges.'.format(n_ranges))
+    return created
+
+
+def get_scanned_relations(cur:psycopg2.extensions.cursor, query:str, params:dict)->List[str]:
+    '''
+    Names of the relations scanned by the plan of a query, from EXPLAIN (FORMAT JSON).
+    Partitions removed by pruning at run time are not listed in the plan either
+    '''
+    cur.execute('EXPLAIN (FORMAT JSON) '+query, params)
+    plan=cur.fetchone()[0]
+    if isinstance(plan,str):
+        plan=json.loads(plan)
+    relations=[]
+    nodes=[plan[0]['Plan']]
+    while nodes:
+        node=nodes.pop()
+        if 'Relation Name' in node:
+            relations.append(node['Relation Name'])
+        nodes.extend(node.get('Plans',[]))
+    return sorted(set(relations))
+
+
+def get_expected_partitions(interval:str, partitions:List[str], start_date:date, end_date:date)->List[str]:
+    '''
+    Partitions overlapping the range [start_date, end_date). The default partition is
+    expected if a part of the range is not covered by the partitions
+    '''
+    expected=[]
+    covered=True
+    last_date=end_date-timedelta(days=1)
+    for year in range(get_partition_start(interval,start_date.year),last_date.year+1,intervals[interval]):
+        partition='{}{}'.format(partition_prefixes[interval],year)
+        if partition in partitions:
+            expected.append(partition)
+        else:
+            covered=False
+    if not covered:
+        expected.append(default_partition)
+    return expected
+
+
+def check_pruning(cur:psycopg2.extensions.cursor, start_date:date, end_date:date, genre_id:int=None)->List[dict]:
+    '''
+    Check whether the queries over albums for the range [start_date, end_date] only
+    scan the partitions of the range, for the sales view queries only the partitions
+    of the partially covered years. Returns per query the expected and the scanned
+    partitions and whether the plan is pruned
+    '''
+    interval=get_partition_interval(cur)
+    if interval is None:
+        raise ValueError('The albums table is not partitioned.')
+    partitions=get_partitions(cur)
+    params={'start_date': start_date, 'end_date': end_date, 'genre_id': genre_id}
+    queries=[('genre_base',query_genre_base,params,[(start_date,end_date+timedelta(days=1))]),
+             ('band_base',query_band_base,params,[(start_date,end_date+timedelta(days=1))])]
+    cur.execute("SELECT to_regclass('band_genre_year_sales') IS NOT NULL")
+    if cur.fetchone()[0]:
+        partial_ranges,partial_params=get_query_params(start_date,end_date)
+        partial_params['genre_id']=genre_id
+        ranges=split_date_range(start_date,end_date)[2]
+        queries.extend([('genre_sales_view',query_genre_sales_view.format(partial_ranges=partial_ranges),partial_params,ranges),
+                        ('band_sales_view',query_band_sales_view.format(partial_ranges=partial_ranges),partial_params,ranges)])
+    results=[]
+    for name,query,query_params,ranges in queries:
+        expected=set()
+        for start,end in ranges:
+            expected.update(get_expected_partitions(interval,partitions,start,end))
+        scanned=[relation for relation in get_scanned_relations(cur,query,query_params) if relation in partitions]
+        results.append({'query': name, 'expected': sorted(expected), 'scanned': scanned,
+                        'pruned': set(scanned)<=expected})
+    return results
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Partitioning of the albums table by release_date')
+    parser.add_argument('command',choices=['create','maintain','check'])
+    parser.add_argument('--interval',choices=sorted(intervals),default='decade')
+    parser.add_argument('--ahead',type=int,default=1)
+    args=parser.parse_args()
+    with postgres_connection() as conn:
+        if args.command=='create':
+            create_partitioned_albums(conn,args.interval)
+        elif args.command=='maintain':
+            maintain_partitions(conn,args.ahead)
+        else:
+            with conn.cursor() as cur:
+                #ranges of the flagship query: the 1990s and the 2010s
+                for start_date,end_date in [(date(1990,1,1),date(1999,12,31)),(date(2010,1,1),date(2019,12,31))]:
+                    for result in check_pruning(cur,start_date,end_date,genre_id=1):
+                        print('{} {} - {}: {}'.format(result['query'],start_date,end_date,result))
@@ -0,0 +1,101 @@
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List
+
+
+'''
+Parallel ETL pipeline shared by the MongoDB and Postgres loaders.
+
+The bands are split into a fixed number of shards by a hash of their band_url, so
+every row of a band ends up in the same shard. The shards are transformed in a
+ProcessPoolExecutor and the results are handed to loader threads in shard order.
+Both stages are bounded: at most max_pending shards are transformed ahead of the
+loaders and at most queue_size transformed shards wait for a loader. As the shard
+of a band only depends on n_shards, the output is the same for any number of workers.
+'''
+
+
+def get_shard_ids(band_urls:pd.Series, n_shards:int)->np.ndarray:
+    '''
+    Shard of every band URI. pandas hashes strings with a fixed key, so the shards
+    are stable across processes and runs, unlike the builtin hash
+    '''
+    hashes=pd.util.hash_array(np.asarray(band_urls,dtype=object))
+    return (hashes%np.uint64(n_shards)).astype(np.int64)
+
+
+def split_frames_into_shards(frames:List[pd.DataFrame], n_shards:int)->List[List[pd.DataFrame]]:
+    '''
+    Splitting of dataframes with the band URI in their first column into n_shards
+    lists of dataframes. The rows of a shard keep the order of the original dataframe
+    '''
+    shards=[[] for _ in range(n_shards)]
+    for df in frames:
+        shard_ids=get_shard_ids(df.iloc[:,0],n_shards)
+        order=np.argsort(shard_ids,kind='stable')
+        bounds=np.searchsorted(shard_ids[order],np.arange(n_shards+1))
+        for shard in range(n_shards):
+            shards[shard].append(df.iloc[order[bounds[shard]:bounds[shard+1]]])
+    return shards
+
+
+def run_pipeline(shards:Iterable, transform:Callable, load:Callable, n_workers:int=None,
+                 n_loaders:int=1, queue_size:int=4, max_pending:int=None)->int:
+    '''
+    Transformation of every shard with transform in n_workers processes and loading
+    of the results with load in n_loaders threads. transform has to be a picklable
+    top level function. With a single loader the results are loaded in shard order.
+    Returns the number of loaded shards
+    '''
+    n_workers=n_workers or os.cpu_count()
+    max_pending=max_pending or 2*n_workers
+    results=queue.Queue(maxsize=queue_size)
+    errors=[]
+    n_loaded=[0]
+    lock=threading.Lock()
+    done=object()
+
+    def loader():
+        while True:
+            result=results.get()
+            if result is done:
+                return
+            #after an error the queue is still drained, so the producer never blocks
+            if errors:
+                continue
+            try:
+                load(result)
+                with lock:
+                    n_loaded[0]+=1
+            except BaseException as error:
+                errors.append(error)
+
+    threads=[threading.Thread(target=loader,daemon=True) for _ in range(n_loaders)]
+    for thread in threads:
+        thread.start()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending=deque()
+            for shard in shards:
+                if errors:
+                    break
+                pending.append(executor.submit(transform,shard))
+                if len(pending)>=max_pending:
+                    results.put(pending.popleft().result())
+            while pending and not errors:
+                results.put(pending.popleft().result())
+            for future in pending:
+                future.cancel()
+    finally:
+        for _ in threads:
+            results.put(done)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return n_loaded[0]
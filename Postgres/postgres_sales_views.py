@@ -0,0 +1,338 @@
+from __future__ import annotations
+from datetime import date, timedelta
+from typing import List, Tuple
+from Connections.connection_manager import postgres_connection
+from Cache.result_cache import cached_query
+
+
+'''
+Materialized view band_genre_year_sales holding the summed album sales per band, genre
+and year, kept up to date from Python:
+
+- single album writes are logged by a row trigger on albums into the summary table
+  band_genre_year_sales_log, which the queries add to the view, so the view does not
+  have to be refreshed after every write
+- changes the log does not capture (bulk loads, which switch off the row trigger with
+  the setting musicians.bulk_load, TRUNCATE, which fires no row triggers, and changes
+  of bands and has_genre) increase the change version in sales_view_changes by
+  statement triggers
+- refresh_sales_view refreshes the view CONCURRENTLY, so readers are not blocked, and
+  in the same REPEATABLE READ snapshot deletes the logged rows the view now contains
+  and stores the change version the view corresponds to in sales_view_state
+
+The view is fresh if its stored version equals the current change version. The query
+functions consult the freshness and read the base tables while the view is stale.
+Queries over a date range sum the rows of the view of all years fully inside the
+range and only join the albums of the partially covered years at the range limits.
+'''
+
+query_create_sales_view='''
+DROP MATERIALIZED VIEW IF EXISTS band_genre_year_sales;
+CREATE MATERIALIZED VIEW band_genre_year_sales
+AS SELECT b.band_id, hg.genre_id, EXTRACT(YEAR FROM a.release_date)::INT AS year, SUM(a.sales) AS sales
+FROM albums AS a
+JOIN bands AS b ON a.band_url=b.band_url
+JOIN has_genre AS hg ON b.band_id=hg.band_id
+WHERE a.sales IS NOT NULL AND a.release_date IS NOT NULL
+GROUP BY b.band_id, hg.genre_id, EXTRACT(YEAR FROM a.release_date)::INT;
+
+CREATE UNIQUE INDEX index_band_genre_year_sales ON band_genre_year_sales USING btree (year, genre_id, band_id);
+
+DROP TABLE IF EXISTS band_genre_year_sales_log;
+CREATE TABLE band_genre_year_sales_log(
+	band_id 	INT 	NOT NULL,
+	genre_id 	INT 	NOT NULL,
+	year 		INT 	NOT NULL,
+	sales 		BIGINT 	NOT NULL
+);
+CREATE INDEX index_band_genre_year_sales_log ON band_genre_year_sales_log USING btree (year, genre_id);
+
+DROP TABLE IF EXISTS sales_view_changes;
+CREATE TABLE sales_view_changes(change_version BIGINT NOT NULL);
+INSERT INTO sales_view_changes VALUES (0);
+
+DROP TABLE IF EXISTS sales_view_state;
+CREATE TABLE sales_view_state(refreshed_version BIGINT NOT NULL, refreshed_at TIMESTAMPTZ NOT NULL);
+INSERT INTO sales_view_state VALUES (0, now());
+
+CREATE OR REPLACE FUNCTION log_album_sales()
+RETURNS trigger
+LANGUAGE plpgsql
+AS
+$$
+begin
+	IF current_setting('musicians.bulk_load', true)='on' THEN
+		RETURN NULL;
+	END IF;
+	IF TG_OP IN ('UPDATE','DELETE') AND OLD.sales IS NOT NULL AND OLD.release_date IS NOT NULL THEN
+		INSERT INTO band_genre_year_sales_log(band_id,genre_id,year,sales)
+		SELECT b.band_id, hg.genre_id, EXTRACT(YEAR FROM OLD.release_date)::INT, -OLD.sales
+		FROM bands AS b
+		JOIN has_genre AS hg ON b.band_id=hg.band_id
+		WHERE b.band_url=OLD.band_url;
+	END IF;
+	IF TG_OP IN ('INSERT','UPDATE') AND NEW.sales IS NOT NULL AND NEW.release_date IS NOT NULL THEN
+		INSERT INTO band_genre_year_sales_log(band_id,genre_id,year,sales)
+		SELECT b.band_id, hg.genre_id, EXTRACT(YEAR FROM NEW.release_date)::INT, NEW.sales
+		FROM bands AS b
+		JOIN has_genre AS hg ON b.band_id=hg.band_id
+		WHERE b.band_url=NEW.band_url;
+	END IF;
+	RETURN NULL;
+end;
+$$;
+
+CREATE OR REPLACE FUNCTION mark_sales_view_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS
+$$
+begin
+	IF TG_OP='TRUNCATE' OR TG_TABLE_NAME<>'albums' OR current_setting('musicians.bulk_load', true)='on' THEN
+		UPDATE sales_view_changes SET change_version=change_version+1;
+	END IF;
+	RETURN NULL;
+end;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_log_album_sales ON albums;
+CREATE TRIGGER trigger_log_album_sales AFTER INSERT OR UPDATE OR DELETE ON albums
+FOR EACH ROW EXECUTE FUNCTION log_album_sales();
+
+DROP TRIGGER IF EXISTS trigger_albums_changed ON albums;
+CREATE TRIGGER trigger_albums_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON albums
+FOR EACH STATEMENT EXECUTE FUNCTION mark_sales_view_changed();
+
+DROP TRIGGER IF EXISTS trigger_bands_changed ON bands;
+CREATE TRIGGER trigger_bands_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bands
+FOR EACH STATEMENT EXECUTE FUNCTION mark_sales_view_changed();
+
+DROP TRIGGER IF EXISTS trigger_has_genre_changed ON has_genre;
+CREATE TRIGGER trigger_has_genre_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON has_genre
+FOR EACH STATEMENT EXECUTE FUNCTION mark_sales_view_changed();
+'''
+
+query_refresh_sales_view='''
+REFRESH MATERIALIZED VIEW CONCURRENTLY band_genre_year_sales;
+DELETE FROM band_genre_year_sales_log;
+UPDATE sales_view_state SET refreshed_version=(SELECT change_version FROM sales_view_changes), refreshed_at=now();
+'''
+
+query_begin_bulk_load='''SET LOCAL musicians.bulk_load='on';'''
+
+query_sales_view_exists='''SELECT to_regclass('band_genre_year_sales') IS NOT NULL;'''
+
+query_sales_view_state='''
+SELECT s.refreshed_version, c.change_version, s.refreshed_at
+FROM sales_view_state AS s, sales_view_changes AS c;
+'''
+
+query_genre_sales_view='''
+WITH sales AS (
+    SELECT v.genre_id, v.sales
+    FROM band_genre_year_sales AS v
+    WHERE v.year BETWEEN %(first_year)s AND %(last_year)s
+    UNION ALL
+    SELECT l.genre_id, l.sales
+    FROM band_genre_year_sales_log AS l
+    WHERE l.year BETWEEN %(first_year)s AND %(last_year)s
+    UNION ALL
+    SELECT hg.genre_id, a.sales
+    FROM albums AS a
+    JOIN bands AS b ON a.band_url=b.band_url
+    JOIN has_genre AS hg ON b.band_id=hg.band_id
+    WHERE a.sales IS NOT NULL AND ({partial_ranges})
+)
+SELECT genre_id FROM sales
+GROUP BY genre_id ORDER BY SUM(sales) DESC
+LIMIT 1;
+'''
+
+query_band_sales_view='''
+WITH sales AS (
+    SELECT v.band_id, v.sales
+    FROM band_genre_year_sales AS v
+    WHERE v.genre_id=%(genre_id)s AND v.year BETWEEN %(first_year)s AND %(last_year)s
+    UNION ALL
+    SELECT l.band_id, l.sales
+    FROM band_genre_year_sales_log AS l
+    WHERE l.genre_id=%(genre_id)s AND l.year BETWEEN %(first_year)s AND %(last_year)s
+    UNION ALL
+    SELECT b.band_id, a.sales
+    FROM albums AS a
+    JOIN bands AS b ON a.band_url=b.band_url
+    JOIN has_genre AS hg ON b.band_id=hg.band_id
+    WHERE hg.genre_id=%(genre_id)s AND a.sales IS NOT NULL AND ({partial_ranges})
+)
+SELECT b.band_url FROM sales AS s
+JOIN bands AS b ON b.band_id=s.band_id
+GROUP BY b.band_url ORDER BY SUM(s.sales) DESC
+LIMIT 1;
+'''
+
+query_genre_base='''
+SELECT hg.genre_id
+FROM albums AS a
+JOIN bands AS b ON a.band_url=b.band_url
+JOIN has_genre AS hg ON b.band_id=hg.band_id
+WHERE a.release_date BETWEEN %(start_date)s AND %(end_date)s
+AND a.sales IS NOT NULL
+GROUP BY hg.genre_id ORDER BY SUM(a.sales) DESC
+LIMIT 1;
+'''
+
+query_band_base='''
+SELECT b.band_url
+FROM albums AS a
+JOIN bands AS b ON a.band_url=b.band_url
+JOIN has_genre AS hg ON b.band_id=hg.band_id
+WHERE hg.genre_id=%(genre_id)s
+AND a.release_date BETWEEN %(start_date)s AND %(end_date)s
+AND a.sales IS NOT NULL
+GROUP BY b.band_url ORDER BY SUM(a.sales) DESC
+LIMIT 1;
+'''
+
+
+def split_date_range(start_date:date, end_date:date)->Tuple[int,int,List[Tuple[date,date]]]:
+    '''
+    Splitting of the range [start_date, end_date] into the years first_year to last_year
+    that are fully covered by the range and the remaining partial ranges [start, end)
+    at its limits
+    '''
+    end_date=end_date+timedelta(days=1)
+    first_year=start_date.year if start_date==date(start_date.year,1,1) else start_date.year+1
+    last_year=end_date.year-1
+    if first_year>last_year:
+        return first_year, last_year, [(start_date, end_date)]
+    partial_ranges=[]
+    if start_date<date(first_year,1,1):
+        partial_ranges.append((start_date, date(first_year,1,1)))
+    if date(last_year+1,1,1)<end_date:
+        partial_ranges.append((date(last_year+1,1,1), end_date))
+    return first_year, last_year, partial_ranges
+
+
+def get_query_params(start_date:date, end_date:date)->Tuple[str,dict]:
+    '''
+    SQL condition on a.release_date for the partial ranges of a date range and the
+    parameters of the sales view queries
+    '''
+    first_year,last_year,partial_ranges=split_date_range(start_date, end_date)
+    params={'first_year': first_year, 'last_year': last_year}
+    conditions=[]
+    for idx,(start,end) in enumerate(partial_ranges):
+        conditions.append('(a.release_date >= %(start_{0})s AND a.release_date < %(end_{0})s)'.format(idx))
+        params['start_{}'.format(idx)]=start
+        params['end_{}'.format(idx)]=end
+    return ' OR '.join(conditions) or 'FALSE', params
+
+
+def create_sales_view(conn:psycopg2.extensions.connection)->None:
+    '''
+    Creation of the materialized view, the log and state tables and the triggers
+    '''
+    with conn.cursor() as cur:
+        cur.execute(query_create_sales_view)
+    conn.commit()
+
+
+def sales_view_exists(cur:psycopg2.extensions.cursor)->bool:
+    cur.execute(query_sales_view_exists)
+    return cur.fetchone()[0]
+
+
+def refresh_sales_view(conn:psycopg2.extensions.connection)->None:
+    '''
+    Concurrent refresh of the materialized view. The refresh, the deletion of the
+    logged rows and the stored change version all see the same snapshot, so rows
+    logged by writes committed during the refresh are kept in the log
+    '''
+    import psycopg2.extensions
+    conn.commit()
+    isolation_level=conn.isolation_level
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query_refresh_sales_view)
+        conn.commit()
+    except psycopg2.DatabaseError:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level='DEFAULT' if isolation_level is None else isolation_level)
+
+
+def refresh_after_load()->None:
+    '''
+    Refreshing of the materialized view after a load, if it was created
+    '''
+    with postgres_connection() as conn:
+        with conn.cursor() as cur:
+            exists=sales_view_exists(cur)
+        if exists:
+            refresh_sales_view(conn)
+            print('Refreshed materialized view band_genre_year_sales.')
+
+
+def get_sales_view_state(cur:psycopg2.extensions.cursor)->dict:
+    '''
+    Freshness of the materialized view: the change version it was refreshed at, the
+    current change version and the time of the last refresh
+    '''
+    cur.execute(query_sales_view_state)
+    refreshed_version,change_version,refreshed_at=cur.fetchone()
+    return {'fresh': refreshed_version==change_version,
+            'refreshed_version': refreshed_version,
+            'change_version': change_version,
+            'refreshed_at': refreshed_at}
+
+
+def is_sales_view_fresh(cur:psycopg2.extensions.cursor)->bool:
+    '''
+    Check whether the materialized view together with the log reflects the tables
+    '''
+    return sales_view_exists(cur) and get_sales_view_state(cur)['fresh']
+
+
+def get_most_successful_genre_id(cur:psycopg2.extensions.cursor, start_date:date, end_date:date)->int:
+    '''
+    Get the id of the genre with the most sales between start_date and end_date (inclusive)
+    from the materialized view if it is fresh and from the tables otherwise
+    '''
+    if not is_sales_view_fresh(cur):
+        cur.execute(query_genre_base, {'start_date': start_date, 'end_date': end_date})
+        return cur.fetchone()[0]
+    partial_ranges,params=get_query_params(start_date, end_date)
+    cur.execute(query_genre_sales_view.format(partial_ranges=partial_ranges), params)
+    return cur.fetchone()[0]
+
+
+def get_most_successful_band_url(cur:psycopg2.extensions.cursor, start_date:date, end_date:date, genre_id:int)->str:
+    '''
+    Get the url of the band with the most sales between start_date and end_date (inclusive)
+    in a genre from the materialized view if it is fresh and from the tables otherwise
+    '''
+    if not is_sales_view_fresh(cur):
+        cur.execute(query_band_base, {'start_date': start_date, 'end_date': end_date, 'genre_id': genre_id})
+        return cur.fetchone()[0]
+    partial_ranges,params=get_query_params(start_date, end_date)
+    params['genre_id']=genre_id
+    cur.execute(query_band_sales_view.format(partial_ranges=partial_ranges), params)
+    return cur.fetchone()[0]
+
+
+#read-through cached versions of the queries, invalidated by the loaders and the album writes
+get_most_successful_genre_id_cached=cached_query('postgres')(get_most_successful_genre_id)
+get_most_successful_band_url_cached=cached_query('postgres')(get_most_successful_band_url)
+
+
+if __name__=='__main__':
+    with postgres_connection() as conn:
+        create_sales_view(conn)
+        with conn.cursor() as cur:
+            print('Sales view state: {}'.format(get_sales_view_state(cur)))
+            #1. Get the most successful band in the 2010s in the most successful genre of the 1990s
+            genre_id=get_most_successful_genre_id(cur, date(1989,12,31), date(2000,1,1))
+            band_url=get_most_successful_band_url(cur, date(2009,12,31), date(2020,1,1), genre_id)
+            print('Most successful band: {}'.format(band_url))
@@ -0,0 +1,237 @@
+from __future__ import annotations
+from collections import Counter
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from Cache.result_cache import bump_data_version
+from Benchmark.instrumentation import span, count
+
+
+'''
+Batched album writes for a feed of album adds and removes. An operation is a tuple
+('add', band_url, album) or ('remove', band_url, album), where album is a dict with
+the keys of the albums of create_json_document (album_name, release_date,
+description, running_time, sales). Removes match the albums of a band by album_name.
+
+The operations of a batch are coalesced per band in the order of the feed: a remove
+of an album added earlier in the same batch cancels these adds, any other remove
+removes all stored albums of that name. Adds are added after the removal. Every band
+is written once per batch:
+
+- MongoDB: one update per band, filtered by the indexed band_url and sent in one
+  unordered bulk_write. A band with only adds gets $push $each of the albums and $inc
+  of the precomputed sales per decade and year. A band with removes is written by a
+  pipeline update, which filters the stored albums and recomputes the precomputed
+  sales of the band from the albums it holds after the update, so they follow the
+  albums that were actually removed. The yearly genre rollup is updated with one more
+  bulk_write per batch, by the sales of the added albums and of the stored albums of
+  the removed names, read before the update. The precomputed sales and the genre
+  rollup are only updated if the rollups of mongo_optimization were created
+- Postgres: one DELETE and one multi-row INSERT in a single statement. The row
+  trigger of postgres_sales_views logs the sales of the inserted and deleted rows
+  within the same statement
+
+AlbumBatchWriter collects the operations of the feed and writes them in batches.
+'''
+
+
+def coalesce_album_operations(operations:Iterable[Tuple[str,str,dict]])->Dict[str,Tuple[Dict[str,dict],List[dict]]]:
+    '''
+    Coalescing of the operations per band into the albums to remove from the stored
+    albums by name and the albums to add afterwards. A remove of an album added in
+    the batch only cancels the adds
+    '''
+    bands={}
+    for operation,band_url,album in operations:
+        removes,adds=bands.setdefault(band_url,({},[]))
+        if operation=='add':
+            adds.append(album)
+        elif operation=='remove':
+            added=[added for added in adds if added['album_name']==album['album_name']]
+            if added:
+                adds[:]=[added for added in adds if added['album_name']!=album['album_name']]
+            else:
+                removes[album['album_name']]=album
+        else:
+            raise ValueError('Unknown album operation: {}'.format(operation))
+    return bands
+
+
+def get_sales_deltas(removed:List[dict], added:List[dict])->Tuple[Counter,Counter]:
+    '''
+    Changes of the precomputed sales of a band by field (decade and year fields) and
+    by year, from the release dates and sales of the removed and added albums
+    '''
+    from MongoDB.mongo_optimization import get_decade_field, get_year_field
+    field_deltas=Counter()
+    year_deltas=Counter()
+    albums=[(album,-1) for album in removed]+[(album,1) for album in added]
+    for album,sign in albums:
+        if not isinstance(album.get('release_date'),(date,datetime)) or album.get('sales') is None:
+            continue
+        sales=sign*album['sales']
+        field_deltas[get_decade_field(album['release_date'])]+=sales
+        field_deltas[get_year_field(album['release_date'])]+=sales
+        year_deltas[album['release_date'].year]+=sales
+    return field_deltas, year_deltas
+
+
+def get_mongo_album_update(removes:Dict[str,dict], adds:List[dict], update_sales_fields:bool=False):
+    '''
+    Update of a band document for the coalesced operations of the band, with
+    update_sales_fields also of its precomputed sales
+    '''
+    from MongoDB.mongo_optimization import pipeline_sales_fields
+    if removes:
+        pipeline=[{'$set': {'albums': {'$concatArrays': [
+            {'$filter': {'input': {'$ifNull': ['$albums', []]},
+                         'cond': {'$not': [{'$in': ['$$this.album_name', list(removes)]}]}}},
+            {'$literal': adds}]}}}]
+        return pipeline+pipeline_sales_fields if update_sales_fields else pipeline
+    update={'$push': {'albums': {'$each': adds}}}
+    field_deltas={field:delta for field,delta in get_sales_deltas([],adds)[0].items() if delta!=0}
+    if update_sales_fields and field_deltas:
+        update['$inc']=field_deltas
+    return update
+
+
+def write_mongo_album_batch(col:pymongo.collection.Collection, operations:Iterable[Tuple[str,str,dict]],
+                            update_sales_fields:Optional[bool]=None)->int:
+    '''
+    Writing of a batch of album operations to the bands collection with one update per
+    band in an unordered bulk_write. With update_sales_fields the precomputed sales
+    and the yearly genre rollup are updated, by default if the genre rollup exists.
+    The genre rollup is never created by a batch. It follows the albums read before
+    the update, so it can miss concurrent writes to the same bands by other writers,
+    which mongo_optimization.create_rollups corrects. Returns the number of matched
+    bands
+    '''
+    from pymongo import UpdateOne
+    from MongoDB.mongo_optimization import genre_rollup_collection, has_genre_rollup
+    from MongoDB.mongo_album_layout import update_album_documents
+    bands={band_url:(removes,adds) for band_url,(removes,adds) in coalesce_album_operations(operations).items()
+           if removes or adds}
+    if not bands:
+        return 0
+    has_rollup=has_genre_rollup(col)
+    if update_sales_fields is None:
+        update_sales_fields=has_rollup
+    stored={}
+    if update_sales_fields and has_rollup:
+        projection={'band_url': 1, 'genres.genre_name': 1,
+                    'albums.album_name': 1, 'albums.release_date': 1, 'albums.sales': 1}
+        stored={doc['band_url']:doc for doc in col.find({'band_url': {'$in': list(bands)}},projection)}
+    requests=[UpdateOne({'band_url': band_url},get_mongo_album_update(removes,adds,update_sales_fields))
+              for band_url,(removes,adds) in bands.items()]
+    with span('network_write',collection=col.name):
+        res=col.bulk_write(requests,ordered=False)
+    count('rows',len(requests),stage='network_write',collection=col.name)
+    genre_deltas=Counter()
+    for band_url,doc in stored.items():
+        removes,adds=bands[band_url]
+        removed=[album for album in doc.get('albums',[]) if album.get('album_name') in removes]
+        year_deltas=get_sales_deltas(removed,adds)[1]
+        for genre in doc.get('genres',[]):
+            for year,sales in year_deltas.items():
+                genre_deltas[(genre['genre_name'],year)]+=sales
+    rollup_requests=[UpdateOne({'genre': genre, 'year': year},{'$inc': {'sales': sales}},upsert=True)
+                     for (genre,year),sales in genre_deltas.items() if sales!=0]
+    if rollup_requests:
+        col.database[genre_rollup_collection].bulk_write(rollup_requests,ordered=False)
+    update_album_documents(col,{'band_url': {'$in': list(bands)}})
+    bump_data_version('mongodb')
+    return res.matched_count
+
+
+album_columns=['band_url','album_name','release_date','description','running_time','sales']
+
+query_write_albums='''
+WITH deleted AS (
+    {delete}
+), inserted AS (
+    {insert}
+)
+SELECT (SELECT COUNT(*) FROM deleted), (SELECT COUNT(*) FROM inserted);
+'''
+
+query_delete_albums='''DELETE FROM albums AS a USING (VALUES {values}) AS r(band_url, album_name)
+    WHERE a.band_url=r.band_url AND a.album_name=r.album_name
+    RETURNING a.album_id'''
+
+query_insert_albums='''INSERT INTO albums(band_url,album_name,release_date,description,running_time,sales)
+    VALUES {values}
+    RETURNING album_id'''
+
+query_no_albums='''SELECT NULL::INT AS album_id WHERE FALSE'''
+
+
+def write_postgres_album_batch(conn:psycopg2.extensions.connection, operations:Iterable[Tuple[str,str,dict]])->Tuple[int,int]:
+    '''
+    Writing of a batch of album operations to the albums table with one DELETE and one
+    multi-row INSERT in a single statement. Both see the table before the statement,
+    so the deletes do not remove albums inserted by the same batch. Returns the number
+    of deleted and inserted albums
+    '''
+    bands=coalesce_album_operations(operations)
+    removes=[(band_url,album_name) for band_url,(band_removes,_) in bands.items() for album_name in band_removes]
+    adds=[(band_url,)+tuple(album.get(column) for column in album_columns[1:])
+          for band_url,(_,band_adds) in bands.items() for album in band_adds]
+    if not removes and not adds:
+        return 0,0
+    with conn.cursor() as cur:
+        delete=query_no_albums
+        if removes:
+            delete=query_delete_albums.format(values=','.join(cur.mogrify('(%s,%s)',row).decode('utf8') for row in removes))
+        insert=query_no_albums
+        if adds:
+            insert=query_insert_albums.format(values=','.join(cur.mogrify('(%s,%s,%s,%s,%s,%s)',row).decode('utf8') for row in adds))
+        with span('network_write',table='albums'):
+            cur.execute(query_write_albums.format(delete=delete,insert=insert))
+            n_deleted,n_inserted=cur.fetchone()
+        count('rows',len(removes)+len(adds),stage='network_write',table='albums')
+    conn.commit()
+    bump_data_version('postgres')
+    return n_deleted,n_inserted
+
+
+class AlbumBatchWriter:
+    '''
+    Collection of the album operations of a feed, written by write in batches of
+    batch_size operations. Used as context manager the remaining operations are
+    written on exit, e.g.
+
+    with AlbumBatchWriter(lambda batch: write_mongo_album_batch(col, batch)) as writer:
+        writer.add(band_url, album)
+    '''
+    def __init__(self, write:Callable[[List[Tuple[str,str,dict]]],object], batch_size:int=1000):
+        self.write=write
+        self.batch_size=batch_size
+        self.operations=[]
+        self.n_batches=0
+
+    def __enter__(self)->'AlbumBatchWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb)->None:
+        if exc_type is None:
+            self.flush()
+
+    def add(self, band_url:str, album:dict)->None:
+        self.append('add',band_url,album)
+
+    def remove(self, band_url:str, album:dict)->None:
+        self.append('remove',band_url,album)
+
+    def append(self, operation:str, band_url:str, album:dict)->None:
+        self.operations.append((operation,band_url,album))
+        if len(self.operations)>=self.batch_size:
+            self.flush()
+
+    def flush(self)->None:
+        '''
+        Writing of the collected operations
+        '''
+        if not self.operations:
+            return
+        operations,self.operations=self.operations,[]
+        self.write(operations)
+        self.n_batches+=1
@@ -0,0 +1,274 @@
+import asyncio
+import re
+from datetime import date, datetime
+from typing import Awaitable, Callable, Hashable, List, Optional, Tuple
+from Connections.connection_manager import get_settings, get_postgres_dsn
+from Cache.result_cache import bump_data_version
+from MongoDB.mongo_queries import get_genre_pipeline, get_band_pipeline, get_highest_sales_pipeline, get_insert_album_update
+from MongoDB.mongo_optimization import get_genre_rollup_requests, genre_rollup_collection
+from MongoDB.mongo_album_layout import album_collection, get_album_update_pipeline
+from Postgres.postgres_sales_views import query_genre_base, query_band_base, query_genre_sales_view, query_band_sales_view, \
+    query_sales_view_exists, query_sales_view_state, get_query_params
+
+
+'''
+Asyncio service layer for the band and genre queries, so that one worker can serve
+many concurrent requests. MongoDB is queried with Motor and Postgres with asyncpg,
+both over a connection pool sized from the shared settings (max_pool_size and
+min_pool_size for MongoDB, minconn and maxconn for Postgres). The drivers are only
+imported when a service is opened.
+
+Identical read requests that are in flight at the same time are coalesced: the
+first request runs the query and all later ones await its result. Writes are never
+coalesced.
+'''
+
+
+class RequestCoalescer:
+    '''
+    Sharing of the result of in-flight coroutines by key
+    '''
+    def __init__(self):
+        self.in_flight={}
+        self.n_requests=0
+        self.n_queries=0
+
+    async def run(self, key:Hashable, query:Callable[[],Awaitable]):
+        '''
+        Awaiting the running query of key or starting query if none is running. The
+        shared task is shielded, so a cancelled caller does not cancel the other callers
+        '''
+        self.n_requests+=1
+        task=self.in_flight.get(key)
+        if task is None:
+            self.n_queries+=1
+            task=asyncio.ensure_future(query())
+            self.in_flight[key]=task
+            task.add_done_callback(lambda _: self.in_flight.pop(key,None))
+        return await asyncio.shield(task)
+
+
+def convert_query_params(query:str, params:dict)->Tuple[str,list]:
+    '''
+    Conversion of a query with psycopg2 named parameters %(name)s into a query with
+    the positional parameters $1, $2, ... of asyncpg and the list of their values
+    '''
+    names=[]
+    def replace(match):
+        name=match.group(1)
+        if name not in names:
+            names.append(name)
+        return '${}'.format(names.index(name)+1)
+    return re.sub(r'%\((\w+)\)s',replace,query), [params[name] for name in names]
+
+
+class MongoQueryService:
+    '''
+    Async queries on the bands collection with a Motor collection
+    '''
+    def __init__(self, col):
+        self.col=col
+        self.coalescer=RequestCoalescer()
+
+    @classmethod
+    def connect(cls)->'MongoQueryService':
+        '''
+        Opening of a Motor client with the shared MongoDB settings
+        '''
+        import motor.motor_asyncio
+        mongo=get_settings()['mongodb']
+        client=motor.motor_asyncio.AsyncIOMotorClient(mongo['uri'],
+                                                      maxPoolSize=int(mongo['max_pool_size']),
+                                                      minPoolSize=int(mongo['min_pool_size']))
+        return cls(client[mongo['database']][mongo['collection']])
+
+    def close(self)->None:
+        self.col.database.client.close()
+
+    async def aggregate_first(self, pipeline:list)->dict:
+        '''
+        First document of an aggregation pipeline
+        '''
+        res=await self.col.aggregate(pipeline).to_list(length=1)
+        return res[0]
+
+    async def get_genre(self, start_date:datetime, end_date:datetime)->str:
+        '''
+        Get the genre with the most sales in a timeframe
+        '''
+        async def query():
+            res=await self.aggregate_first(get_genre_pipeline(start_date, end_date))
+            return res['_id']['genre']
+        return await self.coalescer.run(('genre',start_date,end_date),query)
+
+    async def get_band(self, start_date:datetime, end_date:datetime, genre:str)->str:
+        '''
+        Get the band with the most sales in a specific genre in a timeframe
+        '''
+        async def query():
+            res=await self.aggregate_first(get_band_pipeline(start_date, end_date, genre))
+            return res['_id']['band']
+        return await self.coalescer.run(('band',start_date,end_date,genre),query)
+
+    async def get_highest_sales(self)->int:
+        '''
+        Get the overall highest sales
+        '''
+        async def query():
+            res=await self.aggregate_first(get_highest_sales_pipeline())
+            return res['albums']['sales']
+        return await self.coalescer.run(('highest_sales',),query)
+
+    async def insert_album(self, band:str, sales:int, update_sales_fields:Optional[bool]=None)->None:
+        '''
+        Insert a new album for an existing band with higher sales than any other album,
+        as insert_album of mongo_queries, including the album documents of the band.
+        The precomputed sales and the genre rollup are by default only updated if the
+        genre rollup exists
+        '''
+        date=datetime(2019,1,1,0,0,0,0)
+        has_rollup=bool(await self.col.database.list_collection_names(filter={'name': genre_rollup_collection}))
+        if update_sales_fields is None:
+            update_sales_fields=has_rollup
+        update=get_insert_album_update(date, sales+1, update_sales_fields)
+        if update_sales_fields:
+            doc=await self.col.find_one_and_update({'band_name': band}, update, projection={'genres': 1})
+            if doc is not None and has_rollup:
+                requests=get_genre_rollup_requests(doc.get('genres', []), date, sales+1)
+                if requests:
+                    await self.col.database[genre_rollup_collection].bulk_write(requests, ordered=False)
+        else:
+            await self.col.update_one({'band_name': band}, update)
+        if await self.col.database.list_collection_names(filter={'name': album_collection}):
+            await self.col.database[album_collection].delete_many({'band_name': band})
+            await self.col.aggregate(get_album_update_pipeline({'band_name': band})).to_list(length=None)
+        bump_data_version('mongodb')
+
+
+query_genre_name='''SELECT genre_name FROM genres WHERE genre_id=%(genre_id)s;'''
+
+query_genre_id='''SELECT MIN(genre_id) FROM genres WHERE genre_name=%(genre)s;'''
+
+
+class PostgresQueryService:
+    '''
+    Async queries on the Postgres tables with an asyncpg pool. The genre and band
+    queries read the materialized view of postgres_sales_views if it is fresh and the
+    tables otherwise, like the synchronous queries. Genres are passed and returned by
+    name as by MongoQueryService, the end of a timeframe is inclusive
+    '''
+    def __init__(self, pool):
+        self.pool=pool
+        self.coalescer=RequestCoalescer()
+
+    @classmethod
+    async def connect(cls)->'PostgresQueryService':
+        '''
+        Opening of an asyncpg pool with the shared Postgres settings
+        '''
+        import asyncpg
+        pg=get_settings()['postgres']
+        dsn=get_postgres_dsn()
+        pool=await asyncpg.create_pool(host=dsn['host'], port=int(dsn['port']), database=dsn['dbname'],
+                                       user=dsn['user'], password=dsn['password'],
+                                       min_size=int(pg['minconn']), max_size=int(pg['maxconn']))
+        return cls(pool)
+
+    async def close(self)->None:
+        await self.pool.close()
+
+    async def fetchval(self, query:str, params:dict=None, conn=None):
+        '''
+        First value of the first row of a query with psycopg2 named parameters, on conn
+        or on a connection of the pool
+        '''
+        query,args=convert_query_params(query, params or {})
+        if conn is not None:
+            return await conn.fetchval(query, *args)
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def is_sales_view_fresh(self, conn)->bool:
+        '''
+        Check whether the materialized view together with its log reflects the tables
+        '''
+        if not await conn.fetchval(query_sales_view_exists):
+            return False
+        refreshed_version,change_version,_=await conn.fetchrow(query_sales_view_state)
+        return refreshed_version==change_version
+
+    async def get_genre(self, start_date:date, end_date:date)->str:
+        '''
+        Get the genre with the most sales in a timeframe
+        '''
+        async def query():
+            async with self.pool.acquire() as conn:
+                if await self.is_sales_view_fresh(conn):
+                    partial_ranges,params=get_query_params(start_date, end_date)
+                    genre_id=await self.fetchval(query_genre_sales_view.format(partial_ranges=partial_ranges), params, conn)
+                else:
+                    genre_id=await self.fetchval(query_genre_base, {'start_date': start_date, 'end_date': end_date}, conn)
+                return await self.fetchval(query_genre_name, {'genre_id': genre_id}, conn)
+        return await self.coalescer.run(('genre',start_date,end_date),query)
+
+    async def get_band(self, start_date:date, end_date:date, genre:str)->str:
+        '''
+        Get the url of the band with the most sales in a genre in a timeframe
+        '''
+        async def query():
+            async with self.pool.acquire() as conn:
+                genre_id=await self.fetchval(query_genre_id, {'genre': genre}, conn)
+                if await self.is_sales_view_fresh(conn):
+                    partial_ranges,params=get_query_params(start_date, end_date)
+                    params['genre_id']=genre_id
+                    return await self.fetchval(query_band_sales_view.format(partial_ranges=partial_ranges), params, conn)
+                return await self.fetchval(query_band_base, {'start_date': start_date, 'end_date': end_date,
+                                                             'genre_id': genre_id}, conn)
+        return await self.coalescer.run(('band',start_date,end_date,genre),query)
+
+    async def get_highest_sales(self)->int:
+        '''
+        Get the overall highest sales
+        '''
+        return await self.coalescer.run(
+            ('highest_sales',),
+            lambda: self.fetchval('SELECT MAX(sales) FROM albums'))
+
+    async def insert_album(self, band_url:str, sales:int)->None:
+        '''
+        Insert a new album for an existing band with higher sales than any other album
+        '''
+        async with self.pool.acquire() as conn:
+            await conn.execute('''INSERT INTO albums(band_url,album_name,release_date,description,running_time,sales)
+                                  VALUES($1, 'nice album name', '2019-04-20', 'nice description', 50.7, $2)''',
+                               band_url, sales+1)
+        bump_data_version('postgres')
+
+
+async def run_concurrent(n_requests:int)->None:
+    '''
+    Running of the flagship query n_requests times concurrently on both databases
+    '''
+    mongo=MongoQueryService.connect()
+    postgres=await PostgresQueryService.connect()
+    try:
+        async def query_mongo():
+            genre=await mongo.get_genre(datetime(1989,12,31), datetime(2000,1,1))
+            return await mongo.get_band(datetime(2009,12,31), datetime(2020,1,1), genre)
+
+        async def query_postgres():
+            genre=await postgres.get_genre(date(1989,12,31), date(2000,1,1))
+            return await postgres.get_band(date(2009,12,31), date(2020,1,1), genre)
+
+        bands:List[str]=await asyncio.gather(*[query_mongo() for _ in range(n_requests)],
+                                             *[query_postgres() for _ in range(n_requests)])
+        print('Most successful band: {} (MongoDB), {} (Postgres)'.format(bands[0],bands[-1]))
+        for name,service in [('MongoDB',mongo),('Postgres',postgres)]:
+            print('{}: {} requests, {} queries'.format(name,service.coalescer.n_requests,service.coalescer.n_queries))
+    finally:
+        mongo.close()
+        await postgres.close()
+
+
+if __name__=='__main__':
+    asyncio.run(run_concurrent(100))
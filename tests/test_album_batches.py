@@ -0,0 +1,80 @@
+from datetime import datetime
+from Service.album_batches import coalesce_album_operations, write_mongo_album_batch
+
+
+'''
+Coalescing of album operations and the genre rollup changes of a batch on a fake
+bands collection, which only records the writes. The sales of the band documents
+are recomputed on the server and not part of the test.
+'''
+
+
+def get_album(name:str, year:int, sales:int)->dict:
+    return {'album_name': name, 'release_date': datetime(year,1,1), 'description': None,
+            'running_time': None, 'sales': sales}
+
+
+class FakeCollection:
+    def __init__(self, docs:list, name:str='bands', database=None):
+        self.docs=docs
+        self.name=name
+        self.database=database or FakeDatabase(self)
+        self.writes=[]
+
+    def find(self, query:dict, projection:dict=None):
+        return [doc for doc in self.docs if doc['band_url'] in query['band_url']['$in']]
+
+    def bulk_write(self, requests:list, ordered:bool=True):
+        self.writes.extend(requests)
+        return type('BulkWriteResult',(),{'matched_count': len(requests)})
+
+
+class FakeDatabase:
+    def __init__(self, bands:FakeCollection):
+        self.collections={'bands': bands}
+
+    def __getitem__(self, name:str)->FakeCollection:
+        return self.collections.setdefault(name,FakeCollection([],name,self))
+
+    def list_collection_names(self, filter:dict=None)->list:
+        #like on the server a collection only exists after its first write
+        return [name for name,col in self.collections.items()
+                if (col.docs or col.writes) and name==(filter or {}).get('name',name)]
+
+
+def get_rollup_changes(col:FakeCollection)->dict:
+    return {(request._filter['genre'],request._filter['year']): request._doc['$inc']['sales']
+            for request in col.database['genre_sales_by_year'].writes}
+
+
+def test_remove_cancels_batch_adds():
+    bands=coalesce_album_operations([('add','a',get_album('new',2001,100)),
+                                     ('remove','a',get_album('new',2001,100)),
+                                     ('add','a',get_album('other',2002,5))])
+    assert bands=={'a': ({}, [get_album('other',2002,5)])}
+
+
+def test_rollup_follows_stored_albums():
+    col=FakeCollection([{'band_url': 'a', 'genres': [{'genre_name': 'Rock'}],
+                         'albums': [get_album('dup',1995,10), get_album('dup',1996,20), get_album('kept',1995,1)]}])
+    col.database['genre_sales_by_year'].docs.append({'genre': 'Rock', 'year': 1995, 'sales': 11})
+    write_mongo_album_batch(col,[('add','a',get_album('new',2001,100)),
+                                 ('remove','a',get_album('new',2001,100)),
+                                 ('remove','a',get_album('dup',1995,999)),
+                                 ('remove','a',get_album('missing',1995,50)),
+                                 ('remove','b',get_album('dup',1995,10))])
+    #the cancelled add, the missing album and the unknown band do not change the rollup,
+    #both stored albums named dup are removed with their stored sales
+    assert get_rollup_changes(col)=={('Rock',1995): -10, ('Rock',1996): -20}
+    assert len(col.writes)==2
+    assert isinstance(col.writes[0]._doc,list)
+
+
+def test_no_rollup_without_rollups():
+    col=FakeCollection([{'band_url': 'a', 'genres': [{'genre_name': 'Rock'}], 'albums': [get_album('old',1995,10)]}])
+    write_mongo_album_batch(col,[('add','a',get_album('new',2001,100)),
+                                 ('remove','b',get_album('old',1995,10))])
+    #a plain collection gets neither precomputed sales nor a partial genre rollup
+    assert 'genre_sales_by_year' not in col.database.list_collection_names()
+    assert '$inc' not in col.writes[0]._doc
+    assert len(col.writes[1]._doc)==1
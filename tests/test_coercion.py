@@ -0,0 +1,51 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from Postgres.postgres_data_insertion import coerce_column, convert_to_date, convert_to_datetime, try_parse
+
+
+'''
+The vectorized coercion of a column has to equal try_parse with the same type function
+applied to every value of the column.
+'''
+
+strings=['1','٣',' 12 ','1_000','-5','+7','','  ','abc','1.5','99999999999999999999',' 7 ',
+         'nan','-NaN','inf','-Infinity','1e3','٣.5',' -0 ','00012','1__0','_1','.5','5.','1e-400',
+         '1'*400,'0x10','1,5','True','12/05/1997','31/02/1997','1/1/2000']
+
+columns=[
+    pd.Series(strings,dtype=object),
+    pd.Series(strings,dtype=str),
+    pd.Series([1.5,-2.7,np.nan,np.inf,0.0]),
+    pd.Series([1,-2,3],dtype=np.int64),
+    pd.Series([True,False]),
+    pd.Series(['1',None,np.nan,'2.5'],dtype=object),
+]
+
+
+def same(a, b)->bool:
+    if isinstance(a,float) and isinstance(b,float) and math.isnan(a) and math.isnan(b):
+        return True
+    return type(a)==type(b) and a==b
+
+
+def expected_value(fun, val):
+    #try_parse only catches ValueError, the coercion gives NaN for missing floats and
+    #None for missing or infinite ints
+    try:
+        return try_parse(fun,val)
+    except (TypeError,OverflowError):
+        return np.nan if fun is float else None
+
+
+@pytest.mark.parametrize('fun', [int, float, str, bool, convert_to_date, convert_to_datetime])
+@pytest.mark.parametrize('column', range(len(columns)))
+def test_coercion_equals_try_parse(fun, column):
+    values=columns[column]
+    if fun in (convert_to_date,convert_to_datetime) and not pd.api.types.is_object_dtype(values):
+        pytest.skip('dates are only parsed from strings')
+    res=coerce_column(values,fun)
+    for val,coerced in zip(values,res):
+        expected=expected_value(fun,val)
+        assert same(coerced,expected), (val,coerced,expected)
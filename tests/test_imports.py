@@ -0,0 +1,17 @@
+import pytest
+from Cli.cli import forbidden_imports, get_import_times
+
+
+'''
+Startup check of the command line interface: the query subcommands must not import
+the heavy modules of the other database or of the loaders. Every subcommand is run
+with --import-only in a fresh process under python -X importtime.
+'''
+
+
+@pytest.mark.parametrize('command', sorted(forbidden_imports))
+def test_query_imports(command):
+    modules=get_import_times(command.split())['modules']
+    #the subcommand imported its query module, so the check is not vacuous
+    assert ('Postgres' if command.endswith('postgres') else 'MongoDB') in modules
+    assert not set(forbidden_imports[command])&modules
@@ -0,0 +1,124 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from MongoDB.mongo_analytics import SalesEngine
+from MongoDB.mongo_queries import get_genre_pipeline, get_band_pipeline
+
+
+'''
+Parity of the in-process SalesEngine with the aggregation pipelines of get_genre and
+get_band on a small fixture. The pipelines are evaluated by a minimal interpreter of
+the stages and operators they use.
+'''
+
+big_sales=2**53+1
+
+
+def get_album(year:int, sales, month:int=6)->dict:
+    return {'album_name': 'album', 'release_date': datetime(year,month,1) if year else None, 'sales': sales}
+
+
+docs=[
+    {'band_url': 'a', 'genres': [{'genre_name': 'Rock'}, {'genre_name': 'Pop'}],
+     'albums': [get_album(1991,100), get_album(1995,50), get_album(2012,300)]},
+    {'band_url': 'b', 'genres': [{'genre_name': 'Pop'}, {'genre_name': 'Pop'}],
+     'albums': [get_album(1993,70), get_album(2015,200), get_album(None,999)]},
+    {'band_url': 'c', 'genres': [{'genre_name': 'Jazz'}],
+     'albums': [get_album(1999,120,12), get_album(2000,1000,1), get_album(2011,None)]},
+    {'band_url': 'd', 'genres': [{'genre_name': 'Rock'}],
+     'albums': [get_album(2013,250), get_album(2019,100)]},
+    {'band_url': 'e', 'genres': [], 'albums': [get_album(1990,10**6)]},
+    #as float64 sums both genres would have 2**53 sales and Folk would win by its index
+    {'band_url': 'f', 'genres': [{'genre_name': 'Folk'}], 'albums': [get_album(1951,big_sales)]},
+    {'band_url': 'g', 'genres': [{'genre_name': 'Metal'}],
+     'albums': [get_album(1950,big_sales), get_album(1951,1)]},
+]
+
+
+def get_values(doc, path:str)->list:
+    values=[doc]
+    for key in path.split('.'):
+        values=[value for value in values if isinstance(value,dict) and key in value]
+        values=[item for value in values for item in
+                (value[key] if isinstance(value[key],list) else [value[key]])]
+    return values
+
+
+def matches(value, cond)->bool:
+    if isinstance(cond,dict) and '$elemMatch' in cond:
+        return isinstance(value,list) and any(match_doc(item,cond['$elemMatch']) for item in value)
+    if isinstance(cond,dict):
+        return value is not None and all({'$gte': value>=arg, '$lt': value<arg}[op]
+                                          if value is not None else False for op,arg in cond.items())
+    return value==cond
+
+
+def match_doc(doc:dict, query:dict)->bool:
+    for field,cond in query.items():
+        if isinstance(cond,dict) and '$elemMatch' in cond:
+            if not matches(doc.get(field),cond):
+                return False
+        elif not any(matches(value,cond) for value in get_values(doc,field)):
+            return False
+    return True
+
+
+def run_pipeline(docs:list, pipeline:list)->list:
+    for stage in pipeline:
+        (op,arg),=stage.items()
+        if op=='$match':
+            docs=[doc for doc in docs if match_doc(doc,arg)]
+        elif op=='$unwind':
+            field=arg['path'][1:]
+            docs=[dict(doc,**{field: item}) for doc in docs for item in doc.get(field) or []]
+        elif op=='$group':
+            (acc,(_,sum_path)),=[(name,list(expr.items())[0]) for name,expr in arg.items() if name!='_id']
+            groups={}
+            for doc in docs:
+                key=tuple((name,(get_values(doc,path[1:]) or [None])[0]) for name,path in arg['_id'].items())
+                values=[value for value in get_values(doc,sum_path[1:]) if isinstance(value,int)]
+                groups[key]=groups.get(key,0)+sum(values)
+            docs=[{'_id': dict(key), acc: total} for key,total in groups.items()]
+        elif op=='$sort':
+            (field,order),=arg.items()
+            docs=sorted(docs,key=lambda doc: doc[field],reverse=order<0)
+        elif op=='$limit':
+            docs=docs[:arg]
+    return docs
+
+
+timeframes=[(datetime(1989,12,31),datetime(2000,1,1)),(datetime(2009,12,31),datetime(2020,1,1)),
+            (datetime(1999,12,1),datetime(2000,1,2)),(datetime(1950,1,1),datetime(1952,1,1)),
+            (datetime(2030,1,1),datetime(2040,1,1))]
+
+
+@pytest.fixture
+def engine()->SalesEngine:
+    return SalesEngine.from_band_data(
+        (doc['band_url'],[genre['genre_name'] for genre in doc['genres']],
+         [(album['release_date'],album['sales']) for album in doc['albums']]) for doc in docs)
+
+
+@pytest.mark.parametrize('start_date,end_date', timeframes)
+def test_genre_parity(engine, start_date, end_date):
+    res=run_pipeline(docs,get_genre_pipeline(start_date,end_date))
+    assert engine.get_genre(start_date,end_date)==(res[0]['_id']['genre'] if res else None)
+
+
+@pytest.mark.parametrize('start_date,end_date', timeframes)
+@pytest.mark.parametrize('genre', ['Rock','Pop','Jazz','Metal','Folk','Blues'])
+def test_band_parity(engine, start_date, end_date, genre):
+    res=run_pipeline(docs,get_band_pipeline(start_date,end_date,genre))
+    assert engine.get_band(start_date,end_date,genre)==(res[0]['_id']['band'] if res else None)
+
+
+def test_exact_sums(engine):
+    genre_sales,genre_albums=engine.get_genre_sales(datetime(1950,1,1),datetime(1952,1,1))
+    assert genre_sales.dtype==genre_albums.dtype==np.int64
+    assert genre_sales[list(engine.genre_names).index('Metal')]==big_sales+1
+    assert engine.get_genre(datetime(1950,1,1),datetime(1952,1,1))=='Metal'
+
+
+def test_empty_timeframe(engine):
+    start_date,end_date=timeframes[-1]
+    assert engine.get_band(start_date,end_date,engine.get_genre(start_date,end_date)) is None
@@ -0,0 +1,84 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+import pytest
+from Service.query_service import PostgresQueryService, convert_query_params, query_genre_name, query_genre_id
+from Postgres.postgres_sales_views import query_sales_view_exists, query_sales_view_state, query_genre_base, \
+    query_band_base
+
+
+'''
+Coalescing of the async Postgres queries on a fake asyncpg pool. The fake connection
+answers by the query text and yields to the event loop on every round-trip, so
+concurrent requests overlap like on a real pool.
+'''
+
+genres={7: 'Rock', 8: 'Pop'}
+
+
+class FakeConnection:
+    def __init__(self, fresh:bool):
+        self.fresh=fresh
+        self.queries=[]
+
+    async def fetchval(self, query:str, *args):
+        await asyncio.sleep(0)
+        self.queries.append(query)
+        if query==query_sales_view_exists:
+            return True
+        if query==convert_query_params(query_genre_name,{'genre_id': 0})[0]:
+            return genres[args[0]]
+        if query==convert_query_params(query_genre_id,{'genre': ''})[0]:
+            return {name:genre_id for genre_id,name in genres.items()}[args[0]]
+        if 'SELECT genre_id FROM sales' in query or 'SELECT hg.genre_id' in query:
+            return 7
+        #the band queries filter on genre_id as their first parameter
+        assert 'genre_id=$1' in query
+        return 'band_{}'.format(args[0])
+
+    async def fetchrow(self, query:str):
+        await asyncio.sleep(0)
+        self.queries.append(query)
+        assert query==query_sales_view_state
+        return (3, 3 if self.fresh else 4, None)
+
+
+class FakePool:
+    def __init__(self, conn:FakeConnection):
+        self.conn=conn
+        self.n_acquired=0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.n_acquired+=1
+        yield self.conn
+
+
+async def run_requests(service:PostgresQueryService, n_requests:int):
+    genres=await asyncio.gather(*[service.get_genre(date(1989,12,31), date(2000,1,1)) for _ in range(n_requests)])
+    bands=await asyncio.gather(*[service.get_band(date(2009,12,31), date(2020,1,1), genres[0]) for _ in range(n_requests)])
+    return genres, bands
+
+
+@pytest.mark.parametrize('fresh', [True, False])
+def test_coalesced_requests(fresh):
+    conn=FakeConnection(fresh)
+    service=PostgresQueryService(FakePool(conn))
+    genres,bands=asyncio.run(run_requests(service, 10))
+    assert genres==['Rock']*10
+    assert bands==['band_7']*10
+    assert service.coalescer.n_requests==20
+    assert service.coalescer.n_queries==2
+    assert service.pool.n_acquired==2
+    assert not service.coalescer.in_flight
+    base_queries={convert_query_params(query_genre_base,{'start_date': 0, 'end_date': 0})[0],
+                  convert_query_params(query_band_base,{'start_date': 0, 'end_date': 0, 'genre_id': 0})[0]}
+    assert (not base_queries&set(conn.queries))==fresh
+
+
+def test_requests_after_completion():
+    service=PostgresQueryService(FakePool(FakeConnection(True)))
+    asyncio.run(run_requests(service, 3))
+    asyncio.run(run_requests(service, 3))
+    #finished queries are not cached, only queries in flight are shared
+    assert service.coalescer.n_queries==4
@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+import pytest
+from Cache.result_cache import DiskBackend, ResultCache
+
+
+'''
+Scoping of the cached results by the database of the collection or cursor and reuse
+of the sqlite connections of the disk backend.
+'''
+
+
+class FakeCollection:
+    def __init__(self, full_name:str):
+        self.full_name=full_name
+
+
+class FakeInfo:
+    host='localhost'
+    port=5432
+
+    def __init__(self, dbname:str):
+        self.dbname=dbname
+
+
+class FakeCursor:
+    def __init__(self, dbname:str):
+        self.connection=type('Connection',(),{'info': FakeInfo(dbname)})()
+
+
+def test_key_contains_database():
+    cache=ResultCache()
+    count_query=cache.cached('mongodb')(lambda col, year: (col.full_name, year))
+    assert count_query(FakeCollection('music.bands'), 1990)==('music.bands', 1990)
+    assert count_query(FakeCollection('test.bands'), 1990)==('test.bands', 1990)
+    assert count_query(FakeCollection('music.bands'), 1990)==('music.bands', 1990)
+    assert (cache.n_hits,cache.n_misses)==(1,2)
+    name_query=cache.cached('postgres')(lambda cur: cur.connection.info.dbname)
+    assert [name_query(FakeCursor(dbname)) for dbname in ['music','test','music']]==['music','test','music']
+
+
+def test_disk_backend_connections(tmp_path):
+    backend=DiskBackend(str(tmp_path/'cache.sqlite'))
+    backend.set('key', b'value', 60)
+    assert backend.get('key')==b'value'
+    assert backend.incr('version:postgres')==1
+    assert backend.get_counter('version:postgres')==1
+    assert len(backend.connections)==1
+    thread=threading.Thread(target=lambda: backend.get('key'))
+    thread.start()
+    thread.join()
+    assert len(backend.connections)==2
+    connections=list(backend.connections)
+    backend.close()
+    assert not backend.connections
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+    #a closed backend opens a new connection on the next use
+    assert backend.get('key')==b'value'
+    backend.close()
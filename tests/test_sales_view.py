@@ -0,0 +1,62 @@
+import pytest
+from Connections.connection_manager import get_postgres_dsn
+from Postgres.postgres_sales_views import create_sales_view, refresh_sales_view, is_sales_view_fresh
+
+
+'''
+Freshness of the materialized view after writes to albums, on minimal bands, albums
+and has_genre tables in a temporary schema. Skipped without a Postgres server at the
+configured dsn.
+'''
+
+schema='test_sales_view'
+
+query_create_tables='''
+DROP SCHEMA IF EXISTS {schema} CASCADE;
+CREATE SCHEMA {schema};
+SET search_path TO {schema};
+CREATE TABLE bands(band_id INT PRIMARY KEY, band_url TEXT NOT NULL);
+CREATE TABLE has_genre(band_id INT NOT NULL, genre_id INT NOT NULL);
+CREATE TABLE albums(band_url TEXT NOT NULL, release_date DATE, sales BIGINT);
+INSERT INTO bands VALUES (1, 'a');
+INSERT INTO has_genre VALUES (1, 7);
+INSERT INTO albums VALUES ('a', '1995-06-01', 100);
+'''.format(schema=schema)
+
+
+@pytest.fixture
+def conn():
+    psycopg2=pytest.importorskip('psycopg2')
+    try:
+        conn=psycopg2.connect(connect_timeout=3,**get_postgres_dsn())
+    except psycopg2.OperationalError:
+        pytest.skip('no Postgres server')
+    with conn.cursor() as cur:
+        cur.execute(query_create_tables)
+    conn.commit()
+    create_sales_view(conn)
+    refresh_sales_view(conn)
+    yield conn
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA {} CASCADE;'.format(schema))
+    conn.commit()
+    conn.close()
+
+
+def test_logged_writes_keep_view_fresh(conn):
+    with conn.cursor() as cur:
+        assert is_sales_view_fresh(cur)
+        cur.execute("INSERT INTO albums VALUES ('a', '1996-06-01', 50);")
+        assert is_sales_view_fresh(cur)
+
+
+def test_truncate_marks_view_stale(conn):
+    with conn.cursor() as cur:
+        cur.execute('TRUNCATE albums;')
+        #TRUNCATE fires no row triggers, so the logged sales can not follow it
+        assert not is_sales_view_fresh(cur)
+    conn.commit()
+    refresh_sales_view(conn)
+    with conn.cursor() as cur:
+        assert is_sales_view_fresh(cur)